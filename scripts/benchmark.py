@@ -0,0 +1,632 @@
+"""
+Offline benchmarks of the matching, parsing, and scoring pipelines. They use
+synthetic data and mock_openai_server.py, so they need neither the confidential
+data, the network, nor an API key, and runs can be compared over time.
+
+    python benchmark.py                                   # small scale, every benchmark
+    python benchmark.py --scale medium --latency 0.2 --latency-per-token 0.005 --error-rate 0.02
+    python benchmark.py --only usda_matches,nova_scoring --branded-rows 500000
+
+The synthetic data is generated once per scale and seed, into a subdirectory of
+--directory, and reused by later runs:
+
+    home/Box/dsi-core/11th-hour/good-food-purchasing/
+        branded_food.csv                    vendors with brands and families of
+                                            similar products, UPCs with check
+                                            digits, and ingredient lists (nested,
+                                            with "CONTAINS 2% OR LESS OF", and
+                                            some that the local parser finds
+                                            ambiguous), many shared between foods
+        branded_food-all-MiniLM-L6-v2.*     the vector database and its metadata;
+                                            only the first --embedded-rows are
+                                            embedded, the rest are random unit
+                                            vectors, which cost as much to scan
+                                            but never match
+        CONFIDENTIAL_GFPP ... .csv          a purchase list: copies of embedded
+                                            branded foods, the same with
+                                            abbreviated and reordered names and
+                                            UPCs as floats, and rows that match
+                                            nothing
+    test.jsonl                              NOVA examples in the fine-tuning
+                                            format
+
+Each benchmark runs a script in its own process and working directory. The
+process gets these environment variables: HOME is the synthetic home, so the
+scripts' ~/Box paths find the synthetic files. OPENAI_BASE_URL is a mock server
+that this process starts. The response cache is off. PIPELINE_METRICS collects
+the stage times and counters (see instrumentation.py).
+
+    usda_matches            usda_search.py over the purchase list
+    usda_matches_async      the same with --async
+    ingredient_parsing      parse-ingredient-lists.py into a new store: the
+                            local parser first, the LLM for the rest
+    ingredient_parsing_llm  the same with --no-local-parser
+    nova_scoring            openai-fine-tuning-test.py on test.jsonl
+
+Throughput is rows per second of wall-clock time, and that includes startup
+(loading the model, memory-mapping the vectors). "steady" throughput is
+measured from the first metrics line that counted a row to the last. It leaves
+startup out, but needs a run longer than --metrics-interval.
+
+Each run is appended to --history, a JSON list, with the git commit, data
+scale, and server settings. It is then compared with the previous run that had
+the same settings. A benchmark that is slower by more than --tolerance is
+reported as a regression. With --fail-on-regression, the exit status is 1 if
+any benchmark regressed.
+"""
+
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import food_data
+import gtin_index
+import usda_vector_database
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# relative to the synthetic home, like food_data.DATA_DIRECTORY is to the real one
+DATA_SUBDIRECTORY = os.path.join("Box", "dsi-core", "11th-hour", "good-food-purchasing")
+CGFP_FILENAME = "CONFIDENTIAL_GFPP Product Attribute List_8.26.25.csv"
+VECTOR_DATABASE_FILENAME = "branded_food-all-MiniLM-L6-v2.npy"
+
+SCALES = {
+    "small": {
+        "branded_rows": 20000,
+        "embedded_rows": 5000,
+        "ingredient_lists": 2000,
+        "purchase_rows": 200,
+        "nova_rows": 400,
+    },
+    "medium": {
+        "branded_rows": 200000,
+        "embedded_rows": 20000,
+        "ingredient_lists": 10000,
+        "purchase_rows": 1000,
+        "nova_rows": 2000,
+    },
+    "large": {
+        "branded_rows": 2000000,
+        "embedded_rows": 50000,
+        "ingredient_lists": 50000,
+        "purchase_rows": 5000,
+        "nova_rows": 10000,
+    },
+}
+
+# bump this when the generators change, so that data generated by older versions is replaced
+DATA_VERSION = 1
+
+HISTORY_PATH = os.path.join(food_data.CACHE_DIRECTORY, "benchmark", "history.json")
+
+# fraction of ingredient lists with an item that ingredient_parser.py finds ambiguous
+AMBIGUOUS_FRACTION = 0.15
+
+INGREDIENTS = [
+    "WATER", "SUGAR", "SALT", "CORN SYRUP", "SOYBEAN OIL", "CANOLA OIL", "MILK", "CREAM", "BUTTER", "EGGS",
+    "WHEY", "YEAST", "VINEGAR", "SPICES", "PAPRIKA", "GARLIC POWDER", "ONION POWDER", "TOMATO PASTE",
+    "DEXTROSE", "MALTODEXTRIN", "CARAMEL COLOR", "RED 40", "YELLOW 5", "CITRIC ACID", "ASCORBIC ACID",
+    "SODIUM BENZOATE", "POTASSIUM SORBATE", "CALCIUM PROPIONATE", "XANTHAN GUM", "GUAR GUM",
+    "MODIFIED CORN STARCH", "SOY LECITHIN", "MONO- AND DIGLYCERIDES", "HIGH FRUCTOSE CORN SYRUP", "COCOA",
+    "PALM OIL", "PEANUTS", "ALMONDS", "RICE", "OATS", "CHICKEN", "BEEF", "PORK", "CELERY", "CARROTS",
+    "NATURAL FLAVOR", "ARTIFICIAL FLAVOR", "SODIUM PHOSPHATE", "BLACK PEPPER", "HONEY",
+]
+
+COMPOUND_INGREDIENTS = {
+    "ENRICHED FLOUR": ["WHEAT FLOUR", "NIACIN", "REDUCED IRON", "THIAMIN MONONITRATE", "RIBOFLAVIN", "FOLIC ACID"],
+    "CHEDDAR CHEESE": ["PASTEURIZED MILK", "CHEESE CULTURE", "SALT", "ENZYMES", "ANNATTO"],
+    "CHOCOLATE CHIPS": ["SUGAR", "CHOCOLATE LIQUOR", "COCOA BUTTER", "SOY LECITHIN", "VANILLA"],
+    "MAYONNAISE": ["SOYBEAN OIL", "WATER", "EGG YOLKS", "VINEGAR", "SALT", "LEMON JUICE CONCENTRATE"],
+    "SEASONING": ["SALT", "SPICES", "GARLIC POWDER", "ONION POWDER", "PAPRIKA EXTRACT"],
+    "BREADCRUMBS": ["ENRICHED WHEAT FLOUR", "SUGAR", "YEAST", "SALT", "SOYBEAN OIL"],
+}
+
+# items that ingredient_parser.py sends to the LLM
+AMBIGUOUS_ITEMS = [
+    "SALT AND PEPPER", "VITAMIN A & D", "COLOR (CONTAINS: TURMERIC)", "BEEF OR PORK", "SPICES. CONTAINS MILK",
+]
+
+# what additives are sometimes followed by
+ADDITIVES = {
+    "CARAMEL COLOR", "RED 40", "YELLOW 5", "CITRIC ACID", "ASCORBIC ACID", "SODIUM BENZOATE", "POTASSIUM SORBATE",
+    "CALCIUM PROPIONATE", "XANTHAN GUM", "GUAR GUM", "SOY LECITHIN", "MONO- AND DIGLYCERIDES",
+}
+PURPOSES = [" (PRESERVATIVE)", " TO PRESERVE FRESHNESS", " FOR COLOR", " (EMULSIFIER)"]
+
+VENDOR_WORDS = [
+    "ACME", "SUNRISE", "GOLDEN", "PRAIRIE", "COASTAL", "HERITAGE", "SUMMIT", "VALLEY", "HARVEST", "RIVERSIDE",
+    "MAPLE", "PIONEER", "LIBERTY", "EMPIRE", "NORTHERN", "BLUE RIDGE", "GREAT LAKES", "RED BARN", "OLD MILL",
+]
+VENDOR_SUFFIXES = ["FOODS INC.", "FOOD COMPANY", "FARMS", "BRANDS LLC", "PROVISIONS", "BAKING CO."]
+
+PRODUCTS = [
+    "CHEDDAR CHEESE", "MOZZARELLA CHEESE", "CHICKEN BREAST", "BEEF PATTIES", "PORK SAUSAGE", "WHITE BREAD",
+    "WHOLE WHEAT BREAD", "HAMBURGER BUNS", "FLOUR TORTILLAS", "TOMATO SAUCE", "MARINARA SAUCE", "RANCH DRESSING",
+    "GREEK YOGURT", "CHOCOLATE CHIP COOKIES", "GRANOLA BARS", "POTATO CHIPS", "TORTILLA CHIPS", "APPLE JUICE",
+    "ORANGE JUICE", "PEANUT BUTTER", "STRAWBERRY JAM", "MACARONI AND CHEESE", "CHICKEN NOODLE SOUP",
+    "FROZEN PIZZA", "FISH STICKS", "MIXED VEGETABLES", "GREEN BEANS", "BLACK BEANS", "BROWN RICE", "OATMEAL",
+]
+ADJECTIVES = ["", "", "ORIGINAL", "SHARP", "MILD", "LOW SODIUM", "REDUCED FAT", "ORGANIC", "SPICY", "HOMESTYLE"]
+FORMS = ["", "", "SLICES", "SHREDDED", "FAMILY SIZE", "SINGLE SERVE", "BULK", "12 OZ", "5 LB"]
+
+ABBREVIATIONS = {
+    "CHEESE": "CHS", "CHICKEN": "CHKN", "BREAST": "BRST", "SAUCE": "SCE", "CHOCOLATE": "CHOC", "WHOLE": "WHL",
+    "WHEAT": "WHT", "ORGANIC": "ORG", "REDUCED": "RED", "SODIUM": "SOD", "VEGETABLES": "VEG", "FROZEN": "FRZ",
+}
+
+NOVA_GROUP_WEIGHTS = [0.2, 0.05, 0.25, 0.5]
+
+
+def choose(rng, choices, size=None):
+    return np.array(choices, dtype=object)[rng.integers(len(choices), size=size)]
+
+
+def ingredient_item(rng):
+    if rng.random() < 0.15:
+        name = choose(rng, list(COMPOUND_INGREDIENTS))
+        parts = list(COMPOUND_INGREDIENTS[name])
+        rng.shuffle(parts)
+        opening, closing = ("[", "]") if rng.random() < 0.2 else ("(", ")")
+        return f"{name} {opening}{', '.join(parts[: rng.integers(2, len(parts) + 1)])}{closing}"
+    item = choose(rng, INGREDIENTS)
+    if item in ADDITIVES and rng.random() < 0.5:
+        item += choose(rng, PURPOSES)
+    return item
+
+
+def ingredient_list(rng, ambiguous=False):
+    """
+    Returns one synthetic ingredient list, like those in branded_food.csv.
+    """
+
+    items = [ingredient_item(rng) for _ in range(rng.integers(2, 15))]
+    tail = [ingredient_item(rng) for _ in range(rng.integers(0, 6))]
+    if ambiguous:
+        items.insert(rng.integers(len(items) + 1), choose(rng, AMBIGUOUS_ITEMS))
+
+    text = ", ".join(items)
+    if len(tail) > 0:
+        text += f", CONTAINS {choose(rng, ['2% OR LESS OF:', 'LESS THAN 2% OF', '1% OR LESS OF'])} {', '.join(tail)}"
+    if rng.random() < 0.3:
+        text = "INGREDIENTS: " + text
+    if rng.random() < 0.5:
+        text += "."
+    if rng.random() < 0.2:
+        text = text.title()
+    return text
+
+
+def branded_food(num_rows, num_ingredient_lists, rng):
+    """
+    Returns a DataFrame with the columns of branded_food.csv that the scripts read. Every vendor has a few brands, each with a family of similar products (which are what the LLM has to choose among).
+    """
+
+    num_vendors = max(1, num_rows // 200)
+    vendors = np.array(
+        [
+            f"{' '.join(rng.choice(VENDOR_WORDS, 2, replace=False))} {choose(rng, VENDOR_SUFFIXES)}"
+            for _ in range(num_vendors)
+        ],
+        dtype=object,
+    )
+    # rows are grouped by vendor and brand, as consecutive fdc_ids of one company often are
+    vendor_of_row = np.sort(rng.integers(num_vendors, size=num_rows))
+    brand_of_row = rng.integers(3, size=num_rows)
+    brands = np.array([vendor.split(" ")[0] for vendor in vendors], dtype=object)
+    brand_name = np.where(brand_of_row == 0, brands[vendor_of_row], brands[vendor_of_row] + " SELECT")
+    subbrand_name = np.where(brand_of_row == 2, choose(rng, ["KIDS", "CLASSIC", "PREMIUM"], num_rows), "")
+
+    short_description = np.array(
+        [
+            " ".join(
+                word
+                for word in (choose(rng, ADJECTIVES), product, choose(rng, FORMS))
+                if word != ""
+            )
+            for product in choose(rng, PRODUCTS, num_rows)
+        ],
+        dtype=object,
+    )
+
+    bodies = rng.integers(10**10, 10**11, size=num_rows, dtype=np.int64).astype(np.uint64)
+    upcs = bodies * np.uint64(10) + gtin_index.check_digits(bodies)
+
+    lists = np.array(
+        [ingredient_list(rng, rng.random() < AMBIGUOUS_FRACTION) for _ in range(num_ingredient_lists)], dtype=object
+    )
+    # half of the foods share a few lists (as store brands do), the rest are spread over all of them
+    popular = np.minimum(rng.zipf(1.5, size=num_rows) - 1, num_ingredient_lists - 1)
+    anything = rng.integers(num_ingredient_lists, size=num_rows)
+    ingredients = lists[np.where(rng.random(num_rows) < 0.5, popular, anything)]
+    ingredients = np.where(rng.random(num_rows) < 0.02, None, ingredients)
+
+    return pd.DataFrame(
+        {
+            "fdc_id": np.arange(1000000, 1000000 + num_rows),
+            "gtin_upc": [f"{upc:012d}" for upc in upcs.tolist()],
+            "brand_owner": vendors[vendor_of_row],
+            "brand_name": brand_name,
+            "subbrand_name": subbrand_name,
+            "short_description": short_description,
+            "branded_food_category": choose(rng, ["Cheese", "Breads & Buns", "Frozen Dinners", "Snacks"], num_rows),
+            "ingredients": ingredients,
+        }
+    )
+
+
+def abbreviated(text, rng):
+    words = [ABBREVIATIONS.get(word, word) if rng.random() < 0.7 else word for word in text.split(" ")]
+    if len(words) > 1 and rng.random() < 0.3:
+        words = words[1:] + words[:1]
+    return " ".join(words)
+
+
+def purchase_list(branded, num_rows, num_embedded, rng):
+    """
+    Returns a DataFrame with the columns of the CGFP purchase list that usda_search.py reads, from the first `num_embedded` rows of `branded`.
+    """
+
+    source = branded.iloc[rng.integers(num_embedded, size=num_rows)].reset_index(drop=True)
+    kind = rng.choice(3, size=num_rows, p=[0.4, 0.4, 0.2])
+
+    vendor, brand, product, upc = [], [], [], []
+    for i, row in source.iterrows():
+        row_brand = row["brand_name"] if row["subbrand_name"] == "" else f"{row['brand_name']}, {row['subbrand_name']}"
+        if kind[i] == 0:
+            vendor.append(row["brand_owner"])
+            brand.append(row_brand)
+            product.append(row["short_description"])
+            upc.append(row["gtin_upc"])
+        elif kind[i] == 1:
+            vendor.append(" ".join(row["brand_owner"].split(" ")[:2]))
+            brand.append(abbreviated(row_brand, rng))
+            product.append(abbreviated(row["short_description"], rng))
+            # spreadsheet exports turn UPCs into floats
+            upc.append(f"{float(row['gtin_upc']):.0f}.0" if rng.random() < 0.5 else "")
+        else:
+            vendor.append("DISTRIBUTOR")
+            brand.append("")
+            product.append(f"{choose(rng, INGREDIENTS)} {choose(rng, FORMS)}".strip())
+            upc.append("")
+
+    return pd.DataFrame(
+        {
+            "Product GTIN or UPC": upc,
+            "Vendor": vendor,
+            "Brand Name": brand,
+            "Product Type": product,
+            "Level of Processing": choose(rng, ["Whole/Minimally Processed", "Processed", "Ultra-Processed"], num_rows),
+        }
+    )
+
+
+def nova_examples(num_rows, rng):
+    """
+    Returns lines of test.jsonl in the fine-tuning format (see openai-fine-tuning-prepare.py).
+    """
+
+    groups = rng.choice(4, size=num_rows, p=NOVA_GROUP_WEIGHTS) + 1
+    return [
+        json.dumps(
+            {
+                "messages": [
+                    {"role": "user", "content": ingredient_list(rng).lower()},
+                    {"role": "assistant", "content": json.dumps({"nova_group": int(group)}, separators=(",", ":"))},
+                ]
+            }
+        )
+        + "\n"
+        for group in groups
+    ]
+
+
+def write_vector_database(branded, vector_path, num_embedded, rng, chunksize=100000):
+    """
+    Writes the .npy, .sqlite, and Arrow files of usda_vector_database.py and usda_metadata.py for `branded`, embedding only the first `num_embedded` rows.
+    """
+
+    from sentence_transformers import SentenceTransformer
+
+    import usda_metadata
+
+    model = SentenceTransformer(usda_vector_database.MODEL_NAME)
+    dimension = model.get_sentence_embedding_dimension()
+    vectors = np.lib.format.open_memmap(vector_path, mode="w+", dtype=np.float32, shape=(len(branded), dimension))
+
+    sqlite_path = os.path.splitext(vector_path)[0] + ".sqlite"
+    if os.path.exists(sqlite_path):
+        os.remove(sqlite_path)
+    connection = sqlite3.connect(sqlite_path)
+    usda_vector_database.create_tables(connection)
+
+    for start in range(0, len(branded), chunksize):
+        chunk = branded.iloc[start : start + chunksize]
+        gtin_upc, vendor, brand, product, ingredients, text = usda_vector_database.table_rows(chunk)
+        stop = start + len(chunk)
+        embedded = max(0, min(stop, num_embedded) - start)
+        if embedded > 0:
+            vectors[start : start + embedded] = model.encode(text.iloc[:embedded].tolist(), batch_size=1024)
+        if embedded < len(chunk):
+            noise = rng.standard_normal((len(chunk) - embedded, dimension), dtype=np.float32)
+            vectors[start + embedded : stop] = noise / np.linalg.norm(noise, axis=1, keepdims=True)
+        with connection:
+            connection.executemany(
+                "INSERT INTO branded_food (npy_index, gtin_upc, vendor, brand, product, ingredients) VALUES (?, ?, ?, ?, ?, ?)",
+                zip(range(start, stop), gtin_upc, vendor, brand, product, ingredients),
+            )
+        print(f"{stop} of {len(branded)} vectors written", flush=True)
+
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO metadata (key, value) VALUES ('model', ?)", (usda_vector_database.MODEL_NAME,)
+        )
+    connection.close()
+    vectors.flush()
+    del vectors
+    usda_metadata.export(vector_path)
+
+
+def generate(directory, sizes, seed=12345):
+    """
+    Writes the synthetic data for `sizes` (one of the SCALES) into `directory`, unless it is already there.
+    """
+
+    done_path = os.path.join(directory, "sizes.json")
+    if os.path.exists(done_path):
+        with open(done_path) as file:
+            if json.load(file) == {**sizes, "seed": seed, "version": DATA_VERSION}:
+                return
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+
+    start_time = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    data_directory = os.path.join(directory, "home", DATA_SUBDIRECTORY)
+    os.makedirs(data_directory)
+
+    branded = branded_food(sizes["branded_rows"], sizes["ingredient_lists"], rng)
+    branded.to_csv(os.path.join(data_directory, "branded_food.csv"), index=False)
+    num_embedded = min(sizes["embedded_rows"], sizes["branded_rows"])
+    write_vector_database(branded, os.path.join(data_directory, VECTOR_DATABASE_FILENAME), num_embedded, rng)
+    purchase_list(branded, sizes["purchase_rows"], num_embedded, rng).to_csv(
+        os.path.join(data_directory, CGFP_FILENAME), index=False
+    )
+    with open(os.path.join(directory, "test.jsonl"), "w") as file:
+        file.writelines(nova_examples(sizes["nova_rows"], rng))
+
+    with open(done_path, "w") as file:
+        json.dump({**sizes, "seed": seed, "version": DATA_VERSION}, file)
+    print(f"generated {directory} in {time.perf_counter() - start_time:.0f} s", flush=True)
+
+
+def benchmarks(sizes, test_file):
+    """
+    Returns `{name: (script, arguments, counter)}`, where `counter` is the instrumentation.py counter of rows done.
+    """
+
+    stop = str(sizes["purchase_rows"])
+    return {
+        "usda_matches": ("usda_search.py", ["0", stop], "rows"),
+        "usda_matches_async": ("usda_search.py", ["0", stop, "--async"], "rows"),
+        "ingredient_parsing": ("parse-ingredient-lists.py", ["--store", "ingredient-store"], "jobs"),
+        "ingredient_parsing_llm": (
+            "parse-ingredient-lists.py",
+            ["--store", "ingredient-store", "--no-local-parser"],
+            "jobs",
+        ),
+        "nova_scoring": ("openai-fine-tuning-test.py", ["--test-file", test_file], "scored"),
+    }
+
+
+def run(name, script, arguments, counter, directory, base_url, metrics_interval=1.0):
+    """
+    Runs one benchmark in a new working directory under `directory` and returns its result.
+    """
+
+    working_directory = os.path.join(directory, "runs", name)
+    if os.path.exists(working_directory):
+        shutil.rmtree(working_directory)
+    # usda_search.py writes failures/, and openai-fine-tuning-test.py writes test-results/MODEL_DIR/
+    os.makedirs(os.path.join(working_directory, "failures"))
+    os.makedirs(os.path.join(working_directory, "test-results", "gpt-4.1-nano"))
+    metrics_path = os.path.join(working_directory, "metrics.jsonl")
+
+    environment = dict(os.environ)
+    environment.update(
+        {
+            "HOME": os.path.join(directory, "home"),
+            # the model cache stays where it was
+            "HF_HOME": os.environ.get("HF_HOME", os.path.expanduser("~/.cache/huggingface")),
+            "OPENAI_API_KEY": "mock",
+            "OPENAI_BASE_URL": base_url,
+            "OPENAI_RESPONSE_CACHE": "",
+            "PIPELINE_METRICS": metrics_path,
+            "PIPELINE_METRICS_INTERVAL": str(metrics_interval),
+        }
+    )
+
+    start_time = time.perf_counter()
+    with open(os.path.join(working_directory, "output.txt"), "w") as output:
+        completed = subprocess.run(
+            [sys.executable, os.path.join(SCRIPTS_DIRECTORY, script), *arguments],
+            cwd=working_directory,
+            env=environment,
+            stdout=output,
+            stderr=subprocess.STDOUT,
+        )
+    seconds = time.perf_counter() - start_time
+
+    snapshots = []
+    if os.path.exists(metrics_path):
+        with open(metrics_path) as file:
+            snapshots = [json.loads(line) for line in file if line.strip() != ""]
+    final = snapshots[-1] if len(snapshots) > 0 else {"elapsed": None, "stages": {}, "counters": {}}
+    rows = final["counters"].get(counter, 0)
+
+    steady = None
+    started = [snapshot for snapshot in snapshots if snapshot["counters"].get(counter, 0) > 0]
+    if len(started) > 1 and started[-1]["elapsed"] > started[0]["elapsed"]:
+        steady = (rows - started[0]["counters"][counter]) / (started[-1]["elapsed"] - started[0]["elapsed"])
+
+    return {
+        "returncode": completed.returncode,
+        "rows": rows,
+        "seconds": seconds,
+        "rows_per_second": rows / seconds,
+        "steady_rows_per_second": steady,
+        "stages": {stage: totals["seconds"] for stage, totals in final["stages"].items()},
+        "counters": final["counters"],
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPTS_DIRECTORY, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(entry, history, tolerance):
+    """
+    Returns `{name: change in rows_per_second}` against the latest run in `history` with the same settings, and the names of the benchmarks that regressed by more than `tolerance`.
+    """
+
+    previous = [old for old in history if old["settings"] == entry["settings"]]
+    if len(previous) == 0:
+        return {}, []
+
+    changes, regressions = {}, []
+    for name, result in entry["results"].items():
+        old = previous[-1]["results"].get(name)
+        if old is None or old["rows_per_second"] == 0 or result["returncode"] != 0:
+            continue
+        changes[name] = result["rows_per_second"] / old["rows_per_second"] - 1
+        if changes[name] < -tolerance:
+            regressions.append(name)
+    return changes, regressions
+
+
+def record(entry, history_path, tolerance):
+    """
+    Appends `entry` to the JSON history file and returns what `compare` says about it.
+    """
+
+    history = []
+    if os.path.exists(history_path):
+        with open(history_path) as file:
+            history = json.load(file)
+
+    changes, regressions = compare(entry, history, tolerance)
+
+    os.makedirs(os.path.dirname(os.path.abspath(history_path)), exist_ok=True)
+    with open(history_path + ".tmp", "w") as file:
+        json.dump(history + [entry], file, indent=1)
+    os.replace(history_path + ".tmp", history_path)
+    return changes, regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import mock_openai_server
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipelines on synthetic data against a mock LLM server.")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    for size in SCALES["small"]:
+        parser.add_argument(f"--{size.replace('_', '-')}", type=int, default=None, help="overrides --scale")
+    parser.add_argument("--seed", type=int, default=12345)
+    parser.add_argument(
+        "--only",
+        default=None,
+        help="comma-separated benchmarks to run (default: all of them)",
+    )
+    parser.add_argument(
+        "--directory",
+        default=os.path.join(food_data.CACHE_DIRECTORY, "benchmark"),
+        help="where the synthetic data and each benchmark's output are kept",
+    )
+    parser.add_argument("--history", default=HISTORY_PATH, help="the JSON file that runs are appended to")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="a slowdown larger than this is a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--latency", type=float, default=0.05, help="mock server: mean seconds per response")
+    parser.add_argument(
+        "--latency-per-token", type=float, default=0.0, help="mock server: additional seconds per completion token"
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0, help="mock server: fraction of responses that are 500")
+    parser.add_argument(
+        "--rate-limit-rate", type=float, default=0.0, help="mock server: fraction of responses that are 429"
+    )
+    parser.add_argument("--metrics-interval", type=float, default=1.0, help="seconds between metrics lines")
+    args = parser.parse_args()
+
+    sizes = dict(SCALES[args.scale])
+    sizes.update({size: getattr(args, size) for size in sizes if getattr(args, size) is not None})
+    directory = os.path.abspath(
+        os.path.join(args.directory, "-".join([args.scale, str(args.seed)] + [str(x) for x in sizes.values()]))
+    )
+
+    all_benchmarks = benchmarks(sizes, os.path.join(directory, "test.jsonl"))
+    names = list(all_benchmarks) if args.only is None else args.only.split(",")
+    unknown = [name for name in names if name not in all_benchmarks]
+    if len(unknown) > 0:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)} (choose from {', '.join(all_benchmarks)})")
+
+    generate(directory, sizes, args.seed)
+
+    server_settings = {
+        "latency": args.latency,
+        "latency_per_token": args.latency_per_token,
+        "error_rate": args.error_rate,
+        "rate_limit_rate": args.rate_limit_rate,
+    }
+    server, base_url = mock_openai_server.serve(
+        port=0,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=args.seed,
+        latency_per_token=args.latency_per_token,
+    )
+
+    results = {}
+    try:
+        for name in names:
+            script, arguments, counter = all_benchmarks[name]
+            print(f"{name}: {script} {' '.join(arguments)}", flush=True)
+            results[name] = run(name, script, arguments, counter, directory, base_url, args.metrics_interval)
+            if results[name]["returncode"] != 0:
+                print(f"    FAILED with exit status {results[name]['returncode']}; see runs/{name}/output.txt")
+    finally:
+        server.shutdown()
+
+    entry = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "settings": {"scale": args.scale, "seed": args.seed, "sizes": sizes, "server": server_settings},
+        "results": results,
+    }
+    changes, regressions = record(entry, args.history, args.tolerance)
+
+    print(f"{'benchmark':>24} {'rows':>8} {'seconds':>9} {'rows/s':>9} {'steady/s':>9} {'change':>8}")
+    for name, result in results.items():
+        steady = result["steady_rows_per_second"]
+        change = changes.get(name)
+        print(
+            f"{name:>24} {result['rows']:8d} {result['seconds']:9.2f} {result['rows_per_second']:9.2f} "
+            f"{'' if steady is None else f'{steady:9.2f}':>9} {'' if change is None else f'{100 * change:+7.1f}%':>8}"
+            f"{'  REGRESSION' if name in regressions else ''}"
+        )
+    print(f"appended to {args.history}")
+
+    if args.fail_on_regression and len(regressions) > 0:
+        sys.exit(1)
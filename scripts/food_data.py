@@ -0,0 +1,207 @@
+"""
+Loaders for the large product tables: Open Food Facts
+(en.openfoodfacts.org.products.csv.gz) and USDA branded foods
+(branded_food.csv).
+
+Each source is read in chunks, with only the columns it needs. Every row gets a
+`gtin` column: the barcode as a zero-padded 14-digit string, so UPC-A (12
+digits), EAN-13, and GTIN-14 codes compare equal after padding. Codes that
+can't be made into one (empty, "#REF!", "NIELSENUK0002", more than 14
+significant digits, ...) are left out of the main table. They go to a
+quarantine table, with the reason, instead of being silently dropped.
+
+The first load writes both tables to an uncompressed Arrow (Feather) cache, and
+later loads memory-map that file instead of parsing the CSV. The cache is
+rebuilt when the source file changes.
+
+    import food_data
+    off = food_data.load_off()
+    usda = food_data.load_usda_branded(columns=["fdc_id", "gtin_upc", "ingredients"])
+    quarantined = food_data.load_usda_branded(quarantine=True)
+
+Usage:
+
+    python food_data.py build {off,usda} [--refresh]
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+DATA_DIRECTORY = os.path.expanduser("~/Box/dsi-core/11th-hour/good-food-purchasing")
+CACHE_DIRECTORY = os.path.expanduser("~/.cache/good-food-purchasing")
+
+CHUNKSIZE = 200000
+
+SOURCES = {
+    "off": {
+        "filename": os.path.join(DATA_DIRECTORY, "en.openfoodfacts.org.products.csv.gz"),
+        "read_csv": {"sep": "\t"},
+        "gtin_column": "code",
+        "columns": ["code", "product_name", "brands", "categories", "ingredients_text", "nova_group"],
+        "dtypes": {},
+    },
+    "usda": {
+        "filename": os.path.join(DATA_DIRECTORY, "branded_food.csv"),
+        "read_csv": {},
+        "gtin_column": "gtin_upc",
+        "columns": [
+            "fdc_id",
+            "gtin_upc",
+            "brand_owner",
+            "brand_name",
+            "subbrand_name",
+            "short_description",
+            "branded_food_category",
+            "ingredients",
+        ],
+        "dtypes": {"fdc_id": "int64"},
+    },
+}
+
+# characters that appear in otherwise-numeric codes and carry no information
+GTIN_JUNK = r"[\s\-`X>]"
+
+
+def normalize_gtin(codes):
+    """
+    Returns `(gtin, reason)` for a Series of barcode strings: `gtin` is the zero-padded 14-digit code (missing if there isn't one) and `reason` says why there isn't one (missing if there is).
+    """
+
+    codes = codes.astype("string")
+    cleaned = codes.str.replace(GTIN_JUNK, "", regex=True)
+
+    # spreadsheet exports turn codes into floats: "12345678905.0" or "1.2345678905E+10"
+    as_float = cleaned.str.fullmatch(r"\d+\.0*|\d(\.\d+)?[eE]\+?\d+", na=False)
+    if as_float.any():
+        # exact for up to 15 significant digits, more than a GTIN has
+        numbers = pd.to_numeric(cleaned[as_float], errors="coerce")
+        cleaned = cleaned.copy()
+        cleaned[as_float] = numbers.map(lambda x: f"{x:.0f}", na_action="ignore").astype("string")
+
+    digits = cleaned.str.lstrip("0")
+    is_numeric = cleaned.str.fullmatch(r"\d+", na=False)
+    is_valid = is_numeric & (digits.str.len() <= 14)
+
+    gtin = pd.Series(pd.NA, index=codes.index, dtype="string")
+    gtin[is_valid] = digits[is_valid].str.zfill(14)
+
+    is_empty = cleaned.fillna("") == ""
+    reason = pd.Series(
+        np.where(is_empty, "empty", np.where(is_numeric, "too many digits", "not numeric")),
+        index=codes.index,
+        dtype="string",
+    )
+    reason[is_valid] = pd.NA
+    return gtin, reason
+
+
+def cache_paths(source):
+    """
+    Returns the names of the main and quarantine cache files for `source`, which change when the source file does.
+    """
+
+    spec = SOURCES[source]
+    stat = os.stat(spec["filename"])
+    key = json.dumps([spec["filename"], stat.st_size, stat.st_mtime_ns, spec["columns"]])
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return (
+        os.path.join(CACHE_DIRECTORY, f"{source}-{digest}.arrow"),
+        os.path.join(CACHE_DIRECTORY, f"{source}-{digest}-quarantine.arrow"),
+    )
+
+
+def build(source, chunksize=CHUNKSIZE):
+    """
+    Streams the CSV of `source` into its cache files and returns their names.
+    """
+
+    import pyarrow as pa
+
+    spec = SOURCES[source]
+    columns = spec["columns"]
+    path, quarantine_path = cache_paths(source)
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+
+    fields = [(column, pa.int64() if spec["dtypes"].get(column) == "int64" else pa.string()) for column in columns]
+    schema = pa.schema(fields + [("gtin", pa.string())])
+    quarantine_schema = pa.schema(fields + [("reason", pa.string())])
+
+    chunks = pd.read_csv(
+        spec["filename"],
+        usecols=columns,
+        dtype={column: spec["dtypes"].get(column, str) for column in columns},
+        chunksize=chunksize,
+        **spec["read_csv"],
+    )
+    # write to temporary names, so an interrupted build never leaves a partial cache
+    with pa.OSFile(path + ".tmp", "wb") as sink, pa.OSFile(quarantine_path + ".tmp", "wb") as quarantine_sink:
+        with pa.ipc.new_file(sink, schema) as writer, pa.ipc.new_file(quarantine_sink, quarantine_schema) as quarantine_writer:
+            for chunk in chunks:
+                gtin, reason = normalize_gtin(chunk[spec["gtin_column"]])
+                good = gtin.notna().to_numpy()
+                writer.write_table(
+                    pa.Table.from_pandas(chunk[good].assign(gtin=gtin[good]), schema=schema, preserve_index=False)
+                )
+                quarantine_writer.write_table(
+                    pa.Table.from_pandas(
+                        chunk[~good].assign(reason=reason[~good]), schema=quarantine_schema, preserve_index=False
+                    )
+                )
+
+    os.replace(path + ".tmp", path)
+    os.replace(quarantine_path + ".tmp", quarantine_path)
+    return path, quarantine_path
+
+
+def load(source, columns=None, quarantine=False, refresh=False, rows=None):
+    """
+    Returns `source` ("off" or "usda") as a DataFrame with `columns` (default: all of the source's columns) and a `gtin` column, or the quarantined rows with a `reason` column instead. The cache is built first if needed or if `refresh`.
+
+    With `rows` (an array of row numbers), only those rows are converted, in that order, and the DataFrame has a fresh index.
+    """
+
+    import pyarrow as pa
+
+    spec = SOURCES[source]
+    columns = list(spec["columns"] if columns is None else columns)
+
+    path, quarantine_path = cache_paths(source)
+    if refresh or not os.path.exists(path) or not os.path.exists(quarantine_path):
+        build(source)
+
+    with pa.memory_map(quarantine_path if quarantine else path) as file:
+        # only the selected columns are read out of the mapped file
+        table = pa.ipc.open_file(file).read_all().select(columns + ["reason" if quarantine else "gtin"])
+        if rows is not None:
+            table = table.take(rows)
+        return table.to_pandas()
+
+
+def load_off(columns=None, quarantine=False, refresh=False, rows=None):
+    return load("off", columns, quarantine, refresh, rows)
+
+
+def load_usda_branded(columns=None, quarantine=False, refresh=False, rows=None):
+    return load("usda", columns, quarantine, refresh, rows)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Build the cached, GTIN-normalized product tables.")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("source", choices=sorted(SOURCES))
+    parser.add_argument("--refresh", action="store_true", help="rebuild even if the cache is up to date")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    table = load(args.source, refresh=args.refresh)
+    quarantined = load(args.source, quarantine=True)
+    print(f"{len(table)} rows with a GTIN, loaded in {time.perf_counter() - start:.1f} s into {cache_paths(args.source)[0]}")
+    print(f"{len(quarantined)} quarantined rows:")
+    print(quarantined["reason"].value_counts().to_string())
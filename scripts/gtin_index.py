@@ -0,0 +1,257 @@
+"""
+A persistent GTIN index over the USDA branded-food and Open Food Facts tables
+from food_data.py, for joining CGFP purchase lists against them in one call.
+
+Barcodes are compared as uint64 keys derived from the 14-digit GTIN, so UPC-A
+(12 digits), EAN-13, and GTIN-14 forms of the same code are equal. A code of 11
+or 12 significant digits (a UPC-A or EAN-13 body) or 7 (an EAN-8 body) whose
+last digit is not a valid GS1 check digit is taken to be missing its check
+digit (a common way for UPCs to be recorded), and the check digit is appended.
+Any other code with an invalid check digit, such as a mistyped 13-digit EAN, is
+kept as it is rather than turned into a longer code that was never printed.
+This is applied to both sides of the join, so codes that were equal before are
+still equal.
+
+With `packaging=True`, purchases that don't match exactly are also matched at the
+item level. This ignores the GTIN-14 packaging indicator digit, so a case code
+matches the consumer unit inside it.
+
+For each source, the index is a sorted array of distinct keys, an array of
+offsets into `rows` (the row numbers in the food_data.py table, grouped by key),
+and the same for item-level keys. It is saved next to the food_data.py cache
+and rebuilt with it.
+
+    import gtin_index
+    matches, coverage = gtin_index.join(cgfp, "Product GTIN or UPC")
+
+Usage:
+
+    python gtin_index.py build {usda,off}
+    python gtin_index.py join CGFP.csv [--column "Product GTIN or UPC"] [--packaging] [--output matches.csv]
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import food_data
+
+# weights of the digits before the check digit, from the right
+CHECK_WEIGHTS = np.array([3, 1] * 7, dtype=np.uint64)[:13]
+POWERS_OF_TEN = 10 ** np.arange(13, dtype=np.uint64)
+
+
+def check_digits(bodies):
+    """
+    Returns the GS1 check digit of each uint64 in `bodies`, which are codes without their check digit.
+    """
+
+    digits = (bodies[:, np.newaxis] // POWERS_OF_TEN) % np.uint64(10)
+    total = digits @ CHECK_WEIGHTS
+    return (np.uint64(10) - total % np.uint64(10)) % np.uint64(10)
+
+
+def gtin_keys(gtins):
+    """
+    Returns canonical uint64 keys for a Series of 14-digit GTIN strings (from `food_data.normalize_gtin`), with 0 for missing codes.
+    """
+
+    codes = pd.to_numeric(gtins, errors="coerce").fillna(0).to_numpy(dtype=np.uint64)
+    valid = check_digits(codes // np.uint64(10)) == codes % np.uint64(10)
+    # only the lengths of UPC-A, EAN-13 and EAN-8 bodies can be missing their check digit
+    appendable = ((codes >= np.uint64(10**10)) & (codes < np.uint64(10**12))) | (
+        (codes >= np.uint64(10**6)) & (codes < np.uint64(10**7))
+    )
+    keys = np.where(valid | ~appendable, codes, codes * np.uint64(10) + check_digits(codes))
+    keys[codes == 0] = 0
+    return keys
+
+
+def item_keys(keys):
+    """
+    Returns the keys with the GTIN-14 packaging indicator digit removed and the check digit recomputed.
+    """
+
+    bodies = (keys // np.uint64(10)) % np.uint64(10**12)
+    items = bodies * np.uint64(10) + check_digits(bodies)
+    items[keys == 0] = 0
+    return items
+
+
+def group(keys):
+    """
+    Returns `(unique_keys, offsets, rows)` such that `rows[offsets[i]:offsets[i + 1]]` are the positions of `unique_keys[i]` in `keys`, skipping 0 (missing).
+    """
+
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    present = sorted_keys != 0
+    order, sorted_keys = order[present], sorted_keys[present]
+    if len(sorted_keys) == 0:
+        starts = np.zeros(0, dtype=np.int64)
+    else:
+        starts = np.concatenate([[0], np.nonzero(sorted_keys[1:] != sorted_keys[:-1])[0] + 1])
+    offsets = np.append(starts, len(sorted_keys)).astype(np.int64)
+    return sorted_keys[starts], offsets, order.astype(np.int64)
+
+
+def lookup(unique_keys, offsets, rows, query_keys):
+    """
+    Returns `(query_positions, rows)`: every pair of a position in `query_keys` and a matching row.
+    """
+
+    if len(unique_keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    where = np.minimum(np.searchsorted(unique_keys, query_keys), len(unique_keys) - 1)
+    found = (unique_keys[where] == query_keys) & (query_keys != 0)
+
+    positions = np.nonzero(found)[0]
+    starts = offsets[where[positions]]
+    counts = offsets[where[positions] + 1] - starts
+    # expand each (start, count) into its run of rows, without a Python loop
+    query_positions = np.repeat(positions, counts)
+    run_starts = np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+    return query_positions, rows[run_starts + np.arange(counts.sum())]
+
+
+class GTINIndex:
+    def __init__(self, source, unique_keys, offsets, rows, unique_items, item_offsets, item_rows):
+        self.source = source
+        self.unique_keys, self.offsets, self.rows = unique_keys, offsets, rows
+        self.unique_items, self.item_offsets, self.item_rows = unique_items, item_offsets, item_rows
+
+    @staticmethod
+    def path(source):
+        return food_data.cache_paths(source)[0] + ".gtin.npz"
+
+    @classmethod
+    def build(cls, source):
+        table = food_data.load(source, columns=[])
+        keys = gtin_keys(table["gtin"])
+        index = cls(source, *group(keys), *group(item_keys(keys)))
+        np.savez(
+            cls.path(source),
+            unique_keys=index.unique_keys,
+            offsets=index.offsets,
+            rows=index.rows,
+            unique_items=index.unique_items,
+            item_offsets=index.item_offsets,
+            item_rows=index.item_rows,
+        )
+        return index
+
+    @classmethod
+    def load(cls, source):
+        """
+        Returns the index of `source`, building it (and the food_data.py cache) first if needed.
+        """
+
+        if not os.path.exists(cls.path(source)):
+            return cls.build(source)
+        with np.load(cls.path(source)) as arrays:
+            return cls(
+                source,
+                arrays["unique_keys"],
+                arrays["offsets"],
+                arrays["rows"],
+                arrays["unique_items"],
+                arrays["item_offsets"],
+                arrays["item_rows"],
+            )
+
+    def match(self, query_keys, packaging=False):
+        """
+        Returns `(query_positions, rows, is_item_match)` for canonical `query_keys`; item-level matches are only tried for queries with no exact match.
+        """
+
+        positions, rows = lookup(self.unique_keys, self.offsets, self.rows, query_keys)
+        is_item_match = np.zeros(len(rows), dtype=bool)
+        if packaging:
+            unmatched = np.setdiff1d(np.nonzero(query_keys)[0], positions)
+            item_positions, item_rows = lookup(
+                self.unique_items, self.item_offsets, self.item_rows, item_keys(query_keys[unmatched])
+            )
+            positions = np.concatenate([positions, unmatched[item_positions]])
+            rows = np.concatenate([rows, item_rows])
+            is_item_match = np.concatenate([is_item_match, np.ones(len(item_rows), dtype=bool)])
+        return positions, rows, is_item_match
+
+
+def join(purchases, column="Product GTIN or UPC", sources=("usda", "off"), columns=None, packaging=False):
+    """
+    Joins the `purchases` DataFrame on its GTIN `column` against each of `sources`.
+
+    Returns `(matches, coverage)`. `matches` has a row per match, with the purchase row's index label (`purchase_index`), `source`, `match_type` ("exact", "check digit", or "packaging"), the source's `gtin`, and `columns[source]` (default: all of the source's columns). `coverage` counts the purchases, those with a valid GTIN, and those matched in each source and in any source.
+    """
+
+    gtin, _ = food_data.normalize_gtin(purchases[column])
+    query_keys = gtin_keys(gtin)
+
+    coverage = {"purchases": len(purchases), "valid_gtin": int(np.count_nonzero(query_keys))}
+    matched_anywhere = np.zeros(len(purchases), dtype=bool)
+    pieces = []
+    for source in sources:
+        index = GTINIndex.load(source)
+        positions, rows, is_item_match = index.match(query_keys, packaging)
+
+        source_columns = None if columns is None else columns[source]
+        # only the matched rows are taken out of the memory-mapped table and converted
+        table = food_data.load(source, columns=source_columns, rows=rows)
+        match_type = np.where(
+            is_item_match, "packaging", np.where(table["gtin"].to_numpy() == gtin.to_numpy()[positions], "exact", "check digit")
+        )
+        pieces.append(
+            pd.concat(
+                [
+                    pd.DataFrame(
+                        {
+                            "purchase_index": purchases.index.to_numpy()[positions],
+                            "source": source,
+                            "match_type": match_type,
+                        }
+                    ),
+                    table,
+                ],
+                axis=1,
+            )
+        )
+
+        is_matched = np.zeros(len(purchases), dtype=bool)
+        is_matched[positions] = True
+        matched_anywhere |= is_matched
+        coverage[source] = {
+            "matched": int(is_matched.sum()),
+            "fraction": float(is_matched.sum() / max(len(purchases), 1)),
+            "match_types": pd.Series(match_type).value_counts().to_dict(),
+        }
+
+    coverage["any"] = {
+        "matched": int(matched_anywhere.sum()),
+        "fraction": float(matched_anywhere.sum() / max(len(purchases), 1)),
+    }
+    return pd.concat(pieces, ignore_index=True), coverage
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Build GTIN indexes or join a purchase list against them.")
+    parser.add_argument("command", choices=["build", "join"])
+    parser.add_argument("target", help="for build, the source (usda or off); for join, the purchase-list CSV")
+    parser.add_argument("--column", default="Product GTIN or UPC", help="for join, the GTIN column of the purchase list")
+    parser.add_argument("--packaging", action="store_true", help="for join, also match case GTINs to the items inside")
+    parser.add_argument("--output", default=None, help="for join, a CSV file for the match rows")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = GTINIndex.build(args.target)
+        print(f"{len(index.unique_keys)} distinct GTINs in {len(index.rows)} rows: {GTINIndex.path(args.target)}")
+    else:
+        purchases = pd.read_csv(args.target, dtype=str)
+        matches, coverage = join(purchases, args.column, packaging=args.packaging)
+        if args.output is not None:
+            matches.to_csv(args.output, index=False)
+        print(json.dumps(coverage, indent=4))
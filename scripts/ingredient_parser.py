@@ -0,0 +1,435 @@
+"""
+Deterministic parser for USDA ingredient lists, a fast path before the LLM in
+parse-ingredient-lists.py.
+
+It implements the rules given to ChatGPT in that script's system prompt:
+
+  * items are separated by commas or semicolons, and an item followed by a
+    parenthesized (or bracketed) list has sub-ingredients, which are flattened
+    into the same list after their parent;
+  * words that are not ingredients are dropped: headers like
+    `ALL-NATURAL GLUTEN-FREE INGREDIENTS: `, phrases like
+    `CONTAINS LESS THAN 2% OF ` or ` AND/OR `, explanations like
+    ` ADDED AS A PRESERVATIVE` (or `(PRESERVATIVE)` on its own in brackets),
+    and amounts like "99%";
+  * every ingredient is an exact substring of the input, in order.
+
+The output is the same `{"ingredients": [...], "separators": [...]}` as the
+LLM path, where the separators are the text between consecutive ingredients.
+
+Strings that don't fit this grammar well (unbalanced brackets, "AND"/"OR"
+inside an item, text after a closing bracket, sentence-like periods, allergen
+statements, percentages that might be part of a name like "2% MILK",
+descriptors like `(BLEACHED)` alone in brackets, very long items) are flagged as ambiguous, with a reason, so that
+the caller can send them to the LLM instead.
+
+`align` recovers the separators of an LLM-parsed list in linear time.
+
+Usage (compares against LLM results in an ingredient_store.py store):
+
+    python ingredient_parser.py benchmark [--store DIR] [--limit N] [--show N]
+    python ingredient_parser.py align-benchmark [--store DIR] [--num-longest N] [--timeout SECONDS]
+"""
+
+import re
+import time
+
+# "ALL-NATURAL GLUTEN-FREE INGREDIENTS: " and the like, only at the beginning
+HEADER = re.compile(r"[^,;:()\[\]{}]{0,80}?\bINGREDIENTS?\s*:\s*", re.I)
+
+# only these characters change the structure; everything else is item text
+STRUCTURE = re.compile(r"[()\[\]{},;]")
+
+OPENING = "([{"
+CLOSING = ")]}"
+
+NUMBER = r"\d+(?:\.\d+)?\s*%"
+
+PURPOSES = (
+    r"PRESERVATIVES?|FRESHNESS|COLOU?R(?:ING)?|ANTI-?CAKING(?:\s+AGENTS?)?|EMULSIFIERS?|STABILIZERS?|"
+    r"THICKENERS?|ANTIOXIDANTS?|LEAVENING|ACIDULANTS?|FLAVOU?R|TEXTURE|TARTNESS|MOISTURE|CAKING|QUALITY"
+)
+
+# " ADDED AS A PRESERVATIVE", " TO PRESERVE FRESHNESS", "FOR COLOR", ...
+PURPOSE = (
+    r"(?:ADDED\s+|USED\s+)?"
+    r"(?:AS\s+(?:AN?\s+)?|TO\s+(?:PRESERVE|PROTECT|MAINTAIN|RETAIN|PROMOTE|PREVENT|ENHANCE|IMPROVE|HELP\s+PROTECT|ADD)\s+|FOR\s+)"
+    rf"(?:[A-Z\-]+\s+){{0,2}}?(?:{PURPOSES})\b"
+)
+
+# words at the beginning of an item that are not part of the ingredient ("2% MILK" keeps its "2%")
+PREFIX = re.compile(
+    r"\s+|[*:.\-]+|AND/OR\b|AND\b|OR\b|"
+    rf"CONTAINS?\s+(?:(?:LESS\s+THAN|NOT\s+MORE\s+THAN|UP\s+TO)\s+)?{NUMBER}\s*(?:OR\s+LESS\s+)?(?:OF\b)?(?:\s+EACH\s+OF\b)?(?:\s+THE\s+FOLLOWING\b)?\s*:?|"
+    rf"(?:LESS\s+THAN|NOT\s+MORE\s+THAN)\s+{NUMBER}\s*(?:OF\b)?(?:\s+EACH\s+OF\b)?(?:\s+THE\s+FOLLOWING\b)?\s*:?|"
+    rf"{NUMBER}\s*(?:OR\s+LESS\b\s*(?:OF\b)?|OF\b)|"
+    rf"{PURPOSE}",
+    re.I,
+)
+
+# words at the end of an item that are not part of the ingredient
+SUFFIX = re.compile(rf"(?:\s+|[*.]+|{NUMBER}|\b{PURPOSE})$", re.I)
+
+# "(PRESERVATIVE)", "[COLOR]", "(AN EMULSIFIER)": the whole of a bracketed list, dropped
+BRACKETED_PURPOSE = re.compile(rf"(?:AN?\s+)?(?:{PURPOSES})(?:\s+AGENTS?)?", re.I)
+
+# "(BLEACHED)", "(ORGANIC)": the whole of a bracketed list, which may or may not be dropped
+BRACKETED_DESCRIPTOR = re.compile(
+    r"(?:UN)?BLEACHED|(?:UN)?BROMATED|ENRICHED|ORGANIC|DRIED|DEHYDRATED|FRESH|FROZEN|RAW|COOKED|"
+    r"PASTEURIZED|HOMOGENIZED|HYDROGENATED|PARTIALLY\s+HYDROGENATED|NON-?GMO|KOSHER|VEGAN|GLUTEN[\s-]FREE|"
+    r"NATURAL|ARTIFICIAL|ADDED|PROCESSED|POWDER(?:ED)?|CONCENTRATE|FROM\s+CONCENTRATE",
+    re.I,
+)
+
+# what remains in an item that a simple grammar can't be trusted with
+AMBIGUOUS_ITEM = re.compile(r"\b(?:AND|OR|CONTAINS?|INGREDIENTS?)\b|&|:|\.(?!\d)|%", re.I)
+
+MAX_WORDS_PER_ITEM = 10
+
+# lists with a known right answer, checked by `benchmark` before it compares with the LLM: the ingredients, or None if the list must go to the LLM
+EXAMPLES = [
+    ("WATER, SODIUM BENZOATE (PRESERVATIVE), SALT", ["WATER", "SODIUM BENZOATE", "SALT"]),
+    ("ANNATTO [COLOR], SALT", ["ANNATTO", "SALT"]),
+    ("XANTHAN GUM (AN EMULSIFIER), SILICON DIOXIDE (ANTI-CAKING AGENT)", ["XANTHAN GUM", "SILICON DIOXIDE"]),
+    ("CITRIC ACID (TO PRESERVE FRESHNESS), SALT ADDED AS A PRESERVATIVE", ["CITRIC ACID", "SALT"]),
+    ("WATER, CONTAINS 2% OR LESS OF: SALT, SUGAR", ["WATER", "SALT", "SUGAR"]),
+    ("SPICES (PAPRIKA, TURMERIC), WATER (99%)", ["SPICES", "PAPRIKA", "TURMERIC", "WATER"]),
+    ("WHEAT FLOUR (BLEACHED), SALT", None),
+    ("SOY LECITHIN (EMULSIFIER), LECITHIN (ORGANIC)", None),
+    ("2% MILK, SALT", None),
+    ("SALT AND PEPPER", None),
+    ("SUGAR, (CORN SYRUP", None),
+]
+
+
+def _trim(text, start, end):
+    while start < end:
+        m = PREFIX.match(text, start, end)
+        if m is None or m.end() == start:
+            break
+        start = m.end()
+    while start < end:
+        m = SUFFIX.search(text, start, end)
+        if m is None or m.start() == end:
+            break
+        end = m.start()
+    return start, end
+
+
+def parse(text):
+    """
+    Returns `(content, reason)` where `content` is `{"ingredients": [...], "separators": [...]}` and `reason` is None if the parse can be trusted, or a short description of why it is ambiguous.
+    """
+
+    spans = []
+    reason = None
+
+    def add(start, end):
+        nonlocal reason
+        start, end = _trim(text, start, end)
+        if start == end:
+            return
+        if reason is None:
+            m = AMBIGUOUS_ITEM.search(text, start, end)
+            if m is not None:
+                reason = f"{m.group()!r} in item {text[start:end]!r}"
+            elif text.count(" ", start, end) >= MAX_WORDS_PER_ITEM:
+                reason = f"long item {text[start:end]!r}"
+        spans.append((start, end))
+
+    header = HEADER.match(text)
+    item_start = header.end() if header is not None else 0
+    # after a closing bracket, the item's own text is over until the next delimiter
+    item_open = True
+    depth = 0
+    # where each open bracket's contents start
+    openings = []
+
+    for m in STRUCTURE.finditer(text, item_start):
+        character = m.group()
+        if character in OPENING:
+            if item_open:
+                add(item_start, m.start())
+            depth += 1
+            openings.append(m.end())
+            item_start, item_open = m.end(), True
+
+        elif character in CLOSING:
+            if depth == 0:
+                reason = reason or "unbalanced brackets"
+                break
+            opening = openings.pop()
+            if item_open and item_start == opening:
+                # the brackets hold a single item, which may be a comment on the ingredient before them
+                start, end = _trim(text, item_start, m.start())
+                if BRACKETED_PURPOSE.fullmatch(text, start, end):
+                    item_open = False
+                elif BRACKETED_DESCRIPTOR.fullmatch(text, start, end):
+                    reason = reason or f"descriptor in brackets {text[start:end]!r}"
+            if item_open:
+                add(item_start, m.start())
+            depth -= 1
+            item_start, item_open = m.end(), False
+
+        else:
+            if item_open:
+                add(item_start, m.start())
+            elif _trim(text, item_start, m.start())[0] != m.start():
+                reason = reason or f"text after closing bracket {text[item_start : m.start()]!r}"
+            item_start, item_open = m.end(), True
+
+    else:
+        if depth != 0:
+            reason = reason or "unbalanced brackets"
+        if item_open:
+            add(item_start, len(text))
+        elif _trim(text, item_start, len(text))[0] != len(text):
+            reason = reason or f"text after closing bracket {text[item_start:]!r}"
+
+    if len(spans) == 0:
+        reason = reason or "no ingredients"
+
+    return {
+        "ingredients": [text[start:end] for start, end in spans],
+        "separators": [text[spans[i][1] : spans[i + 1][0]] for i in range(len(spans) - 1)],
+    }, reason
+
+
+def parse_column(ingredients, processes=None, chunksize=10000):
+    """
+    Parses a pandas Series of ingredient lists, each distinct string only once (in `processes` worker processes, if given).
+
+    Returns a DataFrame with the same index and columns `ingredients`, `separators`, and `ambiguous` (the reason, or missing if the parse can be trusted).
+    """
+
+    import pandas as pd
+
+    unique = pd.unique(ingredients)
+    if processes is None:
+        parsed = [parse(text) for text in unique]
+    else:
+        import multiprocessing
+
+        with multiprocessing.Pool(processes) as pool:
+            parsed = pool.map(parse, unique, chunksize=chunksize)
+
+    table = pd.DataFrame(
+        {
+            "ingredients": [content["ingredients"] for content, _ in parsed],
+            "separators": [content["separators"] for content, _ in parsed],
+            "ambiguous": [reason for _, reason in parsed],
+        },
+        index=unique,
+    )
+    return table.loc[ingredients.to_numpy()].set_axis(ingredients.index)
+
+
+class AlignmentError(ValueError):
+    """
+    Raised by `align` when an ingredient is not a substring of the text after the previous ingredient.
+    """
+
+    def __init__(self, message, ingredient_index, ingredient, position):
+        super().__init__(message)
+        self.ingredient_index = ingredient_index
+        self.ingredient = ingredient
+        self.position = position
+
+
+def align(ingredients, text):
+    """
+    Finds `ingredients` in `text`, in order and case-insensitively, and returns the separators between them.
+
+    Each ingredient is found by a scan that starts where the previous one ended (the leftmost occurrence), so the total work is linear in the length of the text, unlike a regular expression of `(.*)` groups, which can backtrack exponentially.
+
+    Raises `AlignmentError`, saying which ingredient did not align and where, if the ingredients are not ordered substrings of the text.
+    """
+
+    # str.find on lowercased strings is fastest, but only valid if lowercasing doesn't change lengths
+    lowered = text.lower()
+    same_length = len(lowered) == len(text)
+
+    separators = []
+    previous_end = None
+    position = 0
+    for i, ingredient in enumerate(ingredients):
+        if same_length and len(ingredient.lower()) == len(ingredient):
+            start = lowered.find(ingredient.lower(), position)
+            end = start + len(ingredient)
+        else:
+            m = re.compile(re.escape(ingredient), re.I).search(text, position)
+            start, end = (-1, -1) if m is None else m.span()
+
+        if start == -1:
+            if re.search(re.escape(ingredient), text, re.I) is not None:
+                problem = "appears only before the end of the previous ingredient (out of order or overlapping)"
+            else:
+                problem = "is not in the text"
+            raise AlignmentError(
+                f"ingredient {i} of {len(ingredients)}, {ingredient!r}, {problem}; searched from position {position}: {text[position : position + 40]!r}",
+                i,
+                ingredient,
+                position,
+            )
+
+        if previous_end is not None:
+            separators.append(text[previous_end:start])
+        previous_end = position = end
+
+    return separators
+
+
+def regex_separators(ingredients, text):
+    """
+    The separators as parse-ingredient-lists.py used to find them, for comparison. Can take exponential time.
+    """
+
+    m = re.search("(.*)".join(re.escape(x) for x in ingredients), text, re.I)
+    return None if m is None else list(m.groups())
+
+
+def normalize(ingredients):
+    return [" ".join(x.split()).upper() for x in ingredients]
+
+
+def llm_results(store_directory):
+    """
+    Returns `(text, content)` pairs for every ingredient list in the store that was parsed by the LLM.
+    """
+
+    import ingredient_store
+
+    store = ingredient_store.IngredientStore(store_directory)
+    texts = dict(store.connection.execute("SELECT job_id, ingredients FROM jobs WHERE state = 'done'"))
+    out = [
+        (texts[job_id], content)
+        for job_id, content in store.results()
+        if job_id in texts and content.get("parser", "llm") == "llm"
+    ]
+    store.close()
+    return out
+
+
+def check_examples():
+    """
+    Returns `(text, expected, ingredients, reason)` for each of the EXAMPLES that `parse` gets wrong.
+    """
+
+    wrong = []
+    for text, expected in EXAMPLES:
+        content, reason = parse(text)
+        if expected is None:
+            right = reason is not None
+        else:
+            right = reason is None and content["ingredients"] == expected
+        if not right:
+            wrong.append((text, expected, content["ingredients"], reason))
+    return wrong
+
+
+def benchmark(store_directory, limit=None, show=0):
+    """
+    Checks the EXAMPLES, then parses the ingredient lists of all jobs in the store that have an LLM result and reports the agreement and speed.
+    """
+
+    wrong = check_examples()
+    print(f"{len(EXAMPLES) - len(wrong)} of {len(EXAMPLES)} examples parsed as expected")
+    for text, expected, ingredients, reason in wrong:
+        print(f"    {text!r}\n        expected: {'ambiguous' if expected is None else expected}\n        local:    {ingredients} ({reason})")
+
+    results = llm_results(store_directory)
+    if limit is not None:
+        results = results[:limit]
+
+    start_time = time.perf_counter()
+    local_results = [parse(text) for text, _ in results]
+    seconds = time.perf_counter() - start_time
+
+    num_unambiguous = 0
+    num_same_ingredients = 0
+    num_same_separators = 0
+    disagreements = []
+    for (text, llm_content), (local_content, reason) in zip(results, local_results):
+        if reason is not None:
+            continue
+        num_unambiguous += 1
+        if normalize(local_content["ingredients"]) == normalize(llm_content["ingredients"]):
+            num_same_ingredients += 1
+            if local_content["separators"] == llm_content["separators"]:
+                num_same_separators += 1
+        elif len(disagreements) < show:
+            disagreements.append((text, llm_content["ingredients"], local_content["ingredients"]))
+
+    total = len(results)
+    print(f"{total} ingredient lists with LLM results")
+    print(f"{total / seconds * 60:,.0f} lists per minute ({seconds:.2f} s)")
+    print(f"{num_unambiguous / max(total, 1):.1%} not ambiguous (would skip the LLM)")
+    print(f"{num_same_ingredients / max(num_unambiguous, 1):.1%} of those have the same ingredients as the LLM")
+    print(f"{num_same_separators / max(num_unambiguous, 1):.1%} of those have the same ingredients and separators")
+    for text, llm_ingredients, local_ingredients in disagreements:
+        print(f"\n{text}\n    LLM:   {llm_ingredients}\n    local: {local_ingredients}")
+
+
+def align_benchmark(store_directory, num_longest=100, timeout=10.0):
+    """
+    Compares `align` with the old regular expression on the `num_longest` longest ingredient lists that have LLM results. Each regular expression search runs in a worker process that is killed after `timeout` seconds.
+    """
+
+    import multiprocessing
+
+    results = sorted(llm_results(store_directory), key=lambda x: len(x[0]), reverse=True)[:num_longest]
+
+    align_seconds = []
+    regex_seconds = []
+    num_timeouts = 0
+    num_disagreements = 0
+    pool = multiprocessing.Pool(1)
+    for text, content in results:
+        start_time = time.perf_counter()
+        try:
+            separators = align(content["ingredients"], text)
+        except AlignmentError:
+            separators = None
+        align_seconds.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        try:
+            expected = pool.apply_async(regex_separators, (content["ingredients"], text)).get(timeout)
+        except multiprocessing.TimeoutError:
+            num_timeouts += 1
+            regex_seconds.append(timeout)
+            pool.terminate()
+            pool = multiprocessing.Pool(1)
+            continue
+        regex_seconds.append(time.perf_counter() - start_time)
+
+        if separators != expected:
+            num_disagreements += 1
+
+    pool.terminate()
+
+    print(f"{len(results)} longest ingredient lists, {len(results[-1][0]) if results else 0} to {len(results[0][0]) if results else 0} characters")
+    print(f"align: total {sum(align_seconds) * 1000:.2f} ms, worst {max(align_seconds, default=0) * 1000:.3f} ms")
+    print(f"regex: total {sum(regex_seconds) * 1000:.2f} ms, worst {max(regex_seconds, default=0) * 1000:.3f} ms (includes process overhead)")
+    print(f"regex timeouts (> {timeout} s): {num_timeouts}")
+    print(f"different separators (where the regex finished): {num_disagreements}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import ingredient_store
+
+    parser = argparse.ArgumentParser(description="Compare the local ingredient list parser with LLM results.")
+    parser.add_argument("command", choices=["benchmark", "align-benchmark"])
+    parser.add_argument("--store", default=ingredient_store.DEFAULT_STORE)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--show", type=int, default=0, help="for benchmark, number of disagreements to print")
+    parser.add_argument("--num-longest", type=int, default=100, help="for align-benchmark")
+    parser.add_argument("--timeout", type=float, default=10.0, help="for align-benchmark, seconds per regex search")
+    args = parser.parse_args()
+
+    if args.command == "benchmark":
+        benchmark(args.store, args.limit, args.show)
+    else:
+        align_benchmark(args.store, args.num_longest, args.timeout)
@@ -0,0 +1,307 @@
+"""
+Work-claiming and results store for parse-ingredient-lists.py.
+
+A store is a directory containing
+
+    jobs.sqlite           one row per distinct ingredient list (a "job", found
+                          by a hash of its text), with its state: pending,
+                          in_progress, done, or failed; and a table mapping
+                          every fdc_id to the job that parses it
+    results-{worker}.jsonl    append-only results, one file per worker process
+
+Workers `claim` a few pending jobs at a time, which marks them in_progress with
+a lease. If a worker crashes, its jobs become claimable again when the lease
+expires; once another worker has claimed a job, the first can no longer
+complete it. A result is appended (and flushed) to the worker's JSONL shard before
+the job is marked done, so a done job always has a result; a crash between the
+two steps only leaves a duplicate line, which `compact` ignores.
+
+`compact` gathers all of the shards into one Parquet file with a row per fdc_id.
+
+Usage:
+
+    python ingredient_store.py status [--store DIR]
+    python ingredient_store.py compact [--store DIR] [--output FILE]
+    python ingredient_store.py retry-failed [--store DIR]
+    python ingredient_store.py import-json [--store DIR] [--directory ingredient-lists]
+"""
+
+import glob
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+DEFAULT_STORE = "ingredient-store"
+
+STATES = ("pending", "in_progress", "done", "failed")
+
+
+def text_hash(ingredients):
+    return hashlib.sha256(ingredients.encode()).hexdigest()
+
+
+class IngredientStore:
+    def __init__(self, directory=DEFAULT_STORE):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(directory, "jobs.sqlite"), timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    job_id INTEGER PRIMARY KEY,
+                    ingredients TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    text_hash TEXT
+                )"""
+            )
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(jobs)")]
+            if "text_hash" not in columns:
+                # a store from before jobs were found by their text
+                self.connection.execute("ALTER TABLE jobs ADD COLUMN text_hash TEXT")
+                self.connection.executemany(
+                    "UPDATE jobs SET text_hash = ? WHERE job_id = ?",
+                    [
+                        (text_hash(ingredients), job_id)
+                        for job_id, ingredients in self.connection.execute("SELECT job_id, ingredients FROM jobs")
+                    ],
+                )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_text_hash ON jobs (text_hash)")
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS members (
+                    fdc_id INTEGER PRIMARY KEY,
+                    job_id INTEGER NOT NULL
+                )"""
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS members_job_id ON members (job_id)")
+        self._shards = {}
+
+    def add_jobs(self, groups, replace=False):
+        """
+        Adds jobs from an iterable of `(ingredients, fdc_ids)` pairs and points each fdc_id at the job for its ingredients. A job whose text is already in the store keeps its job_id and state, so this can be called on every startup, and again with a new USDA release: only new ingredient lists become new jobs, and fdc_ids whose ingredients changed move to the new job.
+
+        With `replace`, `groups` is the whole release: fdc_ids that aren't in it are removed, and so are the pending and failed jobs that no fdc_id points at anymore. Done jobs are kept, in case their text comes back.
+        """
+
+        # BEGIN IMMEDIATE takes the write lock before reading, so workers starting together don't add the same job twice
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            job_ids = dict(self.connection.execute("SELECT text_hash, MIN(job_id) FROM jobs GROUP BY text_hash"))
+            (next_job_id,) = self.connection.execute("SELECT COALESCE(MAX(job_id), 0) + 1 FROM jobs").fetchone()
+
+            jobs = []
+            members = []
+            for ingredients, fdc_ids in groups:
+                digest = text_hash(ingredients)
+                job_id = job_ids.get(digest)
+                if job_id is None:
+                    job_id = job_ids[digest] = next_job_id
+                    next_job_id += 1
+                    jobs.append((job_id, ingredients, digest))
+                members.extend((int(fdc_id), job_id) for fdc_id in fdc_ids)
+
+            self.connection.executemany("INSERT INTO jobs (job_id, ingredients, text_hash) VALUES (?, ?, ?)", jobs)
+            self.connection.executemany("INSERT OR REPLACE INTO members (fdc_id, job_id) VALUES (?, ?)", members)
+            if replace:
+                current = {fdc_id for fdc_id, _ in members}
+                self.connection.executemany(
+                    "DELETE FROM members WHERE fdc_id = ?",
+                    [
+                        (fdc_id,)
+                        for (fdc_id,) in self.connection.execute("SELECT fdc_id FROM members").fetchall()
+                        if fdc_id not in current
+                    ],
+                )
+                self.connection.execute(
+                    """DELETE FROM jobs WHERE state IN ('pending', 'failed')
+                       AND NOT EXISTS (SELECT 1 FROM members WHERE members.job_id = jobs.job_id)"""
+                )
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def claim(self, worker, num_jobs=16, lease_seconds=600):
+        """
+        Marks up to `num_jobs` pending (or lease-expired) jobs as in_progress by `worker` and returns them as `(job_id, ingredients)` pairs. Returns an empty list when there is no more work.
+        """
+
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock before reading, so no two workers get the same job
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            jobs = self.connection.execute(
+                """SELECT job_id, ingredients FROM jobs
+                   WHERE state = 'pending' OR (state = 'in_progress' AND lease_expires < ?)
+                   ORDER BY job_id
+                   LIMIT ?""",
+                (now, num_jobs),
+            ).fetchall()
+            self.connection.executemany(
+                """UPDATE jobs SET state = 'in_progress', worker = ?, lease_expires = ?, attempts = attempts + 1
+                   WHERE job_id = ?""",
+                [(worker, now + lease_seconds, job_id) for job_id, _ in jobs],
+            )
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return jobs
+
+    def _shard(self, worker):
+        shard = self._shards.get(worker)
+        if shard is None:
+            safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", worker)
+            shard = self._shards[worker] = open(os.path.join(self.directory, f"results-{safe_name}.jsonl"), "a")
+        return shard
+
+    def complete(self, job_id, worker, content):
+        """
+        Records `content` (with "ingredients" and "separators") as the result of `job_id` and marks it done. Returns False, and records nothing, if the job is no longer leased to `worker` (its lease expired and another worker claimed it).
+        """
+
+        leased = self.connection.execute(
+            "SELECT 1 FROM jobs WHERE job_id = ? AND worker = ?", (job_id, worker)
+        ).fetchone()
+        if leased is None:
+            return False
+
+        shard = self._shard(worker)
+        shard.write(json.dumps({"job_id": job_id, **content}) + "\n")
+        shard.flush()
+        os.fsync(shard.fileno())
+        with self.connection:
+            updated = self.connection.execute(
+                "UPDATE jobs SET state = 'done', lease_expires = NULL, error = NULL WHERE job_id = ? AND worker = ?",
+                (job_id, worker),
+            ).rowcount
+        return updated > 0
+
+    def fail(self, job_id, worker, error, max_attempts=3):
+        """
+        Records a failed attempt at `job_id`. It goes back to pending unless it has been attempted `max_attempts` times, in which case it is marked failed.
+        """
+
+        with self.connection:
+            self.connection.execute(
+                """UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                   lease_expires = NULL, error = ?
+                   WHERE job_id = ? AND worker = ?""",
+                (max_attempts, error, job_id, worker),
+            )
+
+    def retry_failed(self):
+        with self.connection:
+            self.connection.execute("UPDATE jobs SET state = 'pending', attempts = 0 WHERE state = 'failed'")
+
+    def status(self):
+        """
+        Returns the number of jobs in each state, and the number of fdc_ids.
+        """
+
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        (counts["fdc_ids"],) = self.connection.execute("SELECT COUNT(*) FROM members").fetchone()
+        return counts
+
+    def results(self):
+        """
+        Returns `(job_id, content)` pairs for every result in the shards, the last one for each job_id if it was done more than once.
+        """
+
+        latest = {}
+        for filename in sorted(glob.glob(os.path.join(self.directory, "results-*.jsonl"))):
+            with open(filename) as file:
+                for line in file:
+                    try:
+                        content = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a partial line from a worker that crashed mid-write
+                        continue
+                    latest[content.pop("job_id")] = content
+        return latest.items()
+
+    def compact(self, output=None):
+        """
+        Writes all results to one Parquet file with columns `fdc_id`, `ingredients`, and `separators` (one row per fdc_id) and returns its name.
+        """
+
+        import pandas as pd
+
+        if output is None:
+            output = os.path.join(self.directory, "ingredient-lists.parquet")
+
+        done = {job_id for (job_id,) in self.connection.execute("SELECT job_id FROM jobs WHERE state = 'done'")}
+        results = pd.DataFrame(
+            [
+                (job_id, content["ingredients"], content["separators"])
+                for job_id, content in self.results()
+                if job_id in done
+            ],
+            columns=["job_id", "ingredients", "separators"],
+        )
+        members = pd.read_sql_query("SELECT fdc_id, job_id FROM members", self.connection)
+
+        compacted = members.merge(results, on="job_id").drop(columns="job_id").sort_values("fdc_id")
+        compacted.to_parquet(output, index=False)
+        return output
+
+    def import_json(self, directory="ingredient-lists", worker="import-json"):
+        """
+        Marks jobs as done from the one-file-per-fdc_id outputs of earlier versions of parse-ingredient-lists.py. Empty (unfinished) files are ignored.
+        """
+
+        job_ids = dict(self.connection.execute("SELECT fdc_id, job_id FROM members"))
+        pending = {
+            job_id for (job_id,) in self.connection.execute("SELECT job_id FROM jobs WHERE state != 'done'")
+        }
+        for filename in glob.glob(os.path.join(directory, "*.json")):
+            fdc_id = int(os.path.splitext(os.path.basename(filename))[0])
+            job_id = job_ids.get(fdc_id)
+            if job_id not in pending or os.path.getsize(filename) == 0:
+                continue
+            with open(filename) as file:
+                content = json.load(file)
+            if "separators" in content:
+                # `complete` only accepts the worker that holds the job
+                with self.connection:
+                    self.connection.execute("UPDATE jobs SET worker = ? WHERE job_id = ?", (worker, job_id))
+                self.complete(job_id, worker, content)
+                pending.discard(job_id)
+
+    def close(self):
+        for shard in self._shards.values():
+            shard.close()
+        self._shards.clear()
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage the parse-ingredient-lists.py store.")
+    parser.add_argument("command", choices=["status", "compact", "retry-failed", "import-json"])
+    parser.add_argument("--store", default=DEFAULT_STORE)
+    parser.add_argument("--output", default=None, help="for compact, the Parquet file name")
+    parser.add_argument("--directory", default="ingredient-lists", help="for import-json, the old output directory")
+    args = parser.parse_args()
+
+    store = IngredientStore(args.store)
+
+    if args.command == "compact":
+        print(f"wrote {store.compact(args.output)}")
+    elif args.command == "retry-failed":
+        store.retry_failed()
+    elif args.command == "import-json":
+        store.import_json(args.directory)
+
+    print(json.dumps(store.status()))
+    store.close()
@@ -0,0 +1,195 @@
+"""
+Stage timers and counters for the matching and parsing pipelines, to see where
+the time goes and to size workers.
+
+    import instrumentation
+
+    with instrumentation.stage("encode"):
+        vectors = model.encode(texts)
+    instrumentation.count("candidates", len(indexes))
+
+Stages are summed across threads and coroutines: each has a count, total, and
+maximum time. A stage that runs in many threads at once can add up to more than
+the wall-clock time, which shows how much of it was overlapped. Counters are
+plain sums. Both are cheap enough (a `perf_counter` and a lock) to leave in
+inner loops over rows, though not over candidates.
+
+The scripts call `from_environment()` at startup, which prints a summary table
+to stderr when the process exits and, depending on these environment
+variables, also
+
+    PIPELINE_METRICS            appends a JSON line with the totals so far (and
+                                the rates since the previous line) to this file
+    PIPELINE_METRICS_INTERVAL   every this many seconds (default 30), at exit,
+                                and on SIGUSR1
+    PIPELINE_PROFILE            profiles the main thread with cProfile and
+                                writes the stats to this file at exit (read it
+                                with `python -m pstats` or snakeviz)
+
+Stages are ordinary function calls, so a sampling profiler attached from outside
+(`py-spy record -o profile.svg --pid PID`, or `py-spy dump` for a hung
+process) sees them too, in every thread. Worker threads are named after their
+role, so they are easy to find in its output.
+"""
+
+import atexit
+import contextlib
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+
+class Metrics:
+    """
+    Thread-safe totals of stage times and counters since `start_time`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+
+    def add(self, name, seconds):
+        with self.lock:
+            totals = self.stages.get(name)
+            if totals is None:
+                self.stages[name] = [1, seconds, seconds]
+            else:
+                totals[0] += 1
+                totals[1] += seconds
+                totals[2] = max(totals[2], seconds)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start_time)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        Returns the totals as a JSON-serializable dict.
+        """
+
+        with self.lock:
+            elapsed = time.perf_counter() - self.start_time
+            return {
+                "time": time.time(),
+                "elapsed": elapsed,
+                "stages": {
+                    name: {"count": count, "seconds": seconds, "max_seconds": longest}
+                    for name, (count, seconds, longest) in self.stages.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+    def summary(self):
+        """
+        Returns a table of the stages (by total time) and counters.
+        """
+
+        snapshot = self.snapshot()
+        elapsed = max(snapshot["elapsed"], 1e-9)
+        lines = [
+            f"{'stage':>24} {'count':>10} {'total s':>10} {'% wall':>7} {'mean ms':>10} {'max ms':>10}",
+        ]
+        for name, totals in sorted(snapshot["stages"].items(), key=lambda item: -item[1]["seconds"]):
+            lines.append(
+                f"{name:>24} {totals['count']:10d} {totals['seconds']:10.2f} {100 * totals['seconds'] / elapsed:7.1f} "
+                f"{1000 * totals['seconds'] / totals['count']:10.2f} {1000 * totals['max_seconds']:10.2f}"
+            )
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"{name:>24} {value:10} {value / elapsed:10.2f}/s")
+        lines.append(f"{'wall clock':>24} {'':10} {elapsed:10.2f}")
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+
+
+def stage(name):
+    return metrics.stage(name)
+
+
+def count(name, value=1):
+    metrics.count(name, value)
+
+
+def add(name, seconds):
+    metrics.add(name, seconds)
+
+
+class MetricsWriter:
+    """
+    Appends a JSON line of `metrics.snapshot()` to `path`, with the counters' rates since the previous line, every `interval` seconds in a daemon thread.
+    """
+
+    def __init__(self, path, interval=30.0):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.previous = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        snapshot = metrics.snapshot()
+        with self.lock:
+            if self.previous is not None:
+                seconds = max(snapshot["elapsed"] - self.previous["elapsed"], 1e-9)
+                snapshot["rates"] = {
+                    name: (value - self.previous["counters"].get(name, 0)) / seconds
+                    for name, value in snapshot["counters"].items()
+                }
+            self.previous = snapshot
+            with open(self.path, "a") as file:
+                file.write(json.dumps(snapshot) + "\n")
+
+    def stop(self):
+        self.stopped.set()
+        self.write()
+
+
+def from_environment():
+    """
+    Sets up what the PIPELINE_* environment variables ask for, and the summary at exit. Call it once, from the main thread.
+    """
+
+    writer = None
+    path = os.environ.get("PIPELINE_METRICS")
+    if path:
+        writer = MetricsWriter(path, float(os.environ.get("PIPELINE_METRICS_INTERVAL", "30")))
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: writer.write())
+
+    profiler = None
+    profile_path = os.environ.get("PIPELINE_PROFILE")
+    if profile_path:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def at_exit():
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        if writer is not None:
+            writer.stop()
+        print(metrics.summary(), file=sys.stderr, flush=True)
+
+    atexit.register(at_exit)
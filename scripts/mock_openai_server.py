@@ -0,0 +1,214 @@
+"""
+A local stand-in for the OpenAI chat-completions endpoint, for testing the
+scripts without an API key or quota.
+
+    python mock_openai_server.py --port 8000 --latency 0.5 --latency-per-token 0.01 --error-rate 0.05
+
+    OPENAI_API_KEY=mock OPENAI_BASE_URL=http://localhost:8000/v1 python usda_search.py 0 1000 --async
+
+It answers requests by the name of their `response_format` schema:
+
+    best_match              (usda_search.py) a random numbered choice, or null
+    list_of_ingredients     (parse-ingredient-lists.py) the ingredient_parser.py parse
+    nova_classification     (openai-fine-tuning-test.py) a random group, with logprobs
+
+for each of the `n` trials. Other requests get an empty JSON object as their content.
+
+A response takes --latency seconds on average (exponentially distributed, like
+time spent in a queue) plus --latency-per-token seconds for each completion
+token, as generation does. With `"logprobs": true`, every token has
+`top_logprobs` alternatives (as many as the request asks for), so responses are
+as large as the API's. benchmark.py starts one of these in-process.
+"""
+
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def token_logprobs(content, top_logprobs=None, num_alternatives=1):
+    """
+    Splits `content` into rough tokens, each with logprob 0 (certain), for responses to requests with `"logprobs": true`. `top_logprobs` maps a token to its list of alternatives; other tokens get `num_alternatives` (the token and very unlikely fillers).
+    """
+
+    out = []
+    for token in re.findall(r"\d+|[A-Za-z_]+|[^\w]+", content):
+        fillers = [{"token": f"<{i}>", "logprob": -20.0 - i} for i in range(1, num_alternatives)]
+        alternatives = (top_logprobs or {}).get(token, [{"token": token, "logprob": 0.0}] + fillers)
+        out.append(
+            {
+                "token": token,
+                "logprob": max(x["logprob"] for x in alternatives if x["token"] == token),
+                "top_logprobs": alternatives,
+            }
+        )
+    return {"content": out}
+
+
+def best_match_content(request_body, rng):
+    message = request_body["messages"][-1]["content"]
+    num_choices = len(re.findall(r"^\s+\d+\. ", message, re.M))
+    if num_choices == 0 or rng.random() < 0.1:
+        return json.dumps({"best": None}), None
+    return json.dumps({"best": rng.randint(1, num_choices)}), None
+
+
+def ingredient_list_content(request_body, rng):
+    import ingredient_parser
+
+    content, _ = ingredient_parser.parse(request_body["messages"][-1]["content"])
+    return json.dumps({"ingredients": content["ingredients"]}), None
+
+
+def nova_classification_content(request_body, rng):
+    weights = [rng.random() ** 4 for _ in range(4)]
+    probabilities = [x / sum(weights) for x in weights]
+    group = max(range(4), key=lambda i: probabilities[i]) + 1
+    content = json.dumps({"nova_group": group}, separators=(",", ":"))
+    alternatives = sorted(
+        [{"token": str(i + 1), "logprob": math.log(max(p, 1e-12))} for i, p in enumerate(probabilities)],
+        key=lambda x: -x["logprob"],
+    )
+    return content, {str(group): alternatives}
+
+
+# response_format schema name -> function returning (content, top_logprobs)
+CONTENT_GENERATORS = {
+    "best_match": best_match_content,
+    "list_of_ingredients": ingredient_list_content,
+    "nova_classification": nova_classification_content,
+}
+
+
+class MockChatCompletions(BaseHTTPRequestHandler):
+    # set by `serve`
+    latency = 0.0
+    latency_per_token = 0.0
+    error_rate = 0.0
+    rate_limit_rate = 0.0
+    rng = random.Random(12345)
+    rng_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request_body = json.loads(self.rfile.read(length))
+
+        if not self.path.endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"no such endpoint: {self.path}"}})
+            return
+
+        with self.rng_lock:
+            latency = self.rng.expovariate(1 / self.latency) if self.latency > 0 else 0.0
+            draw = self.rng.random()
+            seed = self.rng.getrandbits(64)
+        if draw < self.rate_limit_rate:
+            time.sleep(latency)
+            self.send_json(429, {"error": {"message": "rate limited"}}, [("Retry-After", "1")])
+            return
+        if draw < self.rate_limit_rate + self.error_rate:
+            time.sleep(latency)
+            self.send_json(500, {"error": {"message": "mock server error"}})
+            return
+
+        rng = random.Random(seed)
+        schema_name = request_body.get("response_format", {}).get("json_schema", {}).get("name")
+        generate = CONTENT_GENERATORS.get(schema_name, lambda request_body, rng: ("{}", None))
+
+        choices = []
+        for i in range(request_body.get("n", 1)):
+            content, top_logprobs = generate(request_body, rng)
+            choices.append(
+                {
+                    "index": i,
+                    "message": {"role": "assistant", "content": content},
+                    "logprobs": (
+                        token_logprobs(content, top_logprobs, request_body.get("top_logprobs") or 1)
+                        if request_body.get("logprobs")
+                        else None
+                    ),
+                    "finish_reason": "stop",
+                }
+            )
+
+        prompt_tokens = sum(len(message["content"]) for message in request_body["messages"]) // 4
+        completion_tokens = sum(len(choice["message"]["content"]) for choice in choices) // 4
+        time.sleep(latency + completion_tokens * self.latency_per_token)
+        self.send_json(
+            200,
+            {
+                "id": f"chatcmpl-mock-{seed:x}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request_body.get("model"),
+                "choices": choices,
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            },
+        )
+
+
+def serve(
+    host="localhost", port=8000, latency=0.0, error_rate=0.0, rate_limit_rate=0.0, seed=12345, latency_per_token=0.0
+):
+    """
+    Returns a started `ThreadingHTTPServer` (call `shutdown()` to stop it) and its base URL. With `port=0`, any free port is used.
+    """
+
+    handler = type(
+        "Handler",
+        (MockChatCompletions,),
+        {
+            "latency": latency,
+            "latency_per_token": latency_per_token,
+            "error_rate": error_rate,
+            "rate_limit_rate": rate_limit_rate,
+            "rng": random.Random(seed),
+            "rng_lock": threading.Lock(),
+        },
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a mock OpenAI chat-completions server.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean response time in seconds (exponential)")
+    parser.add_argument("--latency-per-token", type=float, default=0.0, help="additional seconds per completion token")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that get a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of requests that get a 429")
+    parser.add_argument("--seed", type=int, default=12345)
+    args = parser.parse_args()
+
+    server, url = serve(
+        args.host, args.port, args.latency, args.error_rate, args.rate_limit_rate, args.seed, args.latency_per_token
+    )
+    print(f"serving {url}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,126 @@
+"""
+A CPU-only baseline for the fine-tuned model: multinomial logistic regression on
+the training.jsonl/validation.jsonl/test.jsonl files that
+openai-fine-tuning-prepare.py writes.
+
+The features are either hashed word and character n-grams of the ingredient
+list (the default, needing only scikit-learn) or MiniLM sentence embeddings (the
+model that usda_search.py uses). Test-set predictions are written to
+test-results/NAME/predictions.csv in the same index,P1,P2,P3,P4,truth format as
+openai-fine-tuning-test.py, so openai-fine-tuning-plots.ipynb can plot them.
+
+With --low-confidence THRESHOLD, the test items whose highest probability is
+below THRESHOLD are also written to test-results/NAME/low-confidence.jsonl, so
+that only those need to be sent to the fine-tuned model:
+
+    python nova-local-classifier.py --low-confidence 0.8
+    python openai-fine-tuning-test.py --test-file test-results/local-ngrams/low-confidence.jsonl
+"""
+
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_union
+
+
+def load(filename):
+    """
+    Returns the ingredient lists and NOVA groups from a file in the fine-tuning format.
+    """
+
+    texts = []
+    truths = []
+    with open(filename) as file:
+        for line in file:
+            user_message, assistant_message = json.loads(line)["messages"]
+            texts.append(user_message["content"])
+            truths.append(json.loads(assistant_message["content"])["nova_group"])
+    return texts, np.array(truths)
+
+
+def ngram_features():
+    # stateless, so the same transform applies to training and to new data without a fitted vocabulary
+    return make_union(
+        HashingVectorizer(analyzer="word", ngram_range=(1, 2), n_features=2**18, alternate_sign=False, norm="l2"),
+        HashingVectorizer(analyzer="char_wb", ngram_range=(3, 5), n_features=2**18, alternate_sign=False, norm="l2"),
+    ).transform
+
+
+def minilm_features():
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+    return lambda texts: model.encode(texts, batch_size=256, normalize_embeddings=True)
+
+
+FEATURES = {"ngrams": ngram_features, "minilm": minilm_features}
+
+
+parser = argparse.ArgumentParser(description="Train a local NOVA classifier and write test-results/NAME/predictions.csv.")
+parser.add_argument("--features", choices=sorted(FEATURES), default="ngrams")
+parser.add_argument("--name", default=None, help="the test-results subdirectory (default: local-FEATURES)")
+parser.add_argument("--C", type=float, default=1.0, help="inverse regularization strength")
+parser.add_argument(
+    "--low-confidence",
+    type=float,
+    default=None,
+    metavar="THRESHOLD",
+    help="also write the test items whose highest probability is below THRESHOLD to low-confidence.jsonl",
+)
+args = parser.parse_args()
+
+name = f"local-{args.features}" if args.name is None else args.name
+os.makedirs(f"test-results/{name}", exist_ok=True)
+
+featurize = FEATURES[args.features]()
+
+training_texts, training_truths = load("training.jsonl")
+validation_texts, validation_truths = load("validation.jsonl")
+test_texts, test_truths = load("test.jsonl")
+
+start = time.perf_counter()
+classifier = LogisticRegression(C=args.C, max_iter=1000)
+classifier.fit(featurize(training_texts), training_truths)
+print(f"trained on {len(training_texts)} examples in {time.perf_counter() - start:.1f} s")
+
+# columns of predict_proba follow classifier.classes_; put them in NOVA group order, with zeros for any missing group
+groups = list(classifier.classes_)
+
+
+def probabilities(texts):
+    predicted = classifier.predict_proba(featurize(texts))
+    out = np.zeros((len(texts), 4))
+    for column, group in enumerate(groups):
+        out[:, group - 1] = predicted[:, column]
+    return out
+
+
+validation_probabilities = probabilities(validation_texts)
+validation_accuracy = np.mean(np.argmax(validation_probabilities, axis=1) + 1 == validation_truths)
+validation_log_loss = -np.mean(
+    np.log(np.maximum(validation_probabilities[np.arange(len(validation_truths)), validation_truths - 1], 1e-15))
+)
+print(f"validation: accuracy {validation_accuracy:.3f}, log-loss {validation_log_loss:.3f}")
+
+start = time.perf_counter()
+test_probabilities = probabilities(test_texts)
+elapsed = time.perf_counter() - start
+print(f"scored {len(test_texts)} test examples in {elapsed:.2f} s ({len(test_texts) / max(elapsed, 1e-9):.0f} per second)")
+
+with open(f"test-results/{name}/predictions.csv", "w") as file:
+    for index, (distribution, truth) in enumerate(zip(test_probabilities, test_truths)):
+        file.write(f"{index},{distribution[0]},{distribution[1]},{distribution[2]},{distribution[3]},{truth}\n")
+
+if args.low_confidence is not None:
+    uncertain = set(np.nonzero(test_probabilities.max(axis=1) < args.low_confidence)[0].tolist())
+    with open("test.jsonl") as source, open(f"test-results/{name}/low-confidence.jsonl", "w") as file:
+        for index, line in enumerate(source):
+            if index in uncertain:
+                # "index" keeps the line's position in test.jsonl, so results from both models can be combined
+                file.write(json.dumps({"index": index, **json.loads(line)}) + "\n")
+    print(f"{len(uncertain)} of {len(test_texts)} test examples have confidence below {args.low_confidence}")
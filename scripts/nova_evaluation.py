@@ -0,0 +1,287 @@
+"""
+Evaluation of NOVA classifier results: the test-results/NAME/*.csv files that
+openai-fine-tuning-test.py and nova-local-classifier.py write, with lines of
+index,P1,P2,P3,P4,truth.
+
+Every statistic is computed in one vectorized pass over all rows, without a
+loop over classes:
+
+    confusion matrix               truth × predicted (the most probable group)
+    accuracy, per-class accuracy   with binomial uncertainties, as in the plots
+    log-loss, Brier score          of the probabilities normalized to sum to 1
+    reliability curves             for the predicted group (with the expected
+                                   calibration error) and for each group
+                                   one-vs-rest
+
+Bootstrap confidence intervals use Poisson weights, so a resample is a matrix
+product, not a copy of the rows. Runs of several models are resampled with the
+same weights on the rows they have in common, which gives intervals on their
+differences, too.
+
+    import nova_evaluation
+    results = nova_evaluation.load_results("test-results/finetune")
+    nova_evaluation.evaluate(results)
+
+Usage:
+
+    python nova_evaluation.py finetune gpt-4.1-nano [--bootstrap 1000] [--output summary.json]
+"""
+
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+RESULTS_DIRECTORY = "test-results"
+
+GROUPS = (1, 2, 3, 4)
+PROBABILITY_COLUMNS = ["P1", "P2", "P3", "P4"]
+
+# probabilities are clipped to this before taking logs
+MIN_PROBABILITY = 1e-15
+
+# rows of Poisson weights drawn at a time while bootstrapping
+BOOTSTRAP_BLOCK = 64
+
+
+def load_results(directory):
+    """
+    Returns the results in all of the directory's CSV files as one DataFrame indexed by `index` and sorted, keeping the first line of any index that appears more than once.
+    """
+
+    filenames = sorted(glob.glob(os.path.join(directory, "*.csv")))
+    if len(filenames) == 0:
+        raise FileNotFoundError(f"no result files in {directory}")
+
+    results = pd.concat(
+        [
+            pd.read_csv(
+                filename,
+                header=None,
+                names=["index"] + PROBABILITY_COLUMNS + ["truth"],
+                dtype={"index": np.int64, **{column: np.float64 for column in PROBABILITY_COLUMNS}, "truth": np.int8},
+            )
+            for filename in filenames
+        ],
+        ignore_index=True,
+    )
+    results = results.drop_duplicates("index", keep="first")
+    return results.set_index("index").sort_index()
+
+
+def normalized(results):
+    """
+    Returns the probabilities as an (N, 4) array whose rows sum to 1 (the logprobs leave some mass on other tokens), and the truth as 0-based group numbers.
+    """
+
+    probabilities = results[PROBABILITY_COLUMNS].to_numpy(dtype=np.float64)
+    totals = probabilities.sum(axis=1, keepdims=True)
+    probabilities = np.where(totals > 0, probabilities / np.where(totals > 0, totals, 1), 1 / len(GROUPS))
+    return probabilities, results["truth"].to_numpy(dtype=np.int64) - 1
+
+
+def binomial(correct, total):
+    fraction = correct / np.maximum(total, 1)
+    return fraction, np.sqrt(fraction * (1 - fraction) / np.maximum(total, 1))
+
+
+def evaluate(results, num_bins=10):
+    """
+    Returns a JSON-serializable dict of the statistics in the module docstring for one DataFrame of results.
+    """
+
+    probabilities, truth = normalized(results)
+    num_rows, num_groups = probabilities.shape
+    # argmax of the raw probabilities, as in the plots; normalizing doesn't change it
+    predicted = np.argmax(probabilities, axis=1)
+    correct = predicted == truth
+
+    confusion = np.bincount(truth * num_groups + predicted, minlength=num_groups**2).reshape(num_groups, num_groups)
+    class_totals = confusion.sum(axis=1)
+    class_accuracy, class_uncertainty = binomial(np.diag(confusion), class_totals)
+    accuracy, accuracy_uncertainty = binomial(np.count_nonzero(correct), num_rows)
+
+    truth_probabilities = probabilities[np.arange(num_rows), truth]
+    log_loss = float(-np.log(np.maximum(truth_probabilities, MIN_PROBABILITY)).mean())
+    one_hot = np.zeros_like(probabilities)
+    one_hot[np.arange(num_rows), truth] = 1
+    brier = float(((probabilities - one_hot) ** 2).sum(axis=1).mean())
+
+    # top-label reliability: confidence of the predicted group vs. how often it is right
+    confidence = probabilities[np.arange(num_rows), predicted]
+    bins = np.minimum((confidence * num_bins).astype(np.int64), num_bins - 1)
+    bin_counts = np.bincount(bins, minlength=num_bins)
+    bin_confidence = np.bincount(bins, weights=confidence, minlength=num_bins) / np.maximum(bin_counts, 1)
+    bin_accuracy = np.bincount(bins, weights=correct, minlength=num_bins) / np.maximum(bin_counts, 1)
+    expected_calibration_error = float((bin_counts / num_rows * np.abs(bin_accuracy - bin_confidence)).sum())
+
+    # one-vs-rest reliability of every group at once: bin (group, probability) pairs
+    group_bins = np.minimum((probabilities * num_bins).astype(np.int64), num_bins - 1)
+    flat = (np.arange(num_groups) * num_bins + group_bins).ravel()
+    pair_counts = np.bincount(flat, minlength=num_groups * num_bins)
+    pair_probability = np.bincount(flat, weights=probabilities.ravel(), minlength=num_groups * num_bins)
+    pair_frequency = np.bincount(flat, weights=one_hot.ravel(), minlength=num_groups * num_bins)
+    pair_probability = (pair_probability / np.maximum(pair_counts, 1)).reshape(num_groups, num_bins)
+    pair_frequency = (pair_frequency / np.maximum(pair_counts, 1)).reshape(num_groups, num_bins)
+    pair_counts = pair_counts.reshape(num_groups, num_bins)
+
+    return {
+        "rows": int(num_rows),
+        "confusion_matrix": confusion.tolist(),
+        "accuracy": float(accuracy),
+        "accuracy_uncertainty": float(accuracy_uncertainty),
+        "class_accuracy": {str(group): float(x) for group, x in zip(GROUPS, class_accuracy)},
+        "class_uncertainty": {str(group): float(x) for group, x in zip(GROUPS, class_uncertainty)},
+        "class_counts": {str(group): int(x) for group, x in zip(GROUPS, class_totals)},
+        "log_loss": log_loss,
+        "brier_score": brier,
+        "expected_calibration_error": expected_calibration_error,
+        "reliability": {
+            "bin_edges": np.linspace(0, 1, num_bins + 1).tolist(),
+            "counts": bin_counts.tolist(),
+            "confidence": bin_confidence.tolist(),
+            "accuracy": bin_accuracy.tolist(),
+        },
+        "class_reliability": {
+            str(group): {
+                "counts": pair_counts[i].tolist(),
+                "probability": pair_probability[i].tolist(),
+                "frequency": pair_frequency[i].tolist(),
+            }
+            for i, group in enumerate(GROUPS)
+        },
+    }
+
+
+def bootstrap(runs, num_samples=1000, seed=12345, confidence_level=0.95):
+    """
+    Returns bootstrap intervals of accuracy, per-class accuracy, and log-loss for each of the `runs` (a dict of name to results DataFrame), on the rows that all of them have, and of each run's difference from the first.
+    """
+
+    names = list(runs)
+    common = runs[names[0]].index
+    for name in names[1:]:
+        common = common.intersection(runs[name].index)
+
+    # per run, the per-row quantities whose weighted means are the statistics
+    columns = {}
+    for name in names:
+        probabilities, truth = normalized(runs[name].loc[common])
+        correct = (np.argmax(probabilities, axis=1) == truth).astype(np.float32)
+        nll = -np.log(np.maximum(probabilities[np.arange(len(truth)), truth], MIN_PROBABILITY)).astype(np.float32)
+        one_hot = (truth[:, np.newaxis] == np.arange(len(GROUPS))).astype(np.float32)
+        # columns: correct, nll, 1, then correct and count for each group
+        columns[name] = np.column_stack([correct, nll, np.ones_like(correct), correct[:, np.newaxis] * one_hot, one_hot])
+
+    rng = np.random.default_rng(seed)
+    sums = {name: [] for name in names}
+    for start in range(0, num_samples, BOOTSTRAP_BLOCK):
+        weights = rng.poisson(1.0, size=(min(BOOTSTRAP_BLOCK, num_samples - start), len(common))).astype(np.float32)
+        for name in names:
+            sums[name].append(weights @ columns[name])
+
+    statistics = {}
+    for name in names:
+        totals = np.concatenate(sums[name])
+        num_groups = len(GROUPS)
+        statistics[name] = {
+            "accuracy": totals[:, 0] / np.maximum(totals[:, 2], 1),
+            "log_loss": totals[:, 1] / np.maximum(totals[:, 2], 1),
+            **{
+                f"class_accuracy_{group}": totals[:, 3 + i] / np.maximum(totals[:, 3 + num_groups + i], 1)
+                for i, group in enumerate(GROUPS)
+            },
+        }
+
+    tail = (1 - confidence_level) / 2 * 100
+
+    def interval(samples):
+        low, high = np.percentile(samples, [tail, 100 - tail])
+        return [float(low), float(high)]
+
+    return {
+        "common_rows": int(len(common)),
+        "samples": num_samples,
+        "confidence_level": confidence_level,
+        "intervals": {name: {key: interval(x) for key, x in statistics[name].items()} for name in names},
+        "differences": {
+            f"{name} - {names[0]}": {
+                key: interval(statistics[name][key] - statistics[names[0]][key]) for key in statistics[name]
+            }
+            for name in names[1:]
+        },
+    }
+
+
+def summary(names, results_directory=RESULTS_DIRECTORY, num_bootstrap=1000, num_bins=10, seed=12345):
+    """
+    Returns the machine-readable comparison of the runs in `results_directory/NAME` for each of `names`.
+    """
+
+    runs = {name: load_results(os.path.join(results_directory, name)) for name in names}
+    out = {"runs": {name: evaluate(results, num_bins) for name, results in runs.items()}}
+    if num_bootstrap > 0:
+        out["bootstrap"] = bootstrap(runs, num_bootstrap, seed)
+    return out
+
+
+def make_plots(results, title):
+    """
+    The histograms of openai-fine-tuning-plots.ipynb: the probability of the true group for each group, labeled with the fraction correct.
+    """
+
+    import matplotlib.pyplot as plt
+
+    stats = evaluate(results)
+    truth = results["truth"].to_numpy()
+    fig, axes = plt.subplots(2, 2, figsize=(9, 7))
+    for ax, group, column in zip(axes.ravel(), GROUPS, PROBABILITY_COLUMNS):
+        correct = stats["class_accuracy"][str(group)]
+        uncertainty = stats["class_uncertainty"][str(group)]
+        ax.hist(
+            results[column].to_numpy()[truth == group],
+            bins=50,
+            range=(0, 1),
+            histtype="step",
+            fill=True,
+            color="lightblue",
+            edgecolor="blue",
+        )
+        ax.set_xlabel(f"P(NOVA group {group} | truth = {group})")
+        ax.legend([f"{int(correct*100):d}% ± {uncertainty*100:3.1f}% correct"])
+    fig.suptitle(title, y=0.92)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Evaluate and compare NOVA classifier runs in test-results/NAME.")
+    parser.add_argument("names", nargs="+", help="run directories under --results-directory; differences are relative to the first")
+    parser.add_argument("--results-directory", default=RESULTS_DIRECTORY)
+    parser.add_argument("--bootstrap", type=int, default=1000, help="bootstrap samples (0 for none)")
+    parser.add_argument("--bins", type=int, default=10, help="reliability-curve bins")
+    parser.add_argument("--seed", type=int, default=12345)
+    parser.add_argument("--output", default=None, help="write the full summary to this JSON file")
+    args = parser.parse_args()
+
+    result = summary(args.names, args.results_directory, args.bootstrap, args.bins, args.seed)
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+
+    print(f"{'run':>24} {'rows':>9} {'accuracy':>17} {'log-loss':>9} {'Brier':>7} {'ECE':>7}")
+    for name, stats in result["runs"].items():
+        print(
+            f"{name:>24} {stats['rows']:9d} {stats['accuracy']:9.4f} ± {stats['accuracy_uncertainty']:.4f} "
+            f"{stats['log_loss']:9.4f} {stats['brier_score']:7.4f} {stats['expected_calibration_error']:7.4f}"
+        )
+    if "bootstrap" in result:
+        level = int(result["bootstrap"]["confidence_level"] * 100)
+        print(f"\n{level}% bootstrap intervals on {result['bootstrap']['common_rows']} common rows:")
+        for name, intervals in {**result["bootstrap"]["intervals"], **result["bootstrap"]["differences"]}.items():
+            print(
+                f"{name:>40}  accuracy [{intervals['accuracy'][0]:.4f}, {intervals['accuracy'][1]:.4f}]"
+                f"  log-loss [{intervals['log_loss'][0]:.4f}, {intervals['log_loss'][1]:.4f}]"
+            )
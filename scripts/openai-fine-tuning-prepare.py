@@ -1,40 +1,42 @@
-import json
-import random
-
-import pandas as pd
-
-dataset = pd.read_csv(
-    "~/Box/dsi-core/11th-hour/good-food-purchasing/Filtered_OFF_with_sentences.csv",
-    sep="\t",
-    usecols=["nova_group", "sentence"],
-)
+"""
+Writes training.jsonl, validation.jsonl, and test.jsonl for fine-tuning a NOVA
+classifier from Filtered_OFF_with_sentences.csv (or another tab-separated file
+with nova_group and sentence columns, such as the full Open Food Facts dump).
 
-random.seed(12345)
+Each NOVA group contributes --test-size rows to the test set and
+--validation-size rows to the validation set, chosen uniformly at random. The
+rest of its rows are training rows. The group with the fewest training rows is
+oversampled --oversample times, and the other groups are sampled (or
+oversampled) to the same number of rows, so that the training set is balanced.
 
-dataset1 = list(dataset[dataset["nova_group"] == 1].itertuples())
-random.shuffle(dataset1)
+The file is streamed twice, in chunks, and nothing proportional to its size is
+kept in memory:
 
-dataset2 = list(dataset[dataset["nova_group"] == 2].itertuples())
-random.shuffle(dataset2)
+  1. Only nova_group is read. Each group's test and validation rows are chosen
+     by reservoir sampling (the rows with the smallest random keys), and its
+     rows are counted.
+  2. Rows are read again. The reserved rows are set aside. Every training row
+     gets its number of copies: the whole part of the group's oversampling
+     factor, plus one for an exact uniform sample of the rows that make up the
+     remainder, drawn chunk by chunk from the hypergeometric distribution.
+     Each copy is written to a randomly chosen temporary bucket file, and the
+     buckets are shuffled one at a time into training.jsonl.
 
-dataset3 = list(dataset[dataset["nova_group"] == 3].itertuples())
-random.shuffle(dataset3)
+The result depends only on the input and --seed.
+"""
 
-dataset4 = list(dataset[dataset["nova_group"] == 4].itertuples())
-random.shuffle(dataset4)
+import os
+import json
+import argparse
+import tempfile
 
-test = dataset1[0:100] + dataset2[0:100] + dataset3[0:100] + dataset4[0:100]
-random.shuffle(test)
+import numpy as np
+import pandas as pd
 
-validation = dataset1[100:200] + dataset2[100:200] + dataset3[100:200] + dataset4[100:200]
-random.shuffle(validation)
+GROUPS = (1, 2, 3, 4)
 
-training2 = dataset2[200:] * 11
-training1 = dataset1[200 : 200 + len(training2)]
-training3 = dataset3[200 : 200 + len(training2)]
-training4 = dataset4[200 : 200 + len(training2)]
-training = training1 + training2 + training3 + training4
-random.shuffle(training)
+# lines per temporary bucket, which is how many are held in memory while shuffling
+BUCKET_ROWS = 200000
 
 # Encodings of desired outputs differ in only one token, the group integer.
 # Thus, we can use the "logprobs" of that one token to quantify probability.
@@ -46,29 +48,158 @@ random.shuffle(training)
 
 message_format = '{{"messages":[{{"role":"user","content":{ingredients}}},{{"role":"assistant","content":"{{\\\"nova_group\\\":{nova_group}}}"}}]}}\n'
 
-with open("training.jsonl", "w") as file:
-    for row in training:
-        file.write(
-            message_format.format(
-                ingredients=json.dumps(row.sentence),
-                nova_group=int(row.nova_group),
-            )
-        )
-
-with open("validation.jsonl", "w") as file:
-    for row in validation:
-        file.write(
-            message_format.format(
-                ingredients=json.dumps(row.sentence),
-                nova_group=int(row.nova_group),
-            )
-        )
-
-with open("test.jsonl", "w") as file:
-    for row in test:
-        file.write(
-            message_format.format(
-                ingredients=json.dumps(row.sentence),
-                nova_group=int(row.nova_group),
-            )
-        )
+
+def message(sentence, nova_group):
+    return message_format.format(ingredients=json.dumps(sentence), nova_group=int(nova_group))
+
+
+def read_chunks(filename, columns, chunksize):
+    """
+    Yields `(positions, nova_groups, chunk)` for each chunk of `filename`, where `positions` are row numbers in the file and `nova_groups` are 0 for rows without a NOVA group.
+    """
+
+    position = 0
+    for chunk in pd.read_csv(filename, sep="\t", usecols=columns, chunksize=chunksize):
+        nova_groups = pd.to_numeric(chunk["nova_group"], errors="coerce").fillna(0).to_numpy()
+        nova_groups = np.where(np.isin(nova_groups, GROUPS), nova_groups, 0).astype(np.int64)
+        yield np.arange(position, position + len(chunk)), nova_groups, chunk
+        position += len(chunk)
+
+
+def reserve(filename, num_reserved, rng, chunksize):
+    """
+    Returns `{group: positions}` with `num_reserved` uniformly chosen row positions per group (fewer if the group is smaller), and `{group: count}`.
+    """
+
+    keys = {group: np.zeros(0) for group in GROUPS}
+    reserved = {group: np.zeros(0, dtype=np.int64) for group in GROUPS}
+    counts = {group: 0 for group in GROUPS}
+
+    for positions, nova_groups, _ in read_chunks(filename, ["nova_group"], chunksize):
+        chunk_keys = rng.random(len(positions))
+        for group in GROUPS:
+            in_group = nova_groups == group
+            counts[group] += int(np.count_nonzero(in_group))
+            # keeping the smallest random keys is a uniform sample without replacement
+            group_keys = np.concatenate([keys[group], chunk_keys[in_group]])
+            group_positions = np.concatenate([reserved[group], positions[in_group]])
+            if len(group_keys) > num_reserved:
+                keep = np.argpartition(group_keys, num_reserved)[:num_reserved]
+                group_keys, group_positions = group_keys[keep], group_positions[keep]
+            keys[group], reserved[group] = group_keys, group_positions
+
+    # in random order, so the test and validation rows are a random split of the reserved rows
+    return {group: reserved[group][np.argsort(keys[group])] for group in GROUPS}, counts
+
+
+def write_shuffled(filename, lines, rng):
+    rng.shuffle(lines)
+    with open(filename, "w") as file:
+        file.writelines(lines)
+
+
+def prepare(filename, seed=12345, test_size=100, validation_size=100, oversample=11, chunksize=100000):
+    """
+    Writes the three JSONL files into the current directory and returns the number of lines per group in each.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    reserved, counts = reserve(filename, test_size + validation_size, rng, chunksize)
+    test_positions = {group: reserved[group][:test_size] for group in GROUPS}
+
+    available = {group: counts[group] - len(reserved[group]) for group in GROUPS}
+    present = [group for group in GROUPS if available[group] > 0]
+    target = oversample * min(available[group] for group in present) if present else 0
+    # every row gets `whole` copies, and `remaining` more rows out of the `left` still to come get one more
+    whole = {group: target // available[group] if available[group] > 0 else 0 for group in GROUPS}
+    remaining = {group: target % available[group] if available[group] > 0 else 0 for group in GROUPS}
+    left = dict(available)
+
+    num_buckets = max(1, -(-target * len(present) // BUCKET_ROWS))
+    test, validation = [], []
+    summary = {
+        "test": {group: 0 for group in GROUPS},
+        "validation": {group: 0 for group in GROUPS},
+        "training": {group: 0 for group in GROUPS},
+    }
+
+    with tempfile.TemporaryDirectory(dir=".") as directory:
+        buckets = [open(os.path.join(directory, f"bucket-{i}.jsonl"), "w") for i in range(num_buckets)]
+
+        for positions, nova_groups, chunk in read_chunks(filename, ["nova_group", "sentence"], chunksize):
+            sentences = chunk["sentence"].to_numpy()
+            copies = np.zeros(len(positions), dtype=np.int64)
+
+            for group in GROUPS:
+                in_group = np.nonzero(nova_groups == group)[0]
+                is_reserved = np.isin(positions[in_group], reserved[group])
+                is_test = np.isin(positions[in_group], test_positions[group])
+                for i, in_test in zip(in_group[is_reserved], is_test[is_reserved]):
+                    line = message(sentences[i], group)
+                    if in_test:
+                        test.append(line)
+                        summary["test"][group] += 1
+                    else:
+                        validation.append(line)
+                        summary["validation"][group] += 1
+
+                training = in_group[~is_reserved]
+                if len(training) == 0:
+                    continue
+                copies[training] = whole[group]
+                # how many of this chunk's rows are in the uniform sample of `remaining` out of `left`
+                num_extra = 0
+                if remaining[group] > 0:
+                    num_extra = rng.hypergeometric(len(training), left[group] - len(training), remaining[group])
+                copies[training[rng.choice(len(training), num_extra, replace=False)]] += 1
+                remaining[group] -= num_extra
+                left[group] -= len(training)
+                summary["training"][group] += int(copies[training].sum())
+
+            rows = np.repeat(np.arange(len(positions)), copies)
+            destinations = rng.integers(num_buckets, size=len(rows))
+            for bucket in range(num_buckets):
+                buckets[bucket].writelines(
+                    message(sentences[i], nova_groups[i]) for i in rows[destinations == bucket]
+                )
+
+        for bucket in buckets:
+            bucket.close()
+
+        with open("training.jsonl", "w") as file:
+            for bucket in range(num_buckets):
+                with open(os.path.join(directory, f"bucket-{bucket}.jsonl")) as source:
+                    lines = source.readlines()
+                rng.shuffle(lines)
+                file.writelines(lines)
+
+    # the reserved rows were collected in file order
+    write_shuffled("validation.jsonl", validation, rng)
+    write_shuffled("test.jsonl", test, rng)
+    return summary
+
+
+parser = argparse.ArgumentParser(description="Write training.jsonl, validation.jsonl, and test.jsonl for fine-tuning.")
+parser.add_argument(
+    "--input",
+    default=os.path.expanduser("~/Box/dsi-core/11th-hour/good-food-purchasing/Filtered_OFF_with_sentences.csv"),
+    help="a tab-separated file with nova_group and sentence columns",
+)
+parser.add_argument("--seed", type=int, default=12345)
+parser.add_argument("--test-size", type=int, default=100, help="test rows per NOVA group")
+parser.add_argument("--validation-size", type=int, default=100, help="validation rows per NOVA group")
+parser.add_argument(
+    "--oversample",
+    type=int,
+    default=11,
+    help="copies of each training row of the smallest group; the other groups are sampled to the same size",
+)
+parser.add_argument("--chunksize", type=int, default=100000)
+args = parser.parse_args()
+
+print(
+    json.dumps(
+        prepare(args.input, args.seed, args.test_size, args.validation_size, args.oversample, args.chunksize)
+    )
+)
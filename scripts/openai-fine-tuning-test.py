@@ -1,74 +1,108 @@
 import os
+import glob
 import json
+import time
+import argparse
 import threading
 import queue
 
 import numpy as np
-import requests
 
-OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
+import instrumentation
+import openai_batch
+import openai_client
+import response_cache as response_cache_module
+
 MODEL = "gpt-4.1-nano"
 MODEL_DIR = "gpt-4.1-nano"
+RESULTS_DIR = f"test-results/{MODEL_DIR}"
+BATCH_JOB_DIR = f"batch-jobs/{MODEL_DIR}"
 NUM_THREADS = 30
 
+# see response_cache.py for the environment variables that configure (or disable) this
+response_cache = response_cache_module.from_environment()
+
 
-def probability_distribution(ingredients, countdown):
+def nova_request_body(ingredients):
     # * `{"nova_group":1}` for unprocessed or minimally processed foods, containing only raw or crushed, chilled, frozen, or dried vegetables, meat, seafood, milk, seeds, or spices, etc., without added sweeteners or flavors.
     # * `{"nova_group":2}` for processed culinary ingredients, such as vegetable oils, butter, lard, sugar, molasses, honey, or syrups, which can include anti-oxidants, salt, and added vitamins or minerals.
     # * `{"nova_group":3}` for processed foods such as canned or bottled vegetables and legumes in brine, salted or sugared nuts and seeds, salted, dried cured, or smoked meats and fish, canned fish (with or without preservatives), fruit in syrup (with or without added anti-oxidants), and freshly made unpackaged breads and cheeses.
     # * `{"nova_group":4}` for ultra-processed foods, often ready-to-consume products like carbonated soft drinks, sweet or savory packaged snacks, candies, ice cream, mass-produced breads, margarines and other spreads, cookies, pastries, breakfast cereals, energy bars, energy drinks, instant sauces, ready-to-heat pasta and pizzas, pultry and fish "nuggets" or "sticks", sausages, burgers, hot dogs, infant formulas, health and "slimming" products such as meal-replacement shakes and powders.
 
-    if countdown == 0:
-        raise Exception(f"failed on: {ingredients}")
-    try:
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-            },
-            json={
-                "model": MODEL,
-                "messages": [
-                    {"role": "system", "content": """
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": """
 Your job is to identify a food product's NOVA classification, given its ingredient lists, as one of the four following JSON objects (with no whitespace):
 * `{"nova_group":1}` for unprocessed or minimally processed foods
 * `{"nova_group":2}` for processed culinary ingredients
 * `{"nova_group":3}` for processed foods
 * `{"nova_group":4}` for ultra-processed foods
 """.strip()},
-                    {"role": "user", "content": ingredients},
-                ],
-                "response_format": {
-                    "type": "json_schema",
-                    "json_schema": {
-                        "name": "nova_classification",
-                        "schema": {
-                            "type": "object",
-                            "properties": {
-                                "nova_group": {
-                                    "type": "integer",
-                                    "enum": [1, 2, 3, 4],
-                                },
-                            },
-                            "required": ["nova_group"],
-                            "additionalProperties": False,
+            {"role": "user", "content": ingredients},
+        ],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "nova_classification",
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "nova_group": {
+                            "type": "integer",
+                            "enum": [1, 2, 3, 4],
                         },
                     },
+                    "required": ["nova_group"],
+                    "additionalProperties": False,
                 },
-                "logprobs": True,
-                "top_logprobs": 10,
             },
-        )
-    except Exception:
-        return probability_distribution(ingredients, countdown - 1)
+        },
+        "logprobs": True,
+        "top_logprobs": 10,
+    }
+
+
+def probability_distribution(ingredients, num_attempts=5):
+    """
+    Asks MODEL for the NOVA group of `ingredients`. Failed requests are retried by openai_client.py; responses without the group's logprobs are asked for again, up to `num_attempts` times.
+    """
+
+    request_body = nova_request_body(ingredients)
+
+    for attempt in range(num_attempts):
+        # a cached response always has the logprobs (see below)
+        data = None if response_cache is None or attempt > 0 else response_cache.get(request_body)
+
+        if data is not None:
+            instrumentation.count("response_cache_hits")
+        else:
+            if response_cache is not None and response_cache.replay:
+                raise response_cache_module.CacheMiss(ingredients)
+
+            try:
+                with instrumentation.stage("llm"):
+                    data = openai_client.post_chat_completion(request_body)
+            except openai_client.RequestError as err:
+                raise Exception(f"failed on: {ingredients}") from err
+
+        distribution = distribution_from_response(data)
+        if distribution is not None:
+            # only cache responses that have the logprobs we need
+            if response_cache is not None:
+                response_cache.put(request_body, data)
+            return distribution
+
+    raise Exception(f"failed on: {ingredients}")
 
-    if response.status_code != 200:
-        return probability_distribution(ingredients, countdown - 1)
 
-    data = response.json()
+def distribution_from_response(data):
+    """
+    Returns the probability of each NOVA group from the logprobs of the group's token, or None if the response doesn't have them.
+    """
+
     if len(data.get("choices", [])) != 1:
-        return probability_distribution(ingredients, countdown - 1)
+        return None
 
     for token in data["choices"][0]["logprobs"]["content"]:
         if token["token"] in ("1", "2", "3", "4"):
@@ -78,45 +112,215 @@ Your job is to identify a food product's NOVA classification, given its ingredie
                 if x["token"] in ("1", "2", "3", "4")
             }
 
-    return probability_distribution(ingredients, countdown - 1)
+    return None
+
+
+def result_line(index, distribution, truth):
+    for value in (1, 2, 3, 4):
+        if value not in distribution:
+            distribution[value] = 0
+    return f"{index},{distribution[1]},{distribution[2]},{distribution[3]},{distribution[4]},{truth}\n"
+
+
+def read_results(directory):
+    """
+    Returns `{index: line}` for every result line in the directory's CSV files (the thread-*.csv shards and a merged results.csv); the first line wins if an index appears more than once.
+
+    A line cut off by a crash is removed from its file, so that appending to the file is safe.
+    """
+
+    results = {}
+    for filename in sorted(glob.glob(os.path.join(directory, "*.csv"))):
+        with open(filename) as file:
+            text = file.read()
+        if not text.endswith("\n") and text != "":
+            text = text[: text.rfind("\n") + 1]
+            with open(filename, "w") as file:
+                file.write(text)
+        for line in text.splitlines(keepends=True):
+            results.setdefault(int(line.split(",", 1)[0]), line)
+    return results
+
+
+def merge_results(directory):
+    """
+    Replaces the directory's CSV files with one results.csv, sorted by index and without duplicates, and returns its number of lines.
+    """
+
+    filenames = glob.glob(os.path.join(directory, "*.csv"))
+    results = read_results(directory)
+    merged = os.path.join(directory, "results.csv")
+    # results.csv.tmp isn't matched by *.csv, so an interrupted merge loses nothing
+    with open(merged + ".tmp", "w") as file:
+        for index in sorted(results):
+            file.write(results[index])
+    os.replace(merged + ".tmp", merged)
+    for filename in filenames:
+        if filename != merged:
+            os.remove(filename)
+    return len(results)
+
+
+def set_aside_results(directory):
+    """
+    Moves the directory's CSV files (from an earlier run) into a previous-TIMESTAMP subdirectory, where `read_results` doesn't see them, and returns how many were moved.
+    """
+
+    filenames = glob.glob(os.path.join(directory, "*.csv"))
+    if len(filenames) == 0:
+        return 0
+    previous = os.path.join(directory, time.strftime("previous-%Y%m%d-%H%M%S"))
+    os.makedirs(previous)
+    for filename in filenames:
+        os.replace(filename, os.path.join(previous, os.path.basename(filename)))
+    return len(filenames)
+
+
+def set_aside_batch_job(directory):
+    """
+    Moves a batch job directory from an earlier run to DIRECTORY-previous-TIMESTAMP and returns True, or returns False if there is nothing in it. Calls `parser.error` if the earlier run's batches are unfinished or haven't been collected, since their results would be lost.
+    """
+
+    if not os.path.isdir(directory) or len(os.listdir(directory)) == 0:
+        return False
+    batch_job = openai_batch.BatchJob(directory)
+    batch_job.refresh()
+    if not batch_job.done() or not all(batch["collected"] for batch in batch_job.batches):
+        parser.error(
+            f"{directory} has batches from an earlier run that are unfinished or not collected; "
+            "run --batch collect until they are all finished, or add to them with --resume"
+        )
+    os.replace(directory, time.strftime(f"{directory}-previous-%Y%m%d-%H%M%S"))
+    return True
 
 
 def worker(which, tasks):
-    with open(f"test-results/{MODEL_DIR}/thread-{which}.csv", "w") as file:
+    with open(f"{RESULTS_DIR}/thread-{which}.csv", "a" if args.resume else "w") as file:
         while True:
             task = tasks.get()
             if task is None:
                 break
             index, ingredients, truth = task
-            distribution = probability_distribution(ingredients, 5)
-            for value in (1, 2, 3, 4):
-                if value not in distribution:
-                    distribution[value] = 0
-            file.write(
-                f"{index},{distribution[1]},{distribution[2]},{distribution[3]},{distribution[4]},{truth}\n"
-            )
-            file.flush()
-
-
-tasks = queue.Queue()
-with open(f"test.jsonl") as file:
+            distribution = probability_distribution(ingredients)
+            with instrumentation.stage("write"):
+                file.write(result_line(index, distribution, truth))
+                file.flush()
+            instrumentation.count("scored")
+
+
+parser = argparse.ArgumentParser(description="Score test.jsonl with MODEL and write test-results/MODEL_DIR/*.csv.")
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="skip the examples that already have a line in test-results/MODEL_DIR/*.csv and append to those files, rather than starting over (which moves them into a previous-TIMESTAMP subdirectory)",
+)
+parser.add_argument(
+    "--merge",
+    action="store_true",
+    help="at the end, merge test-results/MODEL_DIR/*.csv into one results.csv, sorted by index (with --resume and nothing left to score, only merges)",
+)
+parser.add_argument(
+    "--batch",
+    choices=["submit", "status", "collect"],
+    default=None,
+    help="use the Batch API (see openai_batch.py) instead of NUM_THREADS threads: submit the requests, check on them, or collect the results into thread-batch.csv",
+)
+parser.add_argument(
+    "--test-file",
+    default="test.jsonl",
+    help="the examples to score, such as the low-confidence.jsonl from nova-local-classifier.py (lines with an \"index\" keep it)",
+)
+args = parser.parse_args()
+
+# see instrumentation.py for the PIPELINE_* environment variables
+instrumentation.from_environment()
+
+all_tasks = []
+with open(args.test_file) as file:
     index = 0
     for line in file:
-        user_message, assistant_message = json.loads(line)["messages"]
-        tasks.put(
-            (index, user_message["content"], json.loads(assistant_message["content"])["nova_group"])
+        example = json.loads(line)
+        user_message, assistant_message = example["messages"]
+        all_tasks.append(
+            (example.get("index", index), user_message["content"], json.loads(assistant_message["content"])["nova_group"])
         )
         index += 1
 
-for _ in range(NUM_THREADS):
-    tasks.put(None)
+# every example's truth, for batch results, which may include examples that --resume skips
+truths = {index: truth for index, _, truth in all_tasks}
+
+if args.resume:
+    scored = read_results(RESULTS_DIR)
+    num_tasks = len(all_tasks)
+    all_tasks = [task for task in all_tasks if task[0] not in scored]
+    print(f"{num_tasks - len(all_tasks)} of {num_tasks} examples already scored; {len(all_tasks)} to go", flush=True)
+
+elif args.batch in (None, "submit"):
+    # a new batch job would otherwise be added to the earlier run's, whose results would be collected with it
+    if args.batch == "submit" and set_aside_batch_job(BATCH_JOB_DIR):
+        print(f"moved the earlier run's {BATCH_JOB_DIR} to a *-previous-* directory", flush=True)
+
+    # a new run; old results.csv and thread-batch.csv lines would otherwise mix with (and win over) the new ones
+    num_moved = set_aside_results(RESULTS_DIR)
+    if num_moved > 0:
+        print(f"moved {num_moved} result files from an earlier run into a previous-* subdirectory", flush=True)
+
+if args.batch is not None:
+    batch_job = openai_batch.BatchJob(BATCH_JOB_DIR)
+
+    if args.batch == "submit":
+        num_requests = batch_job.prepare(
+            (index, nova_request_body(ingredients)) for index, ingredients, _ in all_tasks
+        )
+        batch_job.submit()
+        print(f"submitted {num_requests} requests")
+
+    elif args.batch == "status":
+        for batch in batch_job.refresh():
+            print(f"{batch['batch_id']}  {batch['status']}")
+
+    else:
+        batch_job.refresh()
+        num_written = num_unscored = 0
+        with open(f"{RESULTS_DIR}/thread-batch.csv", "a") as file:
+            for custom_id, request_body, data, error in batch_job.results():
+                distribution = None if data is None else distribution_from_response(data)
+                if distribution is None:
+                    print(f"{custom_id}: {error or 'no NOVA group logprobs in response'}", flush=True)
+                    num_unscored += 1
+                    continue
+                if response_cache is not None:
+                    response_cache.put(request_body, data)
+                file.write(result_line(int(custom_id), distribution, truths[int(custom_id)]))
+                num_written += 1
+        batch_job.mark_collected()
+        if num_unscored > 0:
+            # including requests that a failed or expired batch never answered
+            print(f"{num_unscored} examples have no result; rerun with --resume (with or without --batch submit) to score them")
+        print(f"wrote {num_written} results; all batches finished: {batch_job.done()}")
+
+else:
+    tasks = queue.Queue()
+    for task in all_tasks:
+        tasks.put(task)
+
+    for _ in range(NUM_THREADS):
+        tasks.put(None)
+
+    threads = []
+    for which in range(NUM_THREADS):
+        threads.append(threading.Thread(target=worker, args=(which, tasks), name=f"worker-{which}"))
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
 
-threads = []
-for which in range(NUM_THREADS):
-    threads.append(threading.Thread(target=worker, args=(which, tasks)))
+    print(f"request latency: {json.dumps(openai_client.latency.summary())}")
 
-for thread in threads:
-    thread.start()
+if args.merge and args.batch in (None, "collect"):
+    print(f"merged {merge_results(RESULTS_DIR)} results into {RESULTS_DIR}/results.csv")
 
-for thread in threads:
-    thread.join()
+if response_cache is not None:
+    print(f"response cache: {response_cache.stats()}")
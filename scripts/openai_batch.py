@@ -0,0 +1,348 @@
+"""
+Submission and collection of OpenAI Batch API jobs, for offline runs that don't
+need interactive latency (openai-fine-tuning-test.py, parse-ingredient-lists.py).
+
+A `BatchJob` is a directory holding
+
+    requests-NNNN.jsonl    chat-completions requests in the Batch API input format
+                           (at most 50,000 requests per file)
+    batches.json           the submitted batch IDs and their last known status
+    output-{batch_id}.jsonl    downloaded results
+
+The scripts write their requests with `prepare`, `submit` them, check on them
+with `refresh`, and read the `results` back into their usual outputs when the
+batches are complete.
+
+By default, batches go to the OpenAI API at OPENAI_BASE_URL. If the
+OPENAI_BATCH_LOCAL_DIR environment variable is set, a file-based stand-in is
+used instead: it keeps "uploaded" files and batches in that directory and, when
+a batch is first checked, sends its requests one by one to OPENAI_BASE_URL (for
+instance, mock_openai_server.py) and writes an output file in the Batch API
+format. This exercises the whole path without the real Batch API.
+
+Usage:
+
+    python openai_batch.py status --job DIR
+"""
+
+import glob
+import json
+import os
+import time
+import uuid
+
+import openai_client
+
+OPENAI_BASE_URL = openai_client.OPENAI_BASE_URL
+
+# Batch API limits on input files
+MAX_REQUESTS_PER_FILE = 50000
+MAX_BYTES_PER_FILE = 190 * 1024 * 1024
+
+FINISHED_STATES = ("completed", "failed", "expired", "cancelled")
+
+
+class OpenAIBatchBackend:
+    def __init__(self, base_url=OPENAI_BASE_URL, api_key=None):
+        self.base_url = base_url
+        self.api_key = os.environ["OPENAI_API_KEY"] if api_key is None else api_key
+
+    def _headers(self):
+        return {"Authorization": f"Bearer {self.api_key}"}
+
+    def upload(self, filename):
+        with open(filename, "rb") as file:
+            response = openai_client.session().post(
+                f"{self.base_url}/files",
+                headers=self._headers(),
+                files={"file": (os.path.basename(filename), file)},
+                data={"purpose": "batch"},
+            )
+        response.raise_for_status()
+        return response.json()["id"]
+
+    def create(self, input_file_id):
+        response = openai_client.session().post(
+            f"{self.base_url}/batches",
+            headers=self._headers(),
+            json={
+                "input_file_id": input_file_id,
+                "endpoint": "/v1/chat/completions",
+                "completion_window": "24h",
+            },
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def retrieve(self, batch_id):
+        response = openai_client.session().get(f"{self.base_url}/batches/{batch_id}", headers=self._headers())
+        response.raise_for_status()
+        return response.json()
+
+    def download(self, file_id, filename):
+        response = openai_client.session().get(
+            f"{self.base_url}/files/{file_id}/content", headers=self._headers(), stream=True
+        )
+        response.raise_for_status()
+        with open(filename, "wb") as file:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                file.write(chunk)
+
+
+class LocalBatchBackend:
+    """
+    A file-based stand-in for the Batch API (see the module docstring).
+    """
+
+    def __init__(self, directory, base_url=OPENAI_BASE_URL, api_key=None):
+        self.directory = directory
+        self.base_url = base_url
+        self.api_key = os.environ.get("OPENAI_API_KEY", "") if api_key is None else api_key
+        os.makedirs(os.path.join(directory, "files"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "batches"), exist_ok=True)
+
+    def _file(self, file_id):
+        return os.path.join(self.directory, "files", f"{file_id}.jsonl")
+
+    def _batch(self, batch_id):
+        return os.path.join(self.directory, "batches", f"{batch_id}.json")
+
+    def upload(self, filename):
+        file_id = f"file-{uuid.uuid4().hex}"
+        with open(filename, "rb") as source, open(self._file(file_id), "wb") as destination:
+            destination.write(source.read())
+        return file_id
+
+    def create(self, input_file_id):
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "status": "validating",
+            "input_file_id": input_file_id,
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": int(time.time()),
+        }
+        with open(self._batch(batch["id"]), "w") as file:
+            json.dump(batch, file)
+        return batch
+
+    def retrieve(self, batch_id):
+        with open(self._batch(batch_id)) as file:
+            batch = json.load(file)
+        if batch["status"] not in FINISHED_STATES:
+            batch = self._process(batch)
+        return batch
+
+    def _process(self, batch):
+        output_file_id = f"file-{uuid.uuid4().hex}"
+        session = openai_client.session()
+        with open(self._file(batch["input_file_id"])) as source, open(self._file(output_file_id), "w") as output:
+            for line in source:
+                request = json.loads(line)
+                try:
+                    response = session.post(
+                        f"{self.base_url}/chat/completions",
+                        headers={"Authorization": f"Bearer {self.api_key}"},
+                        json=request["body"],
+                    )
+                    result = {
+                        "response": {"status_code": response.status_code, "body": response.json()},
+                        "error": None,
+                    }
+                except Exception as err:
+                    result = {"response": None, "error": {"code": type(err).__name__, "message": str(err)}}
+                output.write(
+                    json.dumps({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"], **result})
+                    + "\n"
+                )
+
+        batch["status"] = "completed"
+        batch["output_file_id"] = output_file_id
+        with open(self._batch(batch["id"]), "w") as file:
+            json.dump(batch, file)
+        return batch
+
+    def download(self, file_id, filename):
+        with open(self._file(file_id), "rb") as source, open(filename, "wb") as destination:
+            destination.write(source.read())
+
+
+def backend_from_environment():
+    local_directory = os.environ.get("OPENAI_BATCH_LOCAL_DIR")
+    if local_directory:
+        return LocalBatchBackend(local_directory)
+    else:
+        return OpenAIBatchBackend()
+
+
+class BatchJob:
+    def __init__(self, directory, backend=None):
+        self.directory = directory
+        self.backend = backend_from_environment() if backend is None else backend
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_path = os.path.join(directory, "batches.json")
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as file:
+                self.batches = json.load(file)
+        else:
+            self.batches = []
+
+    def _save(self):
+        with open(self.manifest_path + ".tmp", "w") as file:
+            json.dump(self.batches, file, indent=1)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    def prepare(self, requests_to_write):
+        """
+        Writes `(custom_id, request_body)` pairs as new input files in the Batch API format and returns the number of requests written.
+        """
+
+        first = len(glob.glob(os.path.join(self.directory, "requests-*.jsonl")))
+        num_requests = 0
+        file = None
+        num_in_file = num_bytes_in_file = 0
+        try:
+            for custom_id, request_body in requests_to_write:
+                line = (
+                    json.dumps(
+                        {
+                            "custom_id": str(custom_id),
+                            "method": "POST",
+                            "url": "/v1/chat/completions",
+                            "body": request_body,
+                        }
+                    )
+                    + "\n"
+                )
+                if (
+                    file is None
+                    or num_in_file == MAX_REQUESTS_PER_FILE
+                    or num_bytes_in_file + len(line) > MAX_BYTES_PER_FILE
+                ):
+                    if file is not None:
+                        file.close()
+                    file = open(os.path.join(self.directory, f"requests-{first:04d}.jsonl"), "w")
+                    first += 1
+                    num_in_file = num_bytes_in_file = 0
+                file.write(line)
+                num_in_file += 1
+                num_bytes_in_file += len(line)
+                num_requests += 1
+        finally:
+            if file is not None:
+                file.close()
+        return num_requests
+
+    def submit(self):
+        """
+        Uploads every input file that hasn't been submitted yet and creates a batch for it.
+        """
+
+        submitted = {batch["input_file"] for batch in self.batches}
+        for filename in sorted(glob.glob(os.path.join(self.directory, "requests-*.jsonl"))):
+            if os.path.basename(filename) in submitted:
+                continue
+            input_file_id = self.backend.upload(filename)
+            batch = self.backend.create(input_file_id)
+            self.batches.append(
+                {
+                    "input_file": os.path.basename(filename),
+                    "batch_id": batch["id"],
+                    "status": batch["status"],
+                    "output_file_id": None,
+                    "error_file_id": None,
+                    "collected": False,
+                }
+            )
+            # save after each one, so a failure partway through doesn't lose track of submitted batches
+            self._save()
+
+    def refresh(self):
+        """
+        Updates the status of unfinished batches, downloads the output of completed ones, and returns the batches.
+        """
+
+        for batch in self.batches:
+            if batch["status"] in FINISHED_STATES and (batch["output_file_id"] is None or self._downloaded(batch)):
+                continue
+            state = self.backend.retrieve(batch["batch_id"])
+            batch["status"] = state["status"]
+            batch["output_file_id"] = state.get("output_file_id")
+            batch["error_file_id"] = state.get("error_file_id")
+            if batch["output_file_id"] is not None and not self._downloaded(batch):
+                self.backend.download(batch["output_file_id"], self._output(batch))
+            if batch["error_file_id"] is not None:
+                self.backend.download(batch["error_file_id"], self._output(batch, "errors"))
+        self._save()
+        return self.batches
+
+    def _output(self, batch, kind="output"):
+        return os.path.join(self.directory, f"{kind}-{batch['batch_id']}.jsonl")
+
+    def _downloaded(self, batch):
+        return os.path.exists(self._output(batch))
+
+    def done(self):
+        return all(batch["status"] in FINISHED_STATES for batch in self.batches)
+
+    def results(self, include_collected=False):
+        """
+        Yields `(custom_id, request_body, response_body, error)` for every request in the downloaded output (and error) files, where `response_body` is None if the request failed and `error` describes why. Batches that were `mark_collected` are skipped unless `include_collected`.
+
+        A finished batch that failed, expired, or was cancelled leaves requests without any result; those are yielded with `response_body` None and an error with code "no_result", so that the caller can release or resubmit them.
+        """
+
+        for batch in self.batches:
+            if batch["collected"] and not include_collected:
+                continue
+
+            request_bodies = {}
+            with open(os.path.join(self.directory, batch["input_file"])) as file:
+                for line in file:
+                    request = json.loads(line)
+                    request_bodies[request["custom_id"]] = request["body"]
+
+            answered = set()
+            for kind in ("output", "errors"):
+                filename = self._output(batch, kind)
+                if not os.path.exists(filename):
+                    continue
+                with open(filename) as file:
+                    for line in file:
+                        result = json.loads(line)
+                        response = result.get("response") or {}
+                        if response.get("status_code") == 200:
+                            body, error = response["body"], None
+                        else:
+                            body = None
+                            error = result.get("error") or {"status_code": response.get("status_code")}
+                        answered.add(result["custom_id"])
+                        yield result["custom_id"], request_bodies.get(result["custom_id"]), body, error
+
+            if batch["status"] in FINISHED_STATES:
+                error = {"code": "no_result", "message": f"batch {batch['batch_id']} {batch['status']} without a result"}
+                for custom_id, request_body in request_bodies.items():
+                    if custom_id not in answered:
+                        yield custom_id, request_body, None, error
+
+    def mark_collected(self):
+        """
+        Records that the results of all finished batches (including the requests they left without results) have been read into the script's outputs.
+        """
+
+        for batch in self.batches:
+            if batch["status"] in FINISHED_STATES:
+                batch["collected"] = True
+        self._save()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check on submitted batch jobs.")
+    parser.add_argument("command", choices=["status"])
+    parser.add_argument("--job", required=True, help="the batch job directory")
+    args = parser.parse_args()
+
+    for batch in BatchJob(args.job).refresh():
+        print(f"{batch['batch_id']}  {batch['input_file']}  {batch['status']}{'  (collected)' if batch['collected'] else ''}")
@@ -0,0 +1,298 @@
+"""
+The HTTP client for every OpenAI chat-completions call in these scripts and
+notebooks.
+
+Connections are pooled and kept alive: each thread reuses one `requests`
+session (`session()`), and async code shares one `aiohttp` session per event
+loop (`async_session(...)`), so only the first request to the server pays for
+the TCP and TLS handshakes.
+
+Failed requests are retried the same way everywhere. Connection errors,
+timeouts, and the RETRY_STATUS_CODES (including 429, "rate limited") are
+retried up to `max_retries` times with exponential backoff and jitter. The
+client waits at least as long as the server's Retry-After header asks. Any
+other status, or running out of retries, raises `RequestError`.
+
+Every attempt is recorded in `latency`, a histogram of request latencies that
+also counts the status codes and retries. Scripts print `latency.summary()`
+when they finish.
+
+    import openai_client
+    response_json = openai_client.post_chat_completion(request_body)
+
+OPENAI_BASE_URL points all of them at another server, such as
+mock_openai_server.py.
+"""
+
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+
+import numpy as np
+import requests
+
+import instrumentation
+
+# point this at a local server (such as mock_openai_server.py) for testing
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
+
+# HTTP status codes that are worth retrying; any other error fails immediately
+RETRY_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+# upper edges of the latency histogram's bins, in seconds (the last bin is everything longer)
+LATENCY_BINS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class RequestError(Exception):
+    """
+    A request that failed for good: a status code that isn't worth retrying, or every retry failed. `status_code` is None if the last attempt didn't get a response.
+    """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class LatencyHistogram:
+    """
+    Latencies of individual HTTP attempts (a retried request is several attempts), binned by LATENCY_BINS, with counts of status codes and retries. Shared by threads and coroutines.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counts = np.zeros(len(LATENCY_BINS) + 1, dtype=np.int64)
+        self.latencies = []
+        self.statuses = {}
+        self.retries = 0
+
+    def record(self, seconds, status):
+        """
+        Adds one attempt that took `seconds` and ended with the HTTP `status` (or an exception's class name).
+        """
+
+        with self.lock:
+            self.counts[np.searchsorted(LATENCY_BINS, seconds)] += 1
+            self.latencies.append(seconds)
+            self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+        instrumentation.add("http_attempt", seconds)
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+        instrumentation.count("retries")
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            return {
+                "attempts": len(latencies),
+                "retries": self.retries,
+                "statuses": dict(self.statuses),
+                "mean": float(latencies.mean()) if len(latencies) else None,
+                "p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p90": float(np.percentile(latencies, 90)) if len(latencies) else None,
+                "p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+                "max": float(latencies.max()) if len(latencies) else None,
+                "histogram": {
+                    f"<{edge:g}s" if edge is not None else f">={LATENCY_BINS[-1]:g}s": int(count)
+                    for edge, count in zip(LATENCY_BINS + (None,), self.counts)
+                },
+            }
+
+
+latency = LatencyHistogram()
+
+
+def headers(api_key=None):
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {os.environ['OPENAI_API_KEY'] if api_key is None else api_key}",
+    }
+
+
+def retry_delay(attempt, retry_after=None, initial_backoff=1.0, max_backoff=60.0):
+    """
+    Returns how long to wait before retry number `attempt` (starting at 0): exponential backoff with jitter, but at least the Retry-After header (seconds or an HTTP date), if there was one.
+    """
+
+    delay = min(max_backoff, initial_backoff * 2**attempt) * random.uniform(0.5, 1.0)
+    if retry_after is not None:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            try:
+                delay = max(delay, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return delay
+
+
+_local = threading.local()
+
+
+def session(pool_size=10):
+    """
+    Returns this thread's `requests.Session`, which keeps its connections alive between requests.
+    """
+
+    if getattr(_local, "session", None) is None:
+        _local.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        _local.session.mount("https://", adapter)
+        _local.session.mount("http://", adapter)
+    return _local.session
+
+
+def post_chat_completion(
+    request_body, max_retries=5, initial_backoff=1.0, max_backoff=60.0, timeout=600, base_url=None, api_key=None
+):
+    """
+    POSTs `request_body` to the chat-completions endpoint with this thread's session and returns the response JSON, retrying as described in the module docstring.
+    """
+
+    url = f"{OPENAI_BASE_URL if base_url is None else base_url}/chat/completions"
+
+    for attempt in range(max_retries + 1):
+        retry_after = None
+        start_time = time.perf_counter()
+        try:
+            response = session().post(url, headers=headers(api_key), json=request_body, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            latency.record(time.perf_counter() - start_time, type(err).__name__)
+            error = RequestError(f"connection failed: {err}")
+        else:
+            latency.record(time.perf_counter() - start_time, response.status_code)
+            if response.status_code == 200:
+                return response.json()
+            error = RequestError(f"status code is {response.status_code}: {response.text}", response.status_code)
+            if response.status_code not in RETRY_STATUS_CODES:
+                raise error
+            retry_after = response.headers.get("Retry-After")
+
+        if attempt == max_retries:
+            raise error
+        latency.record_retry()
+        time.sleep(retry_delay(attempt, retry_after, initial_backoff, max_backoff))
+
+
+class RateLimiter:
+    """
+    Token buckets for the API's requests-per-minute and tokens-per-minute limits, shared by all coroutines in one event loop. Either limit can be None (unlimited).
+
+    Requests are admitted in the order that they call `acquire`.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute or 0
+        self.available_tokens = tokens_per_minute or 0
+        self.last_update = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+        if self.requests_per_minute is not None:
+            self.available_requests = min(
+                self.requests_per_minute, self.available_requests + elapsed * self.requests_per_minute / 60
+            )
+        if self.tokens_per_minute is not None:
+            self.available_tokens = min(
+                self.tokens_per_minute, self.available_tokens + elapsed * self.tokens_per_minute / 60
+            )
+
+    async def acquire(self, num_tokens):
+        async with self.lock:
+            while True:
+                self._refill()
+                wait = 0.0
+                if self.requests_per_minute is not None and self.available_requests < 1:
+                    wait = max(wait, (1 - self.available_requests) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute is not None:
+                    # a request larger than the whole bucket waits for a full bucket, then overdraws it
+                    needed = min(num_tokens, self.tokens_per_minute)
+                    if self.available_tokens < needed:
+                        wait = max(wait, (needed - self.available_tokens) * 60 / self.tokens_per_minute)
+                if wait == 0.0:
+                    break
+                await asyncio.sleep(wait)
+
+            self.available_requests -= 1
+            self.available_tokens -= num_tokens
+
+
+def estimate_num_tokens(request_body, completion_tokens_per_choice=10):
+    """
+    A rough count of the tokens a chat-completions request will use, for rate limiting: about 4 characters per prompt token, plus a short JSON answer per choice.
+    """
+
+    prompt_characters = sum(len(message["content"]) for message in request_body["messages"])
+    return prompt_characters // 4 + request_body.get("n", 1) * completion_tokens_per_choice
+
+
+def async_session(max_in_flight=100, keepalive_timeout=60):
+    """
+    Returns an `aiohttp.ClientSession` with up to `max_in_flight` kept-alive connections, to use as `async with openai_client.async_session(...) as session:`.
+    """
+
+    import aiohttp
+
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=max_in_flight, keepalive_timeout=keepalive_timeout)
+    )
+
+
+async def post_chat_completion_async(
+    session,
+    request_body,
+    rate_limiter=None,
+    max_retries=5,
+    initial_backoff=1.0,
+    max_backoff=60.0,
+    base_url=None,
+    api_key=None,
+):
+    """
+    Same as `post_chat_completion`, but with an `aiohttp` session from `async_session`, waiting for `rate_limiter` (a `RateLimiter`, or None) before each attempt.
+    """
+
+    import aiohttp
+
+    url = f"{OPENAI_BASE_URL if base_url is None else base_url}/chat/completions"
+    num_tokens = estimate_num_tokens(request_body)
+
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            with instrumentation.stage("rate_limit_wait"):
+                await rate_limiter.acquire(num_tokens)
+
+        retry_after = None
+        start_time = time.perf_counter()
+        try:
+            async with session.post(url, headers=headers(api_key), json=request_body) as response:
+                if response.status == 200:
+                    response_json = await response.json()
+                    latency.record(time.perf_counter() - start_time, response.status)
+                    return response_json
+                latency.record(time.perf_counter() - start_time, response.status)
+                error = RequestError(f"status code is {response.status}: {await response.text()}", response.status)
+                if response.status not in RETRY_STATUS_CODES:
+                    raise error
+                retry_after = response.headers.get("Retry-After")
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            latency.record(time.perf_counter() - start_time, type(err).__name__)
+            error = RequestError(f"connection failed: {err}")
+
+        if attempt == max_retries:
+            raise error
+        latency.record_retry()
+        await asyncio.sleep(retry_delay(attempt, retry_after, initial_backoff, max_backoff))
@@ -1,45 +1,29 @@
-import re
 import os
 import json
-import random
+import socket
+import argparse
 
-import requests
 import pandas as pd
 
-OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
+import ingredient_parser
+import ingredient_store
+import instrumentation
+import openai_batch
+import openai_client
+import response_cache as response_cache_module
 
-branded_food = pd.read_csv(
-    "~/Box/dsi-core/11th-hour/good-food-purchasing/branded_food.csv",
-    usecols=["fdc_id", "ingredients"],
-)
-
-branded_food_list = list(branded_food[branded_food["ingredients"].notna()].itertuples())
-random.shuffle(branded_food_list)
-
-# save memory; only need one copy
-del branded_food
+# see response_cache.py for the environment variables that configure (or disable) this
+response_cache = response_cache_module.from_environment()
 
-for row in branded_food_list:
-    outfilename = f"ingredient-lists/{row.fdc_id}.json"
-    if os.path.exists(outfilename):
-        continue
+# jobs submitted to the Batch API are leased for longer than its 24-hour completion window
+BATCH_LEASE_SECONDS = 26 * 3600
 
-    # When running many instances of this script, writing this empty file is a
-    # synchronization point because of POSIX. Each will only be handled once.
-    with open(outfilename, "w") as file:
-        pass
 
-    try:
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-            },
-            json={
-                "model": "gpt-4.1-nano",
-                "messages": [
-                    {"role": "system", "content": """
+def ingredients_request_body(ingredients):
+    return {
+        "model": "gpt-4.1-nano",
+        "messages": [
+            {"role": "system", "content": """
 The user will provide a list of food ingredients from a Nutrition Facts label.
 
 Your job is to parse it into a JSON list of individual ingredients for further processing.
@@ -60,56 +44,234 @@ The text also contains words that are not part of any ingredient, such as `ALL-N
 
 The strings in the output list should be exact substrings of the input text, in the same order.
 """.strip()},
-                    {"role": "user", "content": row.ingredients},
-                ],
-                "response_format": {
-                    "type": "json_schema",
-                    "json_schema": {
-                        "name": "list_of_ingredients",
-                        "schema": {
-                            "type": "object",
-                            "properties": {
-                                "ingredients": {
-                                    "type": "array",
-                                    "items": {"type": "string"},
-                                },
-                            },
+            {"role": "user", "content": ingredients},
+        ],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "list_of_ingredients",
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "ingredients": {
+                            "type": "array",
+                            "items": {"type": "string"},
                         },
                     },
                 },
             },
-        )
-    except:
-        print(f"{row.fdc_id}: connection failed", flush=True)
-        continue
+        },
+    }
 
-    if response.status_code != 200:
-        print(f"{row.fdc_id}: status code is {response.status_code}", flush=True)
-        continue
 
-    data = response.json()
+def content_from_response(data, ingredients):
+    """
+    Returns `(content, None)` with the parsed "ingredients" and their "separators", or `(None, error)` if the response can't be used.
+    """
 
     if len(data.get("choices", [])) == 0:
-        print(f"{row.fdc_id}: response has no 'choices'", flush=True)
-        continue
+        return None, "response has no 'choices'"
 
     content = json.loads(data["choices"][0].get("message", {}).get("content", "{}"))
 
     if not isinstance(content.get("ingredients"), list):
-        print(f"{row.fdc_id}: choices has no 'ingredients'", flush=True)
-        continue
+        return None, "choices has no 'ingredients'"
 
     if not all(isinstance(x, str) for x in content["ingredients"]):
-        print(f"{row.fdc_id}: not a flat list (didn't follow JSON schema)")
-        continue
+        return None, "not a flat list (didn't follow JSON schema)"
+
+    try:
+        content["separators"] = ingredient_parser.align(content["ingredients"], ingredients)
+    except ingredient_parser.AlignmentError as err:
+        return None, f"{err} <<<<< {json.dumps(ingredients)}"
+
+    return content, None
+
+
+parser = argparse.ArgumentParser(description="Parse USDA branded food ingredient lists with ChatGPT.")
+parser.add_argument("--store", default=ingredient_store.DEFAULT_STORE, help="see ingredient_store.py")
+parser.add_argument(
+    "--update",
+    action="store_true",
+    help="add jobs from branded_food.csv even if the store already has some, and remove foods that are no longer in it (for a new USDA release)",
+)
+parser.add_argument(
+    "--no-local-parser",
+    action="store_true",
+    help="send every ingredient list to the LLM, rather than only those that ingredient_parser.py finds ambiguous",
+)
+parser.add_argument(
+    "--batch",
+    choices=["submit", "status", "collect"],
+    default=None,
+    help="use the Batch API (see openai_batch.py): claim all pending jobs and submit them, check on them, or collect the results into the store",
+)
+args = parser.parse_args()
+
+# see instrumentation.py for the PIPELINE_* environment variables
+instrumentation.from_environment()
+
+store = ingredient_store.IngredientStore(args.store)
+# batch jobs are claimed at submission and completed at collection, so they need a fixed worker name
+worker = "batch" if args.batch is not None else f"{socket.gethostname()}-{os.getpid()}"
+
+if store.status()["fdc_ids"] == 0 or args.update:
+    with instrumentation.stage("read_csv"):
+        branded_food = pd.read_csv(
+            "~/Box/dsi-core/11th-hour/good-food-purchasing/branded_food.csv",
+            usecols=["fdc_id", "ingredients"],
+        )
+
+    branded_food = branded_food[branded_food["ingredients"].notna()]
+
+    # Many branded foods have byte-identical ingredient lists (up to surrounding
+    # whitespace), so each distinct list is one job, whose result applies to
+    # every fdc_id that shares it.
+    ingredient_groups = (
+        branded_food.assign(ingredients=branded_food["ingredients"].str.strip())
+        .sort_values("fdc_id")
+        .groupby("ingredients", sort=False)["fdc_id"]
+        .agg(list)
+    )
+
+    print(
+        f"{len(branded_food)} foods have {len(ingredient_groups)} distinct ingredient lists "
+        f"(dedup ratio {len(branded_food) / max(len(ingredient_groups), 1):.2f})",
+        flush=True,
+    )
+
+    with instrumentation.stage("store"):
+        # an update is a whole new release, so foods that left it are dropped from the store
+        store.add_jobs(ingredient_groups.items(), replace=args.update)
+
+    # save memory; the store has everything that's needed
+    del branded_food, ingredient_groups
+
+print(f"{worker} starting: {json.dumps(store.status())}", flush=True)
+
+
+def failed(job_id, message):
+    print(f"{job_id}: {message}", flush=True)
+    instrumentation.count("failed")
+    with instrumentation.stage("store"):
+        store.fail(job_id, worker, message)
+
+
+def parse_locally(job_id, ingredients):
+    """
+    Completes the job and returns True if the local parser can be trusted with it.
+    """
+
+    if args.no_local_parser:
+        return False
+    with instrumentation.stage("local_parser"):
+        content, reason = ingredient_parser.parse(ingredients)
+    if reason is not None:
+        return False
+    instrumentation.count("parsed_locally")
+    with instrumentation.stage("store"):
+        store.complete(job_id, worker, {**content, "parser": "local"})
+    return True
+
+
+def batch_requests():
+    while True:
+        jobs = store.claim(worker, num_jobs=1000, lease_seconds=BATCH_LEASE_SECONDS)
+        if len(jobs) == 0:
+            break
+        for job_id, ingredients in jobs:
+            if not parse_locally(job_id, ingredients):
+                yield job_id, ingredients_request_body(ingredients)
+
+
+if args.batch is not None:
+    batch_job = openai_batch.BatchJob(os.path.join(args.store, "batch-jobs"))
+
+    if args.batch == "submit":
+        num_requests = batch_job.prepare(batch_requests())
+        batch_job.submit()
+        print(f"submitted {num_requests} requests", flush=True)
+
+    elif args.batch == "status":
+        for batch in batch_job.refresh():
+            print(f"{batch['batch_id']}  {batch['status']}", flush=True)
+
+    else:
+        batch_job.refresh()
+        num_unanswered = 0
+        for custom_id, request_body, data, error in batch_job.results():
+            job_id = int(custom_id)
+            if data is None:
+                # releases the job (back to pending, unless it has run out of attempts) instead of leaving it leased
+                num_unanswered += error.get("code") == "no_result"
+                failed(job_id, f"batch request failed: {error}")
+                continue
+            content, error = content_from_response(data, request_body["messages"][-1]["content"])
+            if error is not None:
+                failed(job_id, error)
+                continue
+            if response_cache is not None:
+                response_cache.put(request_body, data)
+            store.complete(job_id, worker, content)
+        batch_job.mark_collected()
+        if num_unanswered > 0:
+            print(f"{num_unanswered} requests got no result from a failed or expired batch; their jobs were released", flush=True)
+        print(f"all batches finished: {batch_job.done()}", flush=True)
+
+while args.batch is None:
+    # claimed jobs are leased to this worker; if it crashes, others pick them up after the lease expires
+    with instrumentation.stage("claim"):
+        jobs = store.claim(worker)
+    if len(jobs) == 0:
+        break
+
+    for job_id, ingredients in jobs:
+        instrumentation.count("jobs")
+        if parse_locally(job_id, ingredients):
+            continue
+
+        request_body = ingredients_request_body(ingredients)
+
+        data = None if response_cache is None else response_cache.get(request_body)
+        if data is not None:
+            instrumentation.count("response_cache_hits")
+
+        if data is None and response_cache is not None and response_cache.replay:
+            failed(job_id, "not in response cache")
+            continue
+
+        fetched = data is None
+        if fetched:
+            # retried with backoff by openai_client.py; what's left is a failure for good
+            try:
+                with instrumentation.stage("llm"):
+                    data = openai_client.post_chat_completion(request_body)
+            except openai_client.RequestError as err:
+                failed(job_id, str(err))
+                continue
+            instrumentation.count("llm_requests")
+            usage = data.get("usage", {})
+            instrumentation.count("prompt_tokens", usage.get("prompt_tokens", 0))
+            instrumentation.count("completion_tokens", usage.get("completion_tokens", 0))
 
-    m = re.search("(.*)".join(re.escape(x) for x in content["ingredients"]), row.ingredients, re.I)
+        with instrumentation.stage("align"):
+            content, error = content_from_response(data, ingredients)
+        if error is not None:
+            # an unusable response is never cached, so that retrying the job asks again
+            if response_cache is not None and not fetched:
+                response_cache.delete(request_body)
+            failed(job_id, error)
+            continue
 
-    if m is None:
-        print(f"{row.fdc_id}: {content['ingredients']} <<<<< {json.dumps(row.ingredients)}", flush=True)
-        continue
+        if response_cache is not None and fetched:
+            response_cache.put(request_body, data)
 
-    content["separators"] = list(m.groups())
+        with instrumentation.stage("store"):
+            if not store.complete(job_id, worker, content):
+                # the lease expired and another worker claimed the job
+                instrumentation.count("lease_lost")
 
-    with open(outfilename, "w") as file:
-        json.dump(content, file)
+print(f"{worker} finished: {json.dumps(store.status())}", flush=True)
+if args.batch is None:
+    print(f"request latency: {json.dumps(openai_client.latency.summary())}", flush=True)
+store.close()
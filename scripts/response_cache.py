@@ -0,0 +1,254 @@
+"""
+Persistent cache of OpenAI chat-completions responses, shared by all of the scripts.
+
+Responses are stored in SQLite, keyed by the SHA-256 of the canonicalized
+request body (model, messages, response_format, n, temperature, ... with
+sorted keys and no whitespace), so rerunning or resuming a job costs nothing
+for prompts that have already been answered. Only successful responses (with
+`choices`) are stored.
+
+The scripts get their cache from `from_environment()`, controlled by:
+
+    OPENAI_RESPONSE_CACHE        path of the SQLite file (default below); empty to disable
+    OPENAI_RESPONSE_CACHE_MODE   "readwrite" (default) or "replay": never write, and
+                                 raise `CacheMiss` instead of calling the API
+    OPENAI_RESPONSE_CACHE_MAX_AGE    evict entries older than this many days
+    OPENAI_RESPONSE_CACHE_MAX_BYTES  evict least-recently used entries beyond this size
+
+Usage:
+
+    python response_cache.py stats [--path PATH]
+    python response_cache.py evict [--path PATH] [--max-age DAYS] [--max-bytes N]
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_PATH = os.path.expanduser("~/.cache/good-food-purchasing/openai-responses.sqlite")
+
+# how many `put` calls between automatic evictions
+EVICT_EVERY = 1000
+
+
+class CacheMiss(Exception):
+    """
+    Raised in replay mode for a request that is not in the cache.
+    """
+
+
+def request_key(request_body):
+    canonical = json.dumps(request_body, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Thread-safe (one SQLite connection per thread) and safe to share among processes.
+
+    `max_age` is in seconds, `max_bytes` counts the stored response JSON. If
+    `replay` is True, the cache is read-only and `call` raises `CacheMiss`
+    rather than making a request.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_age=None, max_bytes=None, replay=False):
+        self.path = path
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self.hits = 0
+        self.misses = 0
+        self._num_puts = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        if replay and not os.path.exists(path):
+            # a read-only connection can't create the file; say which one is missing instead of sqlite3's "unable to open"
+            raise FileNotFoundError(
+                f"replay mode needs an existing response cache, and {path} does not exist; fill it by running "
+                'with OPENAI_RESPONSE_CACHE_MODE=readwrite, or disable the cache with OPENAI_RESPONSE_CACHE=""'
+            )
+
+        if not replay:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with self._connection() as connection:
+                connection.execute(
+                    """CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY,
+                        response TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        created REAL NOT NULL,
+                        last_used REAL NOT NULL
+                    )"""
+                )
+                connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self.replay:
+                connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=60)
+            else:
+                connection = sqlite3.connect(self.path, timeout=60)
+                connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, request_body):
+        """
+        Returns the cached response JSON for `request_body`, or None.
+        """
+
+        key = request_key(request_body)
+        connection = self._connection()
+        row = connection.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+
+        if row is not None and self.max_age is not None and row[1] < time.time() - self.max_age:
+            row = None
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if row is None:
+            return None
+
+        if not self.replay:
+            with connection:
+                connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, request_body, response_json):
+        """
+        Stores `response_json` if it is a successful response. Does nothing in replay mode.
+        """
+
+        if self.replay or not response_json.get("choices"):
+            return
+
+        response = json.dumps(response_json, separators=(",", ":"))
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (request_key(request_body), response, len(response), now, now),
+            )
+
+        with self._lock:
+            self._num_puts += 1
+            evict = self._num_puts % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def delete(self, request_body):
+        """
+        Forgets the response for `request_body`, such as one that turned out to be unusable. Does nothing in replay mode.
+        """
+
+        if self.replay:
+            return
+        with self._connection() as connection:
+            connection.execute("DELETE FROM responses WHERE key = ?", (request_key(request_body),))
+
+    def call(self, request_body, fetch):
+        """
+        Returns the cached response for `request_body`, or calls `fetch()` to get the response JSON and caches it.
+        """
+
+        response_json = self.get(request_body)
+        if response_json is not None:
+            return response_json
+        if self.replay:
+            raise CacheMiss(request_key(request_body))
+        response_json = fetch()
+        self.put(request_body, response_json)
+        return response_json
+
+    def evict(self):
+        """
+        Deletes entries older than `max_age`, then least-recently used entries until the total size is under `max_bytes`.
+        """
+
+        if self.replay:
+            return
+
+        with self._connection() as connection:
+            if self.max_age is not None:
+                connection.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+
+            if self.max_bytes is not None:
+                (total,) = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+                if total > self.max_bytes:
+                    to_delete = []
+                    for key, size in connection.execute("SELECT key, size FROM responses ORDER BY last_used"):
+                        if total <= self.max_bytes:
+                            break
+                        to_delete.append((key,))
+                        total -= size
+                    connection.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+
+    def stats(self):
+        """
+        Returns this process's hits and misses, and the number and total size of cached responses.
+        """
+
+        entries, size = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests != 0 else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+
+def from_environment():
+    """
+    Returns the `ResponseCache` configured by the OPENAI_RESPONSE_CACHE* environment variables, or None if disabled.
+    """
+
+    path = os.environ.get("OPENAI_RESPONSE_CACHE", DEFAULT_PATH)
+    if path == "":
+        return None
+
+    max_age = os.environ.get("OPENAI_RESPONSE_CACHE_MAX_AGE")
+    max_bytes = os.environ.get("OPENAI_RESPONSE_CACHE_MAX_BYTES")
+    mode = os.environ.get("OPENAI_RESPONSE_CACHE_MODE", "readwrite")
+    if mode not in ("readwrite", "replay"):
+        raise ValueError(f"OPENAI_RESPONSE_CACHE_MODE must be 'readwrite' or 'replay', not {mode!r}")
+
+    return ResponseCache(
+        os.path.expanduser(path),
+        max_age=None if max_age is None else float(max_age) * 86400,
+        max_bytes=None if max_bytes is None else int(max_bytes),
+        replay=mode == "replay",
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or trim the OpenAI response cache.")
+    parser.add_argument("command", choices=["stats", "evict"])
+    parser.add_argument("--path", default=os.environ.get("OPENAI_RESPONSE_CACHE", DEFAULT_PATH))
+    parser.add_argument("--max-age", type=float, default=None, help="in days")
+    parser.add_argument("--max-bytes", type=int, default=None)
+    args = parser.parse_args()
+
+    cache = ResponseCache(
+        os.path.expanduser(args.path),
+        max_age=None if args.max_age is None else args.max_age * 86400,
+        max_bytes=args.max_bytes,
+    )
+    if args.command == "evict":
+        cache.evict()
+    stats = cache.stats()
+    print(f"{stats['entries']} entries, {stats['bytes']} bytes")
@@ -0,0 +1,386 @@
+"""
+Inverted-file (IVF) index over the USDA branded_food embedding vectors.
+
+The exact search in `usda_search.py` takes a dot product with every row of
+`branded_food-all-MiniLM-L6-v2.npy`, which pages in the whole matrix for every
+query. This index clusters the (unit-normalized) vectors around `num_lists`
+centroids with spherical k-means and stores a reordered copy of the vectors so
+that each cluster is a contiguous slice on disk. A range query only reads the
+clusters that can contain a row with cosine similarity >= the threshold.
+
+Each cluster records its angular radius: the largest angle between its centroid
+and any of its members. By the triangle inequality on the sphere, a cluster
+whose centroid is at angle θ from the query contains no row with similarity
+above cos(max(0, θ - radius)), so skipping clusters for which that bound is
+below the threshold loses nothing. Setting `max_lists` additionally limits the
+search to that many clusters (nearest centroids first), which trades recall for
+speed; `python usda_index.py report` measures that tradeoff against the exact scan.
+
+All-zero rows (foods removed by an incremental usda_vector_database.py build)
+have similarity 0 with every query, so they never pass a positive threshold.
+They are left out of training and out of every cluster, and are stored after
+the last cluster, where no search reads them.
+
+The index is stored next to the vector database:
+
+    branded_food-all-MiniLM-L6-v2.ivf.npz   centroids, radii, offsets, order,
+                                            and the vector_state it was built from
+    branded_food-all-MiniLM-L6-v2.ivf.npy   vectors, reordered by cluster
+
+The vector_state is the number of rows and the build hash that
+usda_vector_database.py stores in the SQLite file. After a new build of the
+vectors it no longer matches, and usda_search.py goes back to the exact scan
+until the index is rebuilt.
+
+Usage:
+
+    python usda_index.py build [--num-lists N] [--sample-size N]
+    python usda_index.py report [--num-queries N] [--threshold X]
+"""
+
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+VECTOR_DATABASE_PATH = os.path.expanduser(
+    "~/Box/dsi-core/11th-hour/good-food-purchasing/branded_food-all-MiniLM-L6-v2.npy"
+)
+
+# numerical slack on the cluster bound, so that rounding never drops a true match
+BOUND_TOLERANCE = 1e-5
+
+# rows x centroids similarities computed at a time (32 MB of float32)
+SIMILARITY_BLOCK = 1 << 23
+
+
+def index_paths(vector_database_path):
+    """
+    Returns the (metadata, reordered vectors) file names for the index of `vector_database_path`.
+    """
+
+    base, _ = os.path.splitext(vector_database_path)
+    return f"{base}.ivf.npz", f"{base}.ivf.npy"
+
+
+def vector_state(vector_database_path):
+    """
+    Returns (number of rows, build hash) for the vector database. The hash is the 'vectors_hash' that usda_vector_database.py stores in the SQLite file next to it, or "" if there is none.
+    """
+
+    num_rows = len(np.lib.format.open_memmap(vector_database_path, mode="r"))
+    sqlite_path = os.path.splitext(vector_database_path)[0] + ".sqlite"
+    row = None
+    if os.path.exists(sqlite_path):
+        connection = sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True)
+        try:
+            row = connection.execute("SELECT value FROM metadata WHERE key = 'vectors_hash'").fetchone()
+        except sqlite3.OperationalError:
+            pass
+        finally:
+            connection.close()
+    return num_rows, row[0] if row else ""
+
+
+def nearest_centroids(rows, centroids):
+    """
+    Returns the index of each row's most similar centroid and that similarity, a block of rows at a time, so that the rows x centroids matrix is never whole.
+    """
+
+    block_size = max(1, SIMILARITY_BLOCK // len(centroids))
+    best = np.empty(len(rows), dtype=np.int64)
+    best_similarities = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), block_size):
+        similarities = np.asarray(rows[start : start + block_size], dtype=np.float32) @ centroids.T
+        block_best = np.argmax(similarities, axis=1)
+        best[start : start + len(block_best)] = block_best
+        best_similarities[start : start + len(block_best)] = similarities[np.arange(len(block_best)), block_best]
+    return best, best_similarities
+
+
+def runs(labels):
+    """
+    Returns `(order, starts, run_labels)`: the stable order that sorts `labels`, and where each run of equal labels starts in it, for `np.ufunc.reduceat`.
+    """
+
+    order = np.argsort(labels, kind="stable")
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(np.concatenate([[True], sorted_labels[1:] != sorted_labels[:-1]]))
+    return order, starts, sorted_labels[starts]
+
+
+def build_index(
+    vector_database_path=VECTOR_DATABASE_PATH,
+    num_lists=1024,
+    sample_size=200000,
+    num_iterations=20,
+    chunk_size=65536,
+    seed=12345,
+):
+    """
+    Trains centroids with spherical k-means on a random sample of the vector
+    database, assigns every row to its nearest centroid, and writes the index
+    files next to `vector_database_path`.
+    """
+
+    _, vectors_hash = vector_state(vector_database_path)
+    vectors = np.lib.format.open_memmap(vector_database_path, mode="r")
+    num_rows, num_dims = vectors.shape
+
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(
+        vectors[np.sort(rng.choice(num_rows, min(sample_size, num_rows), replace=False))],
+        dtype=np.float32,
+    )
+    sample = sample[sample.any(axis=1)]
+    num_lists = max(1, min(num_lists, len(sample)))
+    centroids = sample[rng.choice(len(sample), num_lists, replace=False)].copy()
+
+    block_size = max(1, SIMILARITY_BLOCK // num_lists)
+    for _ in range(num_iterations):
+        sums = np.zeros_like(centroids)
+        for start in range(0, len(sample), block_size):
+            block = sample[start : start + block_size]
+            assignments, _ = nearest_centroids(block, centroids)
+            # the sum of each cluster's members, by sorting and adding runs (much faster than np.add.at)
+            order, starts, lists = runs(assignments)
+            sums[lists] += np.add.reduceat(block[order], starts, axis=0)
+        norms = np.linalg.norm(sums, axis=1)
+        empty = norms == 0
+        centroids[~empty] = sums[~empty] / norms[~empty, np.newaxis]
+        # re-seed clusters that lost all of their members
+        centroids[empty] = sample[rng.choice(len(sample), np.count_nonzero(empty), replace=False)]
+
+    # all-zero rows get the extra list number num_lists, after every cluster
+    assignments = np.empty(num_rows, dtype=np.int32)
+    min_similarity = np.full(num_lists, np.inf, dtype=np.float32)
+    for start in range(0, num_rows, chunk_size):
+        chunk = np.asarray(vectors[start : start + chunk_size], dtype=np.float32)
+        best, similarities = nearest_centroids(chunk, centroids)
+        is_zero = ~chunk.any(axis=1)
+        best[is_zero] = num_lists
+        assignments[start : start + len(best)] = best
+        order, starts, lists = runs(best[~is_zero])
+        if len(lists) > 0:
+            min_similarity[lists] = np.minimum(
+                min_similarity[lists], np.minimum.reduceat(similarities[~is_zero][order], starts)
+            )
+
+    order = np.argsort(assignments, kind="stable")
+    counts = np.bincount(assignments, minlength=num_lists + 1)
+    # num_lists + 2 offsets: the last slice is the all-zero rows
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    radii = np.arccos(np.clip(min_similarity, -1, 1))
+    radii[counts[:num_lists] == 0] = 0
+
+    metadata_path, vectors_path = index_paths(vector_database_path)
+
+    reordered = np.lib.format.open_memmap(
+        vectors_path, mode="w+", dtype=vectors.dtype, shape=(num_rows, num_dims)
+    )
+    for start in range(0, num_rows, chunk_size):
+        reordered[start : start + chunk_size] = vectors[order[start : start + chunk_size]]
+    reordered.flush()
+    del reordered
+
+    np.savez(
+        metadata_path,
+        centroids=centroids,
+        radii=radii,
+        offsets=offsets,
+        order=order,
+        num_rows=num_rows,
+        vectors_hash=vectors_hash,
+    )
+
+
+class IVFIndex:
+    """
+    A built index, opened read-only. The reordered vectors are memory-mapped,
+    so only the clusters touched by a query are paged in.
+    """
+
+    def __init__(self, vector_database_path=VECTOR_DATABASE_PATH):
+        metadata_path, vectors_path = index_paths(vector_database_path)
+        with np.load(metadata_path) as metadata:
+            self.centroids = metadata["centroids"]
+            self.radii = metadata["radii"]
+            self.offsets = metadata["offsets"]
+            self.order = metadata["order"]
+            # None for an index built before the state was recorded
+            if "num_rows" in metadata.files:
+                self.state = int(metadata["num_rows"]), str(metadata["vectors_hash"])
+            else:
+                self.state = None
+        self.vectors = np.lib.format.open_memmap(vectors_path, mode="r")
+
+    def __len__(self):
+        return len(self.order)
+
+    def candidate_lists(self, vector, threshold, max_lists=None):
+        """
+        Returns the clusters that may contain rows with similarity >= `threshold`,
+        nearest centroid first, truncated to `max_lists` if given.
+        """
+
+        centroid_similarities = self.centroids @ vector
+        angles = np.arccos(np.clip(centroid_similarities, -1, 1))
+        bounds = np.cos(np.maximum(angles - self.radii, 0))
+        lists = np.nonzero(bounds >= threshold - BOUND_TOLERANCE)[0]
+        lists = lists[np.argsort(-centroid_similarities[lists], kind="stable")]
+        if max_lists is not None:
+            lists = lists[:max_lists]
+        return lists
+
+    def range_search(self, vector, threshold, max_lists=None):
+        """
+        Returns (indexes, similarities) of all rows in the vector database with
+        similarity >= `threshold` to `vector`, sorted by index. With `max_lists=None`
+        the result is the same as the exact scan; otherwise it may miss rows.
+        """
+
+        found_indexes = [np.empty(0, dtype=self.order.dtype)]
+        found_similarities = [np.empty(0, dtype=np.float32)]
+        # visit clusters in disk order, so reads are sequential
+        for i in np.sort(self.candidate_lists(vector, threshold, max_lists)):
+            start, stop = self.offsets[i], self.offsets[i + 1]
+            similarities = self.vectors[start:stop] @ vector
+            keep = np.nonzero(similarities >= threshold)[0]
+            found_indexes.append(self.order[start + keep])
+            found_similarities.append(similarities[keep])
+
+        indexes = np.concatenate(found_indexes)
+        similarities = np.concatenate(found_similarities)
+        ordering = np.argsort(indexes)
+        return indexes[ordering], similarities[ordering]
+
+
+def exact_range_search(vector_database, vector, threshold):
+    """
+    Same interface as `IVFIndex.range_search`, but scans the whole vector database.
+    """
+
+    similarities = np.dot(vector_database, vector)
+    indexes = np.nonzero(similarities >= threshold)[0]
+    return indexes, similarities[indexes]
+
+
+def blocked_range_search(vector_database, vectors, threshold, tile_size=65536):
+    """
+    Same as `exact_range_search` for each row of `vectors`, but reads the vector
+    database only once: each tile of `tile_size` rows is multiplied by all of the
+    query vectors at once. Returns a list of (indexes, similarities) per query.
+    """
+
+    vectors = np.asarray(vectors)
+    found_indexes = [[] for _ in range(len(vectors))]
+    found_similarities = [[] for _ in range(len(vectors))]
+
+    for start in range(0, len(vector_database), tile_size):
+        similarities = np.asarray(vector_database[start : start + tile_size]) @ vectors.T
+        rows, queries = np.nonzero(similarities >= threshold)
+        # group hits by query; a stable sort keeps rows in increasing order within each query
+        ordering = np.argsort(queries, kind="stable")
+        rows, queries = rows[ordering], queries[ordering]
+        boundaries = np.searchsorted(queries, np.arange(len(vectors) + 1))
+        for i in np.unique(queries):
+            selected = rows[boundaries[i] : boundaries[i + 1]]
+            found_indexes[i].append(start + selected)
+            found_similarities[i].append(similarities[selected, i])
+
+    return [
+        (
+            np.concatenate(indexes) if len(indexes) != 0 else np.empty(0, dtype=np.int64),
+            np.concatenate(similarities) if len(similarities) != 0 else np.empty(0, dtype=vectors.dtype),
+        )
+        for indexes, similarities in zip(found_indexes, found_similarities)
+    ]
+
+
+def recall_report(
+    vector_database_path=VECTOR_DATABASE_PATH,
+    num_queries=200,
+    threshold=0.6,
+    max_lists_options=(1, 4, 16, 64, 256, None),
+    seed=12345,
+):
+    """
+    Uses randomly chosen rows of the vector database as queries and compares
+    the index at several `max_lists` settings against the exact scan.
+
+    Returns a list of dicts with the mean recall, the mean number of rows read,
+    and the mean time per query for each setting.
+    """
+
+    vector_database = np.lib.format.open_memmap(vector_database_path, mode="r")
+    index = IVFIndex(vector_database_path)
+
+    rng = np.random.default_rng(seed)
+    queries = np.asarray(
+        vector_database[np.sort(rng.choice(len(vector_database), num_queries, replace=False))]
+    )
+
+    exact = []
+    start_time = time.perf_counter()
+    for query in queries:
+        exact.append(exact_range_search(vector_database, query, threshold)[0])
+    exact_seconds = (time.perf_counter() - start_time) / num_queries
+
+    report = [
+        {
+            "max_lists": "exact",
+            "recall": 1.0,
+            "rows_read": float(len(vector_database)),
+            "seconds_per_query": exact_seconds,
+        }
+    ]
+    for max_lists in max_lists_options:
+        recalls = []
+        rows_read = []
+        start_time = time.perf_counter()
+        for query, expected in zip(queries, exact):
+            found, _ = index.range_search(query, threshold, max_lists=max_lists)
+            recalls.append(1.0 if len(expected) == 0 else len(np.intersect1d(found, expected)) / len(expected))
+        seconds = (time.perf_counter() - start_time) / num_queries
+        for query in queries:
+            lists = index.candidate_lists(query, threshold, max_lists)
+            rows_read.append(int(np.sum(index.offsets[lists + 1] - index.offsets[lists])))
+        report.append(
+            {
+                "max_lists": "all" if max_lists is None else max_lists,
+                "recall": float(np.mean(recalls)),
+                "rows_read": float(np.mean(rows_read)),
+                "seconds_per_query": seconds,
+            }
+        )
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build or evaluate the IVF index over the USDA vector database.")
+    parser.add_argument("command", choices=["build", "report"])
+    parser.add_argument("--vector-database", default=VECTOR_DATABASE_PATH)
+    parser.add_argument("--num-lists", type=int, default=1024)
+    parser.add_argument("--sample-size", type=int, default=200000)
+    parser.add_argument("--num-iterations", type=int, default=20)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--threshold", type=float, default=0.6)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_index(
+            args.vector_database,
+            num_lists=args.num_lists,
+            sample_size=args.sample_size,
+            num_iterations=args.num_iterations,
+        )
+
+    else:
+        print(f"{'max_lists':>10} {'recall':>8} {'rows read':>12} {'ms/query':>10}")
+        for line in recall_report(args.vector_database, num_queries=args.num_queries, threshold=args.threshold):
+            print(
+                f"{line['max_lists']:>10} {line['recall']:8.4f} {line['rows_read']:12.0f} {line['seconds_per_query'] * 1000:10.3f}"
+            )
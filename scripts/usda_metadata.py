@@ -0,0 +1,160 @@
+"""
+Lookup of the USDA branded_food rows (gtin_upc, vendor, brand, product,
+ingredients) by npy_index, for the candidates of a vector search.
+
+There are two backends with the same interface:
+
+    ArrowMetadata     branded_food-all-MiniLM-L6-v2.metadata.arrow, an
+                      uncompressed Arrow file whose row i is npy_index i. It is
+                      memory-mapped, and a lookup is one vectorized `take`, which
+                      only pages in the rows it touches.
+    SQLiteMetadata    the branded_food table of branded_food-all-MiniLM-L6-v2.sqlite,
+                      queried in chunks that stay under SQLite's limit on bound
+                      variables, with one connection per thread.
+
+Both return rows in the order of the requested indexes, so they line up with
+whatever the caller computed for those indexes. Both can be shared by a thread
+pool.
+
+`open_metadata` uses the Arrow file if it exists and is at least as new as the
+SQLite file. USDA_METADATA_BACKEND=sqlite forces the SQLite backend.
+
+Usage:
+
+    python usda_metadata.py export
+"""
+
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+import usda_index
+
+VECTOR_DATABASE_PATH = usda_index.VECTOR_DATABASE_PATH
+
+COLUMNS = ("gtin_upc", "vendor", "brand", "product", "ingredients")
+
+# SQLite builds before 3.32 allow at most 999 bound variables per statement
+MAX_VARIABLES = 999
+
+
+def metadata_paths(vector_database_path):
+    """
+    Returns the (Arrow, SQLite) file names for the metadata of `vector_database_path`.
+    """
+
+    base, _ = os.path.splitext(vector_database_path)
+    return f"{base}.metadata.arrow", f"{base}.sqlite"
+
+
+class SQLiteMetadata:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path)
+        return connection
+
+    def rows(self, indexes):
+        """
+        Returns a `(npy_index, gtin_upc, vendor, brand, product, ingredients)` tuple for each of `indexes`, in order.
+        """
+
+        indexes = [int(i) for i in indexes]
+        unique = sorted(set(indexes))
+        found = {}
+        connection = self._connection()
+        for start in range(0, len(unique), MAX_VARIABLES):
+            chunk = unique[start : start + MAX_VARIABLES]
+            for row in connection.execute(
+                f"SELECT npy_index, {', '.join(COLUMNS)} FROM branded_food WHERE npy_index IN ({', '.join(['?'] * len(chunk))})",
+                chunk,
+            ):
+                found[row[0]] = row
+        return [found.get(i, (i,) + ("",) * len(COLUMNS)) for i in indexes]
+
+
+class ArrowMetadata:
+    def __init__(self, path):
+        import pyarrow as pa
+
+        self.path = path
+        self._file = pa.memory_map(path)
+        self.table = pa.ipc.open_file(self._file).read_all()
+
+    def __len__(self):
+        return len(self.table)
+
+    def rows(self, indexes):
+        """
+        Returns a `(npy_index, gtin_upc, vendor, brand, product, ingredients)` tuple for each of `indexes`, in order.
+        """
+
+        indexes = np.asarray(indexes, dtype=np.int64)
+        gathered = self.table.take(indexes)
+        columns = [gathered.column(name).to_pylist() for name in COLUMNS]
+        return list(zip(indexes.tolist(), *columns))
+
+
+def export(vector_database_path=VECTOR_DATABASE_PATH, chunk_size=100000):
+    """
+    Writes the Arrow metadata file from the SQLite table, with one row per row of the vector database (empty strings for npy_indexes that have no row).
+    """
+
+    import pyarrow as pa
+
+    arrow_path, sqlite_path = metadata_paths(vector_database_path)
+    num_rows = len(np.lib.format.open_memmap(vector_database_path, mode="r"))
+    schema = pa.schema([(name, pa.string()) for name in COLUMNS])
+
+    connection = sqlite3.connect(sqlite_path)
+    with pa.OSFile(arrow_path + ".tmp", "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+        for start in range(0, num_rows, chunk_size):
+            stop = min(start + chunk_size, num_rows)
+            columns = [[""] * (stop - start) for _ in COLUMNS]
+            for row in connection.execute(
+                f"SELECT npy_index, {', '.join(COLUMNS)} FROM branded_food WHERE npy_index >= ? AND npy_index < ?",
+                (start, stop),
+            ):
+                for column, value in zip(columns, row[1:]):
+                    column[row[0] - start] = "" if value is None else value
+            writer.write_batch(pa.record_batch(columns, schema=schema))
+    connection.close()
+    os.replace(arrow_path + ".tmp", arrow_path)
+    return arrow_path
+
+
+def open_metadata(vector_database_path=VECTOR_DATABASE_PATH, backend=None):
+    """
+    Returns the `backend` ("arrow" or "sqlite"; default: USDA_METADATA_BACKEND, or Arrow if its file is up to date).
+    """
+
+    arrow_path, sqlite_path = metadata_paths(vector_database_path)
+    if backend is None:
+        backend = os.environ.get("USDA_METADATA_BACKEND")
+    if backend is None:
+        is_current = os.path.exists(arrow_path) and (
+            not os.path.exists(sqlite_path) or os.path.getmtime(arrow_path) >= os.path.getmtime(sqlite_path)
+        )
+        backend = "arrow" if is_current else "sqlite"
+
+    if backend == "arrow":
+        return ArrowMetadata(arrow_path)
+    else:
+        return SQLiteMetadata(sqlite_path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export the USDA metadata from SQLite to a memory-mappable Arrow file.")
+    parser.add_argument("command", choices=["export"])
+    parser.add_argument("--vector-database", default=VECTOR_DATABASE_PATH)
+    args = parser.parse_args()
+
+    print(f"wrote {export(args.vector_database)}")
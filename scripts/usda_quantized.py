@@ -0,0 +1,241 @@
+"""
+Quantized copies of the USDA branded_food embedding vectors, for exact-scan
+searches that read 2× (float16) or 4× (int8) less than the float32 file.
+
+    branded_food-all-MiniLM-L6-v2.float16.npy        vectors as float16
+    branded_food-all-MiniLM-L6-v2.int8.npy           vectors as int8, each row
+    branded_food-all-MiniLM-L6-v2.int8-scales.npy    scaled by its own float32 factor
+    branded_food-all-MiniLM-L6-v2.{dtype}-state.json the usda_index.vector_state
+                                                     the copy was built from
+
+usda_search.py only reads a copy whose recorded state matches the vector
+database; after a new build of the vectors, it scans the float32 file until the
+copy is rebuilt.
+
+A scan dequantizes one tile of rows at a time to float32, so memory stays
+bounded and the page cache only holds the small file.
+
+Quantization moves similarities by a little: at most about 0.001 for float16
+and a bound that depends on each row's scale for int8. With `rescore=True`, a
+search keeps every row within that error of the threshold as a candidate and
+then recomputes the candidates' similarities from the float32 file. Those few
+rows are the only float32 reads, and the result is the same set of rows as the
+float32 scan. Without rescoring, the quantized similarities are used as they
+are, and rows near the threshold can be gained or lost;
+`python usda_quantized.py report` counts how many.
+
+Usage:
+
+    python usda_quantized.py build [--dtype {float16,int8}]
+    python usda_quantized.py report [--dtype {float16,int8}] [--num-queries N] [--threshold X]
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+
+import usda_index
+
+VECTOR_DATABASE_PATH = usda_index.VECTOR_DATABASE_PATH
+
+DTYPES = ("float16", "int8")
+
+# float16 has an 11-bit significand: for unit vectors, a dot product moves by at most ~2**-11
+FLOAT16_MARGIN = 1e-3
+
+
+def quantized_paths(vector_database_path, dtype):
+    """
+    Returns the (vectors, scales) file names for the `dtype` copy of `vector_database_path`; scales is None for float16.
+    """
+
+    base, _ = os.path.splitext(vector_database_path)
+    return f"{base}.{dtype}.npy", (f"{base}.{dtype}-scales.npy" if dtype == "int8" else None)
+
+
+def state_path(vector_database_path, dtype):
+    """
+    Returns the file name that records the `usda_index.vector_state` the `dtype` copy was built from.
+    """
+
+    base, _ = os.path.splitext(vector_database_path)
+    return f"{base}.{dtype}-state.json"
+
+
+def quantize(vector_database_path=VECTOR_DATABASE_PATH, dtype="int8", chunk_size=65536):
+    """
+    Writes the `dtype` copy of the vector database next to it.
+    """
+
+    num_rows, vectors_hash = usda_index.vector_state(vector_database_path)
+    vectors = np.lib.format.open_memmap(vector_database_path, mode="r")
+    vectors_path, scales_path = quantized_paths(vector_database_path, dtype)
+
+    quantized = np.lib.format.open_memmap(vectors_path + ".tmp", mode="w+", dtype=dtype, shape=vectors.shape)
+    scales = np.zeros(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start : start + chunk_size], dtype=np.float32)
+        if dtype == "float16":
+            quantized[start : start + len(chunk)] = chunk.astype(np.float16)
+        else:
+            chunk_scales = np.abs(chunk).max(axis=1) / 127
+            divisors = np.where(chunk_scales == 0, 1, chunk_scales)[:, np.newaxis]
+            quantized[start : start + len(chunk)] = np.rint(chunk / divisors).astype(np.int8)
+            scales[start : start + len(chunk)] = chunk_scales
+    quantized.flush()
+    del quantized
+
+    os.replace(vectors_path + ".tmp", vectors_path)
+    if scales_path is not None:
+        np.save(scales_path, scales)
+    with open(state_path(vector_database_path, dtype), "w") as f:
+        json.dump({"num_rows": num_rows, "vectors_hash": vectors_hash}, f)
+
+
+class QuantizedVectors:
+    """
+    A quantized copy of the vector database, opened read-only. Slicing it returns float32 rows, so it can stand in for the float32 memmap in `usda_index.blocked_range_search`.
+    """
+
+    def __init__(self, vector_database_path=VECTOR_DATABASE_PATH, dtype="int8"):
+        vectors_path, scales_path = quantized_paths(vector_database_path, dtype)
+        self.dtype = dtype
+        self.vectors = np.lib.format.open_memmap(vectors_path, mode="r")
+        self.scales = None if scales_path is None else np.load(scales_path)
+        # None for a copy built before the state was recorded
+        self.state = None
+        if os.path.exists(state_path(vector_database_path, dtype)):
+            with open(state_path(vector_database_path, dtype)) as f:
+                state = json.load(f)
+            self.state = state["num_rows"], state["vectors_hash"]
+        # only read for rescoring, a few rows at a time
+        self.float32_vectors = np.lib.format.open_memmap(vector_database_path, mode="r")
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def __getitem__(self, rows):
+        out = np.asarray(self.vectors[rows], dtype=np.float32)
+        if self.scales is not None:
+            out *= self.scales[rows, np.newaxis]
+        return out
+
+    def margin(self, vector):
+        """
+        Returns an upper bound on how far a quantized similarity to `vector` can be from the float32 one.
+        """
+
+        if self.scales is None:
+            return FLOAT16_MARGIN * float(np.linalg.norm(vector))
+        # each component is off by at most half of its row's scale
+        return float(self.scales.max()) / 2 * float(np.abs(vector).sum()) + usda_index.BOUND_TOLERANCE
+
+    def rescore(self, indexes, vector, threshold):
+        similarities = np.asarray(self.float32_vectors[indexes], dtype=np.float32) @ vector
+        keep = similarities >= threshold
+        return indexes[keep], similarities[keep]
+
+    def range_search(self, vector, threshold, rescore=True, tile_size=65536):
+        """
+        Same interface as `usda_index.exact_range_search`. With `rescore`, the result is the same as the float32 scan.
+        """
+
+        return self.blocked_range_search(vector[np.newaxis], threshold, rescore, tile_size)[0]
+
+    def blocked_range_search(self, vectors, threshold, rescore=True, tile_size=65536):
+        """
+        Same interface as `usda_index.blocked_range_search`.
+        """
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not rescore:
+            return usda_index.blocked_range_search(self, vectors, threshold, tile_size=tile_size)
+
+        margin = max(self.margin(vector) for vector in vectors)
+        candidates = usda_index.blocked_range_search(self, vectors, threshold - margin, tile_size=tile_size)
+        return [self.rescore(indexes, vector, threshold) for (indexes, _), vector in zip(candidates, vectors)]
+
+
+def difference_report(
+    vector_database_path=VECTOR_DATABASE_PATH,
+    dtype="int8",
+    num_queries=200,
+    threshold=0.6,
+    seed=12345,
+):
+    """
+    Uses randomly chosen rows of the vector database as queries and compares the quantized search, with and without rescoring, against the float32 scan.
+
+    Returns a list of dicts with the mean number of rows missing and extra per query, the fraction of queries with exactly the same rows, the mean number of candidates, and the time per query.
+    """
+
+    vector_database = np.lib.format.open_memmap(vector_database_path, mode="r")
+    quantized = QuantizedVectors(vector_database_path, dtype)
+
+    rng = np.random.default_rng(seed)
+    queries = np.asarray(
+        vector_database[np.sort(rng.choice(len(vector_database), num_queries, replace=False))], dtype=np.float32
+    )
+
+    start_time = time.perf_counter()
+    exact = usda_index.blocked_range_search(vector_database, queries, threshold)
+    report = [
+        {
+            "search": "float32",
+            "missing": 0.0,
+            "extra": 0.0,
+            "identical": 1.0,
+            "candidates": float(np.mean([len(indexes) for indexes, _ in exact])),
+            "seconds_per_query": (time.perf_counter() - start_time) / num_queries,
+            "bytes": vector_database.nbytes,
+        }
+    ]
+
+    margin = max(quantized.margin(query) for query in queries)
+    for rescore in (False, True):
+        start_time = time.perf_counter()
+        found = quantized.blocked_range_search(queries, threshold, rescore=rescore)
+        seconds = (time.perf_counter() - start_time) / num_queries
+        if rescore:
+            candidates = usda_index.blocked_range_search(quantized, queries, threshold - margin)
+        else:
+            candidates = found
+        missing = [len(np.setdiff1d(expected, indexes)) for (expected, _), (indexes, _) in zip(exact, found)]
+        extra = [len(np.setdiff1d(indexes, expected)) for (expected, _), (indexes, _) in zip(exact, found)]
+        report.append(
+            {
+                "search": f"{dtype}{' + rescore' if rescore else ''}",
+                "missing": float(np.mean(missing)),
+                "extra": float(np.mean(extra)),
+                "identical": float(np.mean([m == 0 and e == 0 for m, e in zip(missing, extra)])),
+                "candidates": float(np.mean([len(indexes) for indexes, _ in candidates])),
+                "seconds_per_query": seconds,
+                "bytes": quantized.vectors.nbytes + (0 if quantized.scales is None else quantized.scales.nbytes),
+            }
+        )
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build or evaluate a quantized copy of the USDA vector database.")
+    parser.add_argument("command", choices=["build", "report"])
+    parser.add_argument("--vector-database", default=VECTOR_DATABASE_PATH)
+    parser.add_argument("--dtype", choices=DTYPES, default="int8")
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--threshold", type=float, default=0.6)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        quantize(args.vector_database, args.dtype)
+
+    else:
+        print(f"{'search':>16} {'missing':>8} {'extra':>8} {'identical':>10} {'candidates':>11} {'ms/query':>10} {'MB':>8}")
+        for line in difference_report(args.vector_database, args.dtype, args.num_queries, args.threshold):
+            print(
+                f"{line['search']:>16} {line['missing']:8.3f} {line['extra']:8.3f} {line['identical']:10.3f} "
+                f"{line['candidates']:11.1f} {line['seconds_per_query'] * 1000:10.3f} {line['bytes'] / 1e6:8.1f}"
+            )
@@ -4,32 +4,72 @@ Gets an ingredient list for a branded food from the USDA.
 The brand and product name are fuzzy-matched by a text-embedding space.
 """
 
+import asyncio
+import itertools
 import json
 import os
 import re
-import sqlite3
+import sys
+import threading
+import time
 
-import requests
 import numpy as np
 from sentence_transformers import SentenceTransformer
 
-OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
+import instrumentation
+import openai_client
+import response_cache as response_cache_module
+import usda_index
+import usda_metadata
+import usda_quantized
+
+# see response_cache.py for the environment variables that configure (or disable) this
+response_cache = response_cache_module.from_environment()
 
 model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
 
-vector_database = np.lib.format.open_memmap(
-    os.path.expanduser(
-        "~/Box/dsi-core/11th-hour/good-food-purchasing/branded_food-all-MiniLM-L6-v2.npy"
-    ),
-    mode="r",
+VECTOR_DATABASE_PATH = os.path.expanduser(
+    "~/Box/dsi-core/11th-hour/good-food-purchasing/branded_food-all-MiniLM-L6-v2.npy"
 )
 
-sqlite_database = sqlite3.connect(
-    os.path.expanduser(
-        "~/Box/dsi-core/11th-hour/good-food-purchasing/branded_food-all-MiniLM-L6-v2.sqlite"
-    )
-)
-cursor = sqlite_database.cursor()
+vector_database = np.lib.format.open_memmap(VECTOR_DATABASE_PATH, mode="r")
+
+# (number of rows, build hash) of the vectors; the quantized copy and the index below are only
+# used if they were built from this state, so a new build of the vectors can't make searches
+# read stale rows
+vector_state = usda_index.vector_state(VECTOR_DATABASE_PATH)
+
+# USDA_VECTOR_DTYPE=float16 or int8 makes exact scans read the smaller copy built by
+# `python usda_quantized.py build`; USDA_VECTOR_RESCORE=0 skips the float32 rescoring
+# that makes its results the same as the float32 scan's
+VECTOR_DATABASE_DTYPE = os.environ.get("USDA_VECTOR_DTYPE", "float32")
+quantized_database = None
+if VECTOR_DATABASE_DTYPE != "float32":
+    quantized_database = usda_quantized.QuantizedVectors(VECTOR_DATABASE_PATH, VECTOR_DATABASE_DTYPE)
+    quantized_rescore = os.environ.get("USDA_VECTOR_RESCORE", "1") != "0"
+    if quantized_database.state != vector_state:
+        print(
+            f"warning: the {VECTOR_DATABASE_DTYPE} copy of the vectors is out of date; scanning the float32 vectors "
+            f"until `python usda_quantized.py build --dtype {VECTOR_DATABASE_DTYPE}` is run",
+            file=sys.stderr,
+            flush=True,
+        )
+        quantized_database = None
+
+# built by `python usda_index.py build`; without it, every search is an exact scan
+ann_index = None
+if os.path.exists(usda_index.index_paths(VECTOR_DATABASE_PATH)[0]):
+    ann_index = usda_index.IVFIndex(VECTOR_DATABASE_PATH)
+    if ann_index.state != vector_state:
+        print(
+            "warning: the IVF index is out of date; using the exact scan until `python usda_index.py build` is run",
+            file=sys.stderr,
+            flush=True,
+        )
+        ann_index = None
+
+# the branded_food rows by npy_index (see usda_metadata.py); safe to share between threads
+metadata = usda_metadata.open_metadata(VECTOR_DATABASE_PATH)
 
 
 def usda_matches(
@@ -41,6 +81,9 @@ def usda_matches(
     chatgpt_temperature=1.0,
     chatgpt_num_trials=10,
     return_num_tokens=False,
+    exact_search=False,
+    ann_max_lists=None,
+    candidate_limits=None,
 ):
     """
     For each `vendor`, `brand`, `product` triple, this function
@@ -58,21 +101,213 @@ def usda_matches(
         * the number of prompt tokens and completion tokens
 
     For gpt-4.1-mini on 2025-08-29, 1 million prompt tokens costs $0.40 and 1 million completion tokens costs $1.60.
+
+    `candidate_limits` (a `CandidateLimits`) caps how many candidates are sent in step (3), and can skip step (3) when one candidate is far more similar than the rest; such matches have a `chatgpt_score` of None.
+
+    Step (2) uses the IVF index from `usda_index.py` if it has been built, unless `exact_search` is True. With `ann_max_lists=None`, the index returns the same rows as the exact scan; a number limits the search to that many clusters, which is faster but may miss some matches (see `python usda_index.py report`). The exact scan reads the quantized copy from `usda_quantized.py` if USDA_VECTOR_DTYPE selects one.
     """
 
-    vector = model.encode(f"{vendor} {brand} {product}")
+    with instrumentation.stage("encode"):
+        vector = model.encode(f"{vendor} {brand} {product}")
+
+    with instrumentation.stage("search"):
+        indexes, similarities = embedding_search(vector, embedding_threshold, exact_search, ann_max_lists)
+
+    return chatgpt_select(
+        vendor,
+        brand,
+        product,
+        indexes,
+        similarities,
+        chatgpt_model=chatgpt_model,
+        chatgpt_temperature=chatgpt_temperature,
+        chatgpt_num_trials=chatgpt_num_trials,
+        return_num_tokens=return_num_tokens,
+        candidate_limits=candidate_limits,
+    )
 
-    similarities = np.dot(vector_database, vector)
 
-    indexes = np.nonzero(similarities >= embedding_threshold)[0]
+def usda_matches_batch(
+    triples,
+    embedding_threshold=0.6,
+    chatgpt_model="gpt-4.1-mini",
+    chatgpt_temperature=1.0,
+    chatgpt_num_trials=10,
+    return_num_tokens=False,
+    exact_search=False,
+    ann_max_lists=None,
+    candidate_limits=None,
+    encode_batch_size=256,
+    tile_size=65536,
+    return_exceptions=False,
+):
+    """
+    Same as `usda_matches`, but for a list of `(vendor, brand, product)` triples at once.
 
-    cursor.execute(
-        f"SELECT vendor, brand, product FROM branded_food WHERE npy_index IN ({', '.join(['?'] * len(indexes))})",
-        indexes.tolist(),
+    All of the text is embedded in one `model.encode` call, and (unless the IVF index is in use) the similarities are computed as one matrix-matrix product against the vector database, streamed in tiles of `tile_size` rows so that memory stays bounded. This reads the vector database once per batch, rather than once per triple.
+
+    The LLM selection is still one request per triple. Returns a list with one `usda_matches` result per triple, in order. If `return_exceptions` is True, a triple whose LLM step fails gets the exception object in its place, rather than raising it (like `asyncio.gather`).
+    """
+
+    candidates = embedding_search_batch(
+        triples, embedding_threshold, exact_search, ann_max_lists, encode_batch_size, tile_size
     )
-    with_duplicates = ["{} {} {}".format(*row).strip() for row in cursor.fetchall()]
+
+    out = []
+    for (vendor, brand, product), (indexes, similarities) in zip(triples, candidates):
+        try:
+            out.append(
+                chatgpt_select(
+                    vendor,
+                    brand,
+                    product,
+                    indexes,
+                    similarities,
+                    chatgpt_model=chatgpt_model,
+                    chatgpt_temperature=chatgpt_temperature,
+                    chatgpt_num_trials=chatgpt_num_trials,
+                    return_num_tokens=return_num_tokens,
+                    candidate_limits=candidate_limits,
+                )
+            )
+        except Exception as err:
+            if not return_exceptions:
+                raise
+            out.append(err)
+
+    return out
+
+
+def embedding_search(vector, embedding_threshold, exact_search=False, ann_max_lists=None):
+    """
+    Returns (indexes, similarities) of USDA vectors with cosine similarity >= `embedding_threshold`, sorted by index.
+    """
+
+    if quantized_database is not None and (ann_index is None or exact_search):
+        return quantized_database.range_search(vector, embedding_threshold, rescore=quantized_rescore)
+    elif ann_index is None or exact_search:
+        return usda_index.exact_range_search(vector_database, vector, embedding_threshold)
+    else:
+        return ann_index.range_search(vector, embedding_threshold, max_lists=ann_max_lists)
+
+
+def embedding_search_batch(
+    triples, embedding_threshold, exact_search=False, ann_max_lists=None, encode_batch_size=256, tile_size=65536
+):
+    """
+    Embeds all of the `(vendor, brand, product)` triples and returns an `embedding_search` result for each.
+    """
+
+    with instrumentation.stage("encode"):
+        vectors = model.encode(
+            [f"{vendor} {brand} {product}" for vendor, brand, product in triples],
+            batch_size=encode_batch_size,
+        )
+
+    with instrumentation.stage("search"):
+        if quantized_database is not None and (ann_index is None or exact_search):
+            results = quantized_database.blocked_range_search(
+                vectors, embedding_threshold, rescore=quantized_rescore, tile_size=tile_size
+            )
+        elif ann_index is None or exact_search:
+            results = usda_index.blocked_range_search(
+                vector_database, vectors, embedding_threshold, tile_size=tile_size
+            )
+        else:
+            results = [
+                ann_index.range_search(vector, embedding_threshold, max_lists=ann_max_lists)
+                for vector in vectors
+            ]
+    return results
+
+
+def chatgpt_select(
+    vendor,
+    brand,
+    product,
+    indexes,
+    similarities,
+    chatgpt_model="gpt-4.1-mini",
+    chatgpt_temperature=1.0,
+    chatgpt_num_trials=10,
+    return_num_tokens=False,
+    candidate_limits=None,
+):
+    """
+    Steps (3) and (4) of `usda_matches`, given the `indexes` and `similarities` of the candidates from `embedding_search`.
+    """
+
+    request_body, inverse_indexes = chatgpt_request(
+        vendor,
+        brand,
+        product,
+        indexes,
+        similarities,
+        chatgpt_model,
+        chatgpt_temperature,
+        chatgpt_num_trials,
+        candidate_limits,
+    )
+    if request_body is None:
+        run_stats.record(chatgpt_model, len(indexes), inverse_indexes)
+        return chatgpt_results(
+            None, indexes, similarities, inverse_indexes, chatgpt_num_trials, return_num_tokens
+        )
+
+    fetched = False
+    start_time = time.perf_counter()
+
+    def fetch():
+        nonlocal fetched
+        fetched = True
+        with instrumentation.stage("llm"):
+            return openai_client.post_chat_completion(request_body)
+
+    if response_cache is None:
+        response_json = fetch()
+    else:
+        response_json = response_cache.call(request_body, fetch)
+
+    run_stats.record(
+        chatgpt_model, len(indexes), inverse_indexes, response_json, time.perf_counter() - start_time, not fetched
+    )
+    return chatgpt_results(
+        response_json, indexes, similarities, inverse_indexes, chatgpt_num_trials, return_num_tokens
+    )
+
+
+def chatgpt_request(
+    vendor,
+    brand,
+    product,
+    indexes,
+    similarities,
+    chatgpt_model,
+    chatgpt_temperature,
+    chatgpt_num_trials,
+    candidate_limits=None,
+):
+    """
+    Returns the chat-completions request body that asks ChatGPT to choose among the deduplicated candidates, and the `inverse_indexes` that map each of the `indexes` to its (zero-based) choice number, or -1 if `candidate_limits` left it out.
+
+    If there is nothing to ask (no candidates, or an early exit under `candidate_limits`), the request body is None and `inverse_indexes` maps the selected rows, if any, to 0.
+    """
+
+    if len(indexes) == 0:
+        return None, np.empty(0, dtype=np.int64)
+
+    with instrumentation.stage("metadata"):
+        rows = metadata.rows(indexes)
+    with_duplicates = ["{} {} {}".format(*row[2:5]).strip() for row in rows]
     unique_rows, inverse_indexes = np.unique_inverse(with_duplicates)
 
+    if candidate_limits is not None:
+        unique_rows, inverse_indexes = candidate_limits.apply(
+            unique_rows, inverse_indexes, similarities, f"{vendor} {brand} {product}"
+        )
+        if unique_rows is None:
+            return None, inverse_indexes
+
     choices = "\n    ".join(f"{i + 1}. {row}" for i, row in enumerate(unique_rows))
     message = f"""Which is the best match to the following food product description?
 
@@ -84,69 +319,79 @@ Here are your choices:
 
 Respond with JSON indicating the number `N` corresponding to the best match or `null` if none of the choices are a good match."""
 
-    response = requests.post(
-        "https://api.openai.com/v1/chat/completions",
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-        },
-        json={
-            "model": chatgpt_model,
-            "messages": [
-                {"role": "user", "content": message},
-            ],
-            "response_format": {
-                "type": "json_schema",
-                "json_schema": {
-                    "name": "best_match",
-                    "schema": {
-                        "type": "object",
-                        "properties": {
-                            "best": {"type": ["integer", "null"]},
-                        },
-                        "required": ["best"],
-                        "additionalProperties": False,
+    request_body = {
+        "model": chatgpt_model,
+        "messages": [
+            {"role": "user", "content": message},
+        ],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "best_match",
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "best": {"type": ["integer", "null"]},
                     },
+                    "required": ["best"],
+                    "additionalProperties": False,
                 },
             },
-            "temperature": chatgpt_temperature,
-            "n": chatgpt_num_trials,
         },
-    )
-    response_json = response.json()
+        "temperature": chatgpt_temperature,
+        "n": chatgpt_num_trials,
+    }
+
+    return request_body, inverse_indexes
+
+
+def chatgpt_results(response_json, indexes, similarities, inverse_indexes, chatgpt_num_trials, return_num_tokens):
+    """
+    Converts ChatGPT's choices into the list of matches returned by `usda_matches`. A `response_json` of None means that no request was made (see `chatgpt_request`): the rows with `inverse_indexes` 0, if any, are the matches, with no `chatgpt_score`.
+    """
+
+    if response_json is None:
+        indexes_to_get = [int(j) for j in indexes[inverse_indexes == 0]]
+        scores = [None] * len(indexes_to_get)
+        num_tokens = {"prompt_tokens": 0, "completion_tokens": 0}
 
-    best_indexes = [
-        x
-        for x in [
-            json.loads(result["message"]["content"])["best"]
-            for result in response_json["choices"]
+    else:
+        num_tokens = {
+            "prompt_tokens": response_json["usage"]["prompt_tokens"],
+            "completion_tokens": response_json["usage"]["completion_tokens"],
+        }
+        num_choices = int(inverse_indexes.max()) + 1 if len(inverse_indexes) != 0 else 0
+        best_indexes = [
+            x
+            for x in [
+                json.loads(result["message"]["content"])["best"]
+                for result in response_json["choices"]
+            ]
+            # only numbers that were offered; 0 would select the rows left out by candidate_limits
+            if x is not None and 1 <= x <= num_choices
         ]
-        if x is not None
-    ]
-    if len(best_indexes) == 0:
-        return []
-    unique_indexes, index_counts = np.unique_counts(best_indexes)
-
-    indexes_to_get = []
-    scores = []
-    for i, cnt in zip(unique_indexes, index_counts):
-        for j in indexes[inverse_indexes == i - 1]:
-            indexes_to_get.append(int(j))
-            scores.append(float(cnt / chatgpt_num_trials))
-
-    cursor.execute(
-        f"SELECT * FROM branded_food WHERE npy_index IN ({', '.join(['?'] * len(indexes_to_get))})",
-        indexes_to_get,
-    )
+
+        indexes_to_get = []
+        scores = []
+        if len(best_indexes) != 0:
+            unique_indexes, index_counts = np.unique_counts(best_indexes)
+            for i, cnt in zip(unique_indexes, index_counts):
+                for j in indexes[inverse_indexes == i - 1]:
+                    indexes_to_get.append(int(j))
+                    scores.append(float(cnt / chatgpt_num_trials))
+
+    # rows come back in the order of indexes_to_get, so they line up with scores
     seen = set()
     out = []
-    for row, score in zip(cursor.fetchall(), scores):
-        if row in seen:
+    with instrumentation.stage("metadata"):
+        rows = metadata.rows(indexes_to_get)
+    for row, score in zip(rows, scores):
+        if row[1:] in seen:
             continue
         seen.add(row[1:])
         out.append(
             {
-                "encoding_similarity": similarities[row[0]],
+                "encoding_similarity": similarities[np.searchsorted(indexes, row[0])],
                 "chatgpt_score": score,
                 "usda_index": row[0],
                 "gtin_upc": row[1],
@@ -158,21 +403,355 @@ Respond with JSON indicating the number `N` corresponding to the best match or `
         )
 
     if return_num_tokens:
-        return out, {
-            "prompt_tokens": response_json["usage"]["prompt_tokens"],
-            "completion_tokens": response_json["usage"]["completion_tokens"],
-        }
+        return out, num_tokens
     else:
         return out
 
 
+# characters in the chatgpt_request prompt other than the product and its choices
+PROMPT_OVERHEAD_CHARACTERS = 350
+
+
+class CandidateLimits:
+    """
+    Limits on the candidates that `chatgpt_request` sends to ChatGPT, ranked by their embedding similarity:
+
+        max_candidates          at most this many choices (top-k)
+        max_prompt_tokens       at most this many (estimated) prompt tokens, but always at least one choice
+        early_exit_similarity   if the most similar candidate has at least this similarity and is
+        early_exit_margin       at least this much more similar than the next one, it is the match,
+                                without asking ChatGPT
+
+    Any of them can be None (no limit). When nothing is cut, the request is the same as without limits, so cached responses still apply.
+    """
+
+    def __init__(self, max_candidates=None, max_prompt_tokens=None, early_exit_similarity=None, early_exit_margin=0.1):
+        self.max_candidates = max_candidates
+        self.max_prompt_tokens = max_prompt_tokens
+        self.early_exit_similarity = early_exit_similarity
+        self.early_exit_margin = early_exit_margin
+
+    def apply(self, unique_rows, inverse_indexes, similarities, description):
+        """
+        Returns the `unique_rows` to offer and the `inverse_indexes` renumbered for them (-1 for rows left out), or `(None, inverse_indexes)` with the dominant row as 0 for an early exit.
+        """
+
+        best = np.full(len(unique_rows), -np.inf)
+        np.maximum.at(best, inverse_indexes, similarities)
+        order = np.argsort(-best, kind="stable")
+
+        if (
+            self.early_exit_similarity is not None
+            and best[order[0]] >= self.early_exit_similarity
+            and (len(order) == 1 or best[order[0]] - best[order[1]] >= self.early_exit_margin)
+        ):
+            return None, np.where(inverse_indexes == order[0], 0, -1)
+
+        keep = order if self.max_candidates is None else order[: self.max_candidates]
+        if self.max_prompt_tokens is not None:
+            # about 4 characters per token, as in estimate_num_tokens; a choice line adds its number and indentation
+            line_tokens = np.array([(len(unique_rows[i]) + 8) // 4 for i in keep])
+            total_tokens = (PROMPT_OVERHEAD_CHARACTERS + len(description)) // 4 + np.cumsum(line_tokens)
+            keep = keep[: max(1, np.count_nonzero(total_tokens <= self.max_prompt_tokens))]
+
+        if len(keep) == len(unique_rows):
+            return unique_rows, inverse_indexes
+
+        # keep the alphabetical order of np.unique in the prompt
+        keep = np.sort(keep)
+        renumber = np.full(len(unique_rows), -1)
+        renumber[keep] = np.arange(len(keep))
+        return unique_rows[keep], renumber[inverse_indexes]
+
+
+# dollars per million (prompt, completion) tokens
+PRICES_PER_MILLION_TOKENS = {
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+}
+
+
+class RunStats:
+    """
+    Totals of candidates, tokens, cost, and request latency over a run, for tuning `CandidateLimits` for throughput per dollar. Shared by threads and coroutines; `usda_search.run_stats` is updated by every `chatgpt_select`.
+
+    Responses from the response cache cost nothing and aren't counted in the latency.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.rows = 0
+        self.requests = 0
+        self.cached = 0
+        self.skipped = 0
+        self.candidates = 0
+        self.choices = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.latencies = []
+        self.start_time = time.perf_counter()
+
+    def record(self, model, num_candidates, inverse_indexes, response_json=None, seconds=None, cached=False):
+        instrumentation.count("rows")
+        instrumentation.count("candidates", num_candidates)
+        if response_json is None:
+            instrumentation.count("llm_skipped")
+        else:
+            instrumentation.count("choices", int(inverse_indexes.max()) + 1)
+            instrumentation.count("response_cache_hits" if cached else "llm_requests")
+        usage = {} if response_json is None or cached else response_json.get("usage", {})
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        instrumentation.count("prompt_tokens", prompt_tokens)
+        instrumentation.count("completion_tokens", completion_tokens)
+
+        with self.lock:
+            self.rows += 1
+            self.candidates += num_candidates
+            if response_json is None:
+                self.skipped += 1
+                return
+            self.choices += int(inverse_indexes.max()) + 1
+            if cached:
+                self.cached += 1
+                return
+            prompt_price, completion_price = PRICES_PER_MILLION_TOKENS.get(model, (0.0, 0.0))
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cost += (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+            self.latencies.append(seconds)
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.start_time
+            latencies = np.array(self.latencies)
+            return {
+                "rows": self.rows,
+                "requests": self.requests,
+                "cached": self.cached,
+                "skipped": self.skipped,
+                "mean_candidates": self.candidates / max(self.rows, 1),
+                "mean_choices": self.choices / max(self.requests + self.cached, 1),
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "cost": self.cost,
+                "cost_per_1000_rows": 1000 * self.cost / max(self.rows, 1),
+                "rows_per_second": self.rows / max(elapsed, 1e-9),
+                "latency_mean": float(latencies.mean()) if len(latencies) else None,
+                "latency_p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "latency_p95": float(np.percentile(latencies, 95)) if len(latencies) else None,
+            }
+
+
+run_stats = RunStats()
+
+
+async def chatgpt_select_async(
+    session,
+    rate_limiter,
+    vendor,
+    brand,
+    product,
+    indexes,
+    similarities,
+    chatgpt_model="gpt-4.1-mini",
+    chatgpt_temperature=1.0,
+    chatgpt_num_trials=10,
+    return_num_tokens=False,
+    max_retries=5,
+    candidate_limits=None,
+):
+    """
+    Same as `chatgpt_select`, but the request is made with `openai_client.post_chat_completion_async`.
+    """
+
+    request_body, inverse_indexes = chatgpt_request(
+        vendor,
+        brand,
+        product,
+        indexes,
+        similarities,
+        chatgpt_model,
+        chatgpt_temperature,
+        chatgpt_num_trials,
+        candidate_limits,
+    )
+    if request_body is None:
+        run_stats.record(chatgpt_model, len(indexes), inverse_indexes)
+        return chatgpt_results(
+            None, indexes, similarities, inverse_indexes, chatgpt_num_trials, return_num_tokens
+        )
+
+    start_time = time.perf_counter()
+    response_json = None if response_cache is None else response_cache.get(request_body)
+    cached = response_json is not None
+    if response_json is None:
+        if response_cache is not None and response_cache.replay:
+            raise response_cache_module.CacheMiss(response_cache_module.request_key(request_body))
+        with instrumentation.stage("llm"):
+            response_json = await openai_client.post_chat_completion_async(
+                session, request_body, rate_limiter, max_retries
+            )
+        if response_cache is not None:
+            response_cache.put(request_body, response_json)
+
+    run_stats.record(
+        chatgpt_model, len(indexes), inverse_indexes, response_json, time.perf_counter() - start_time, cached
+    )
+    return chatgpt_results(
+        response_json, indexes, similarities, inverse_indexes, chatgpt_num_trials, return_num_tokens
+    )
+
+
+async def usda_matches_async(
+    rows,
+    on_result,
+    max_in_flight=32,
+    requests_per_minute=None,
+    tokens_per_minute=None,
+    max_retries=5,
+    ordered=True,
+    batch_size=256,
+    embedding_threshold=0.6,
+    chatgpt_model="gpt-4.1-mini",
+    chatgpt_temperature=1.0,
+    chatgpt_num_trials=10,
+    return_num_tokens=False,
+    exact_search=False,
+    ann_max_lists=None,
+    candidate_limits=None,
+):
+    """
+    Runs `usda_matches` on each of the `rows`, a list of `(key, vendor, brand, product)` tuples, overlapping up to `max_in_flight` ChatGPT requests.
+
+    The embedding search is done `batch_size` rows at a time (as in `usda_matches_batch`) in a worker thread, so the next batch is embedded while the previous batch's requests are in flight. Requests are throttled by `requests_per_minute` and `tokens_per_minute` (either may be None) and retried as described in openai_client.py.
+
+    As each row finishes, `on_result(key, matches)` is called, where `matches` is what `usda_matches` would return or the exception that row failed with. If `ordered` is True, calls are made in the order of `rows`; otherwise, in the order that they finish.
+    """
+
+    semaphore = asyncio.Semaphore(max_in_flight)
+    rate_limiter = openai_client.RateLimiter(requests_per_minute, tokens_per_minute)
+    finished = {}
+    next_position = 0
+
+    def report(position, key, matches):
+        nonlocal next_position
+        if not ordered:
+            on_result(key, matches)
+            return
+        finished[position] = (key, matches)
+        while next_position in finished:
+            on_result(*finished.pop(next_position))
+            next_position += 1
+
+    async def select(session, position, key, vendor, brand, product, indexes, similarities):
+        try:
+            matches = await chatgpt_select_async(
+                session,
+                rate_limiter,
+                vendor,
+                brand,
+                product,
+                indexes,
+                similarities,
+                chatgpt_model=chatgpt_model,
+                chatgpt_temperature=chatgpt_temperature,
+                chatgpt_num_trials=chatgpt_num_trials,
+                return_num_tokens=return_num_tokens,
+                max_retries=max_retries,
+                candidate_limits=candidate_limits,
+            )
+        except Exception as err:
+            matches = err
+        finally:
+            semaphore.release()
+        report(position, key, matches)
+
+    async with openai_client.async_session(max_in_flight) as session:
+        tasks = set()
+        for batch_start in range(0, len(rows), batch_size):
+            batch = rows[batch_start : batch_start + batch_size]
+
+            try:
+                candidates = await asyncio.to_thread(
+                    embedding_search_batch,
+                    [(vendor, brand, product) for _, vendor, brand, product in batch],
+                    embedding_threshold,
+                    exact_search,
+                    ann_max_lists,
+                )
+            except Exception as err:
+                candidates = [err] * len(batch)
+
+            for position, (key, vendor, brand, product), found in zip(itertools.count(batch_start), batch, candidates):
+                if isinstance(found, Exception):
+                    report(position, key, found)
+                    continue
+                await semaphore.acquire()
+                task = asyncio.create_task(select(session, position, key, vendor, brand, product, *found))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        await asyncio.gather(*tasks)
+
+
 if __name__ == "__main__":
-    import pandas as pd
+    import argparse
     import csv
-    import sys
+
+    import pandas as pd
     from tqdm import tqdm
 
-    start, stop = map(int, sys.argv[1:])
+    parser = argparse.ArgumentParser(description="Match CGFP purchase list rows [start, stop) to USDA branded foods.")
+    parser.add_argument("start", type=int)
+    parser.add_argument("stop", type=int)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=256,
+        help="number of CGFP rows to embed and search together (1 means row by row)",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="overlap the ChatGPT requests of many rows in one process",
+    )
+    parser.add_argument("--max-in-flight", type=int, default=32, help="with --async, the most concurrent requests")
+    parser.add_argument("--requests-per-minute", type=float, default=None, help="with --async, the request rate limit")
+    parser.add_argument("--tokens-per-minute", type=float, default=None, help="with --async, the token rate limit")
+    parser.add_argument("--max-retries", type=int, default=5, help="with --async, retries per request")
+    parser.add_argument(
+        "--unordered",
+        action="store_true",
+        help="with --async, write rows as they finish, rather than in input order",
+    )
+    parser.add_argument("--max-candidates", type=int, default=None, help="send at most this many choices to ChatGPT")
+    parser.add_argument("--max-prompt-tokens", type=int, default=None, help="and at most this many prompt tokens")
+    parser.add_argument(
+        "--early-exit-similarity",
+        type=float,
+        default=None,
+        help="skip ChatGPT when the best candidate has at least this similarity and leads the next by --early-exit-margin",
+    )
+    parser.add_argument("--early-exit-margin", type=float, default=0.1)
+    args = parser.parse_args()
+
+    # see instrumentation.py for the PIPELINE_* environment variables
+    instrumentation.from_environment()
+
+    candidate_limits = None
+    if (args.max_candidates, args.max_prompt_tokens, args.early_exit_similarity) != (None, None, None):
+        candidate_limits = CandidateLimits(
+            args.max_candidates, args.max_prompt_tokens, args.early_exit_similarity, args.early_exit_margin
+        )
+    start, stop = args.start, args.stop
 
     cgfp = pd.read_csv(
         "~/Box/dsi-core/11th-hour/good-food-purchasing/CONFIDENTIAL_GFPP Product Attribute List_8.26.25.csv",
@@ -199,46 +778,96 @@ if __name__ == "__main__":
             "usda_ingredients",
         ))
 
-        for index, row in tqdm(cgfp.iterrows(), total=len(cgfp)):
-            gtin_upc = "" if not isinstance(row["Product GTIN or UPC"], str) else row["Product GTIN or UPC"]
-            cgfp_vendor = "" if not isinstance(row["Vendor"], str) else row["Vendor"]
-            cgfp_brand = "" if not isinstance(row["Brand Name"], str) else row["Brand Name"]
-            cgfp_product = "" if not isinstance(row["Product Type"], str) else row["Product Type"]
-            cgfp_nova = "" if not isinstance(row["Level of Processing"], str) else row["Level of Processing"]
+        rows = []
+        for index, row in cgfp.iterrows():
+            rows.append((
+                index,
+                "" if not isinstance(row["Product GTIN or UPC"], str) else row["Product GTIN or UPC"],
+                "" if not isinstance(row["Vendor"], str) else row["Vendor"],
+                "" if not isinstance(row["Brand Name"], str) else row["Brand Name"],
+                "" if not isinstance(row["Product Type"], str) else row["Product Type"],
+                "" if not isinstance(row["Level of Processing"], str) else row["Level of Processing"],
+            ))
 
-            try:
-                matches = usda_matches(
-                    cgfp_vendor,
-                    cgfp_brand,
-                    cgfp_product,
+        progress = tqdm(total=len(rows))
+
+        def write_matches(row, matches):
+            index, gtin_upc, cgfp_vendor, cgfp_brand, cgfp_product, cgfp_nova = row
+
+            if isinstance(matches, Exception):
+                with open(f"failures/{index}", "w") as errfile:
+                    errfile.write(f"{type(matches).__name__}: {str(matches)}")
+
+            else:
+                with instrumentation.stage("write"):
+                    for match in matches:
+                        writer.writerow(
+                            (
+                                index,
+                                gtin_upc,
+                                cgfp_vendor,
+                                cgfp_brand,
+                                cgfp_product,
+                                cgfp_nova,
+                                match["encoding_similarity"],
+                                match["chatgpt_score"],
+                                match["usda_index"],
+                                match["gtin_upc"],
+                                match["vendor"],
+                                match["brand"],
+                                match["product"],
+                                match["ingredients"],
+                            )
+                        )
+                    file.flush()
+
+            progress.update(1)
+
+        if args.use_async:
+            asyncio.run(
+                usda_matches_async(
+                    [(row, row[2], row[3], row[4]) for row in rows],
+                    write_matches,
+                    max_in_flight=args.max_in_flight,
+                    requests_per_minute=args.requests_per_minute,
+                    tokens_per_minute=args.tokens_per_minute,
+                    max_retries=args.max_retries,
+                    ordered=not args.unordered,
+                    batch_size=args.batch_size,
                     embedding_threshold=0.6,
                     chatgpt_model="gpt-4.1-mini",
                     chatgpt_temperature=1.0,
                     chatgpt_num_trials=10,
                     return_num_tokens=False,
+                    candidate_limits=candidate_limits,
                 )
-            except Exception as err:
-                with open(f"failures/{index}", "w") as errfile:
-                    errfile.write(f"{type(err).__name__}: {str(err)}")
-                continue
-
-            for match in matches:
-                writer.writerow(
-                    (
-                        index,
-                        gtin_upc,
-                        cgfp_vendor,
-                        cgfp_brand,
-                        cgfp_product,
-                        cgfp_nova,
-                        match["encoding_similarity"],
-                        match["chatgpt_score"],
-                        match["usda_index"],
-                        match["gtin_upc"],
-                        match["vendor"],
-                        match["brand"],
-                        match["product"],
-                        match["ingredients"],
+            )
+
+        else:
+            for batch_start in range(0, len(rows), args.batch_size):
+                batch = rows[batch_start : batch_start + args.batch_size]
+
+                try:
+                    batch_matches = usda_matches_batch(
+                        [(cgfp_vendor, cgfp_brand, cgfp_product) for _, _, cgfp_vendor, cgfp_brand, cgfp_product, _ in batch],
+                        embedding_threshold=0.6,
+                        chatgpt_model="gpt-4.1-mini",
+                        chatgpt_temperature=1.0,
+                        chatgpt_num_trials=10,
+                        return_num_tokens=False,
+                        candidate_limits=candidate_limits,
+                        return_exceptions=True,
                     )
-                )
-            file.flush()
+                except Exception as err:
+                    # the embedding step failed, so the whole batch failed
+                    batch_matches = [err] * len(batch)
+
+                for row, matches in zip(batch, batch_matches):
+                    write_matches(row, matches)
+
+        progress.close()
+
+    print(f"run stats: {json.dumps(run_stats.summary())}")
+    print(f"request latency: {json.dumps(openai_client.latency.summary())}")
+    if response_cache is not None:
+        print(f"response cache: {response_cache.stats()}")
@@ -0,0 +1,280 @@
+"""
+Builds the two files that usda_search.py searches, from branded_food.csv:
+
+    branded_food-all-MiniLM-L6-v2.npy       one MiniLM embedding of
+                                            "{vendor} {brand} {product}" per row
+    branded_food-all-MiniLM-L6-v2.sqlite    table branded_food (npy_index
+                                            INTEGER PRIMARY KEY, gtin_upc, vendor,
+                                            brand, product, ingredients)
+
+The vendor is the brand_owner, the brand is the brand_name and subbrand_name
+(joined by ", "), and the product is the short_description.
+
+The CSV is streamed in chunks. Embeddings are computed in large batches,
+optionally in several processes, and written straight into a memory-mapped .npy
+file, so the whole table is never held in memory.
+
+The SQLite file also keeps a build_state table with the fdc_id and a hash of the
+embedded text for each npy_index. When a new USDA release is built over an
+existing database, only rows that are new or whose text changed are
+re-embedded. Rows that disappeared are deleted from branded_food and their
+vectors are zeroed, so they never pass a similarity threshold. New rows are
+appended. --full rebuilds everything from scratch, which also compacts away the
+removed rows.
+
+Both files are written under temporary names and renamed at the end, so an
+interrupted build leaves the previous database intact. A build ends by storing
+a hash of build_state in the metadata table; the usda_index.py index and the
+usda_quantized.py copies record the hash they were built from, and
+usda_search.py does not use them once it no longer matches, so they must be
+rebuilt after the vectors change. The command line also re-exports the
+usda_metadata.py Arrow file.
+
+Usage:
+
+    python usda_vector_database.py build [--csv branded_food.csv] [--full] [--processes N]
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+import food_data
+import usda_index
+import usda_metadata
+import usda_quantized
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+CSV_PATH = os.path.join(food_data.DATA_DIRECTORY, "branded_food.csv")
+VECTOR_DATABASE_PATH = usda_index.VECTOR_DATABASE_PATH
+SQLITE_DATABASE_PATH = os.path.splitext(VECTOR_DATABASE_PATH)[0] + ".sqlite"
+
+CSV_COLUMNS = ["fdc_id", "gtin_upc", "brand_owner", "brand_name", "subbrand_name", "short_description", "ingredients"]
+
+# rows copied at a time when growing the .npy file
+COPY_BLOCK = 1 << 18
+
+
+def table_rows(chunk):
+    """
+    Returns `(gtin_upc, vendor, brand, product, ingredients, text)` columns for a chunk of branded_food.csv, where `text` is what gets embedded.
+    """
+
+    vendor = chunk["brand_owner"].fillna("")
+    brand_name = chunk["brand_name"].fillna("")
+    subbrand_name = chunk["subbrand_name"].fillna("")
+    brand = brand_name.where(subbrand_name == "", brand_name + ", " + subbrand_name)
+    brand = brand.where(brand_name != "", subbrand_name)
+    product = chunk["short_description"].fillna("")
+    gtin_upc = food_data.normalize_gtin(chunk["gtin_upc"])[0].fillna("")
+    return gtin_upc, vendor, brand, product, chunk["ingredients"].fillna(""), vendor + " " + brand + " " + product
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def create_tables(connection):
+    connection.execute(
+        """CREATE TABLE IF NOT EXISTS branded_food (
+            npy_index INTEGER PRIMARY KEY,
+            gtin_upc TEXT,
+            vendor TEXT,
+            brand TEXT,
+            product TEXT,
+            ingredients TEXT
+        )"""
+    )
+    connection.execute(
+        """CREATE TABLE IF NOT EXISTS build_state (
+            npy_index INTEGER PRIMARY KEY,
+            fdc_id INTEGER NOT NULL UNIQUE,
+            text_hash TEXT NOT NULL
+        )"""
+    )
+    connection.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+
+
+def record_vectors_hash(connection):
+    """
+    Stores a hash of the build_state table as the metadata key 'vectors_hash'. Every build that changes a row of the vectors changes it, so the index and quantized copies, which record the hash they were built from, can tell when they are stale (see `usda_index.vector_state`).
+    """
+
+    digest = hashlib.sha256()
+    for npy_index, fdc_id, row_hash in connection.execute(
+        "SELECT npy_index, fdc_id, text_hash FROM build_state ORDER BY npy_index"
+    ):
+        digest.update(f"{npy_index} {fdc_id} {row_hash}\n".encode())
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO metadata (key, value) VALUES ('vectors_hash', ?)", (digest.hexdigest(),)
+        )
+
+
+def previous_state(vector_path, sqlite_path):
+    """
+    Returns `{fdc_id: (npy_index, text_hash)}` from an existing database built with MODEL_NAME, or None if there isn't one to update.
+    """
+
+    if not os.path.exists(sqlite_path) or not os.path.exists(vector_path):
+        return None
+    connection = sqlite3.connect(sqlite_path)
+    try:
+        tables = {name for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if "build_state" not in tables or "metadata" not in tables:
+            return None
+        model = connection.execute("SELECT value FROM metadata WHERE key = 'model'").fetchone()
+        if model is None or model[0] != MODEL_NAME:
+            return None
+        return {
+            fdc_id: (npy_index, digest)
+            for npy_index, fdc_id, digest in connection.execute("SELECT npy_index, fdc_id, text_hash FROM build_state")
+        }
+    finally:
+        connection.close()
+
+
+def build(
+    csv_path=CSV_PATH,
+    vector_path=VECTOR_DATABASE_PATH,
+    sqlite_path=SQLITE_DATABASE_PATH,
+    full=False,
+    processes=1,
+    batch_size=1024,
+    chunksize=100000,
+):
+    """
+    Builds or updates the vector database and its SQLite table from `csv_path` and returns counts of what was done.
+    """
+
+    from sentence_transformers import SentenceTransformer
+
+    start_time = time.perf_counter()
+    model = SentenceTransformer(MODEL_NAME)
+    dimension = model.get_sentence_embedding_dimension()
+
+    state = None if full else previous_state(vector_path, sqlite_path)
+    if state is None and not full:
+        print("no existing database with build state; building from scratch", flush=True)
+
+    # first pass: only the fdc_ids, to size the .npy file and assign every row its npy_index
+    fdc_ids = pd.read_csv(csv_path, usecols=["fdc_id"], dtype={"fdc_id": np.int64})["fdc_id"].to_numpy()
+    if state is None:
+        old_size = 0
+        npy_indexes = dict(zip(fdc_ids.tolist(), range(len(fdc_ids))))
+        removed = []
+    else:
+        old_size = np.lib.format.open_memmap(vector_path, mode="r").shape[0]
+        npy_indexes = {fdc_id: npy_index for fdc_id, (npy_index, _) in state.items()}
+        for fdc_id in fdc_ids.tolist():
+            if fdc_id not in npy_indexes:
+                npy_indexes[fdc_id] = old_size + len(npy_indexes) - len(state)
+        current = set(fdc_ids.tolist())
+        removed = [npy_index for fdc_id, (npy_index, _) in state.items() if fdc_id not in current]
+    size = old_size + len(npy_indexes) - (0 if state is None else len(state))
+
+    vectors = np.lib.format.open_memmap(vector_path + ".tmp", mode="w+", dtype=np.float32, shape=(size, dimension))
+    if state is not None:
+        old_vectors = np.lib.format.open_memmap(vector_path, mode="r")
+        for start in range(0, old_size, COPY_BLOCK):
+            stop = min(start + COPY_BLOCK, old_size)
+            vectors[start:stop] = old_vectors[start:stop]
+        del old_vectors
+        vectors[removed] = 0
+
+    if os.path.exists(sqlite_path + ".tmp"):
+        os.remove(sqlite_path + ".tmp")
+    connection = sqlite3.connect(sqlite_path + ".tmp")
+    if state is not None:
+        old_connection = sqlite3.connect(sqlite_path)
+        old_connection.backup(connection)
+        old_connection.close()
+    create_tables(connection)
+    with connection:
+        connection.executemany("DELETE FROM branded_food WHERE npy_index = ?", [(i,) for i in removed])
+        connection.executemany("DELETE FROM build_state WHERE npy_index = ?", [(i,) for i in removed])
+        connection.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('model', ?)", (MODEL_NAME,))
+
+    pool = None
+    if processes > 1:
+        pool = model.start_multi_process_pool(["cpu"] * processes)
+
+    num_embedded = 0
+    try:
+        for chunk in pd.read_csv(csv_path, usecols=CSV_COLUMNS, dtype=str, chunksize=chunksize):
+            gtin_upc, vendor, brand, product, ingredients, text = table_rows(chunk)
+            chunk_fdc_ids = chunk["fdc_id"].astype(np.int64).tolist()
+            chunk_npy_indexes = np.array([npy_indexes[fdc_id] for fdc_id in chunk_fdc_ids], dtype=np.int64)
+            hashes = [text_hash(x) for x in text]
+
+            if state is None:
+                to_embed = np.ones(len(chunk), dtype=bool)
+            else:
+                to_embed = np.array(
+                    [state.get(fdc_id, (None, None))[1] != digest for fdc_id, digest in zip(chunk_fdc_ids, hashes)]
+                )
+
+            if to_embed.any():
+                texts = text[to_embed].tolist()
+                if pool is None:
+                    embeddings = model.encode(texts, batch_size=batch_size)
+                else:
+                    embeddings = model.encode_multi_process(texts, pool, batch_size=batch_size)
+                vectors[chunk_npy_indexes[to_embed]] = embeddings
+                num_embedded += len(texts)
+
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO branded_food (npy_index, gtin_upc, vendor, brand, product, ingredients) VALUES (?, ?, ?, ?, ?, ?)",
+                    zip(chunk_npy_indexes.tolist(), gtin_upc, vendor, brand, product, ingredients),
+                )
+                connection.executemany(
+                    "INSERT OR REPLACE INTO build_state (npy_index, fdc_id, text_hash) VALUES (?, ?, ?)",
+                    zip(chunk_npy_indexes.tolist(), chunk_fdc_ids, hashes),
+                )
+            print(f"{num_embedded} embedded, {time.perf_counter() - start_time:.0f} s", flush=True)
+    finally:
+        if pool is not None:
+            model.stop_multi_process_pool(pool)
+
+    record_vectors_hash(connection)
+
+    vectors.flush()
+    del vectors
+    connection.close()
+    os.replace(vector_path + ".tmp", vector_path)
+    os.replace(sqlite_path + ".tmp", sqlite_path)
+
+    return {
+        "rows": len(fdc_ids),
+        "embedded": num_embedded,
+        "removed": len(removed),
+        "size": size,
+        "seconds": time.perf_counter() - start_time,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Build or update the branded_food vector database.")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--csv", default=CSV_PATH, help="the USDA branded_food.csv")
+    parser.add_argument("--full", action="store_true", help="re-embed every row instead of only the changes")
+    parser.add_argument("--processes", type=int, default=1, help="encoding processes (each uses several threads)")
+    parser.add_argument("--batch-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    print(json.dumps(build(args.csv, full=args.full, processes=args.processes, batch_size=args.batch_size)))
+    print(f"wrote {usda_metadata.export(VECTOR_DATABASE_PATH)}")
+    if os.path.exists(usda_index.index_paths(VECTOR_DATABASE_PATH)[0]):
+        print("the vectors changed: run `python usda_index.py build` to rebuild the index")
+    for dtype in usda_quantized.DTYPES:
+        if os.path.exists(usda_quantized.quantized_paths(VECTOR_DATABASE_PATH, dtype)[0]):
+            print(f"the vectors changed: run `python usda_quantized.py build --dtype {dtype}` to rebuild the {dtype} copy")